@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for SmartNotes storage.
+
+Benchmarks cover:
+- Storage formats: pretty-printed JSON vs. zlib/lzma block compression
+  (file size, save time, full load time, single-note read time)
+- Durability modes: throughput of a burst of add calls under
+  strict / batched / relaxed fsync policies
+- Query cache: repeated list/search calls, uncached vs. cached
+- Export: txt/md/json/ndjson one call per format vs. one multi-format run
+
+Run: python benchmark_smartnotes.py [--notes N] [--burst N] [--dir DIR]
+"""
+
+import argparse
+import io
+import json
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent))
+
+from smartnotes import BlockStore, DurabilityPolicy, RecordWriter, SmartNotes
+
+
+LOG_LINES = [
+    "ERROR connection refused by database server at {host}:5432",
+    "WARN retrying request {n} after timeout",
+    "INFO deployed build {n} to {host}",
+    "Traceback (most recent call last): File \"worker.py\", line {n}, in run",
+    "Decision: roll back release {n} on {host} #deploy",
+]
+
+
+def make_notes(count, seed=42):
+    """Generate log-heavy notes similar to agent workloads."""
+    rng = random.Random(seed)
+    start = datetime(2026, 1, 1)
+    notes = []
+    for i in range(1, count + 1):
+        lines = [rng.choice(LOG_LINES).format(host=f"host-{rng.randint(1, 20)}", n=rng.randint(1, 9999))
+                 for _ in range(rng.randint(1, 8))]
+        created = (start + timedelta(minutes=i)).isoformat()
+        notes.append({
+            "id": i,
+            "content": "\n".join(lines),
+            "tags": rng.sample(["deploy", "error", "database", "worker", "release", "ops"], 3),
+            "created": created,
+            "modified": created,
+        })
+    return notes
+
+
+def timed(func, repeat=3):
+    """Return the best wall time of ``repeat`` runs, in milliseconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def bench_storage(notes, workdir):
+    """Compare storage formats for size and latency."""
+    probe_ids = random.Random(7).sample([n["id"] for n in notes], min(50, len(notes)))
+    results = []
+
+    json_path = workdir / "notes.json"
+
+    def save_json():
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(notes, f, indent=2, ensure_ascii=False)
+
+    def load_json():
+        with open(json_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def read_one_json():
+        for note_id in probe_ids:
+            next(n for n in load_json() if n["id"] == note_id)
+
+    save_ms = timed(save_json)
+    results.append(("json (indent=2)", json_path.stat().st_size, save_ms, timed(load_json),
+                    timed(read_one_json, repeat=1) / len(probe_ids)))
+
+    for codec, level in [("zlib", 1), ("zlib", 6), ("zlib", 9), ("lzma", 0), ("lzma", 6)]:
+        store = BlockStore(workdir / f"notes-{codec}{level}.blk", codec=codec, level=level)
+
+        def save_blocks():
+            with open(store.path, "wb") as f:
+                store.write(notes, f)
+
+        def read_one_block():
+            for note_id in probe_ids:
+                store.read_note(note_id)
+
+        save_ms = timed(save_blocks)
+        results.append((f"{codec} level {level}", store.path.stat().st_size, save_ms,
+                        timed(store.read_all), timed(read_one_block, repeat=1) / len(probe_ids)))
+
+    print(f"\nStorage formats ({len(notes)} notes)")
+    print(f"{'format':<18}{'size (KB)':>12}{'ratio':>8}{'save ms':>10}{'load ms':>10}{'1 note ms':>11}")
+    baseline = results[0][1]
+    for name, size, save_ms, load_ms, one_ms in results:
+        print(f"{name:<18}{size / 1024:>12.1f}{baseline / size:>7.1f}x"
+              f"{save_ms:>10.1f}{load_ms:>10.1f}{one_ms:>11.2f}")
+
+
+def bench_durability(burst, workdir):
+    """Measure add throughput for each durability mode.
+
+    The commit column times only DurabilityPolicy.write of a notes-sized
+    payload, isolating the fsync cost from indexing and serialization.
+    Both columns include the final flush/close, which fsyncs pending
+    batched commits and nothing in relaxed mode.
+    """
+    payload = json.dumps(make_notes(200), indent=2)
+    print(f"\nDurability modes (burst of {burst} adds into an empty store)")
+    print(f"{'mode':<10}{'total ms':>12}{'adds/sec':>12}{'commits/sec':>14}")
+    for mode in ("strict", "batched", "relaxed"):
+        store_dir = workdir / f"durability-{mode}"
+        store_dir.mkdir()
+        with open(store_dir / "config.json", "w") as f:
+            json.dump({"durability": mode, "duplicates": "off"}, f)
+
+        notes = SmartNotes(writer=RecordWriter("ndjson", stream=io.StringIO()), notes_dir=store_dir)
+        start = time.perf_counter()
+        for i in range(burst):
+            notes.add_note(f"Burst note {i}: worker heartbeat ok")
+        notes.close()
+        elapsed = time.perf_counter() - start
+
+        policy = DurabilityPolicy(mode)
+        target = store_dir / "commit.json"
+        start = time.perf_counter()
+        for _ in range(burst):
+            policy.write(target, lambda f: f.write(payload))
+        policy.flush()
+        commit_elapsed = time.perf_counter() - start
+        print(f"{mode:<10}{elapsed * 1000:>12.1f}{burst / elapsed:>12.1f}"
+              f"{burst / commit_elapsed:>14.1f}")
+
+
+def bench_query_cache(notes, workdir):
+    """Compare repeated list/search calls with and without the result cache."""
+    store_dir = workdir / "query-cache"
+    store_dir.mkdir()
+    with open(store_dir / "notes.json", "w", encoding="utf-8") as f:
+        json.dump(notes, f)
+
+    store = SmartNotes(writer=RecordWriter("ndjson", stream=io.StringIO()), notes_dir=store_dir)
+    calls = [
+        ("list --tag error --limit 20", lambda: store.list_notes(tag_filter="error", limit=20)),
+        ("search host-7 --limit 20", lambda: store.list_notes(search_term="host-7", limit=20)),
+    ]
+    print(f"\nQuery cache ({len(notes)} notes, best of 3)")
+    print(f"{'call':<30}{'uncached ms':>13}{'cached ms':>11}")
+    for name, call in calls:
+        store.config["query_cache_size"] = 0
+        uncached = timed(call)
+        store.config["query_cache_size"] = 128
+        call()
+        cached = timed(call)
+        print(f"{name:<30}{uncached:>13.2f}{cached:>11.3f}")
+
+
+def bench_export(notes, workdir):
+    """Compare exporting each format separately with a single multi-format run."""
+    store_dir = workdir / "export"
+    store_dir.mkdir()
+    with open(store_dir / "notes.json", "w", encoding="utf-8") as f:
+        json.dump(notes, f)
+
+    store = SmartNotes(writer=RecordWriter("ndjson", stream=io.StringIO()), notes_dir=store_dir)
+    formats = ["txt", "md", "json", "ndjson"]
+
+    def one_by_one():
+        for fmt in formats:
+            store.export_notes(fmt, workdir / f"serial.{fmt}", workers=1,
+                               chunk_size=len(notes))
+
+    def combined():
+        store.export_notes(formats, workdir / "combined")
+
+    print(f"\nExport of {', '.join(formats)} ({len(notes)} notes, best of 3)")
+    print(f"{'mode':<30}{'total ms':>12}")
+    print(f"{'one call per format':<30}{timed(one_by_one):>12.1f}")
+    print(f"{'one multi-format call':<30}{timed(combined):>12.1f}")
+
+
+def main():
+    """Run all benchmarks."""
+    parser = argparse.ArgumentParser(description="SmartNotes benchmarks")
+    parser.add_argument("--notes", type=int, default=20000, help="Number of notes to generate")
+    parser.add_argument("--burst", type=int, default=200, help="Adds per durability run")
+    parser.add_argument("--dir", help="Run in this directory (fsync cost depends on the disk; "
+                                      "the default temp dir may be in memory)")
+    args = parser.parse_args()
+
+    print("=" * 70)
+    print("BENCHMARK: SmartNotes")
+    print("=" * 70)
+
+    notes = make_notes(args.notes)
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        bench_storage(notes, Path(tmp))
+        bench_durability(args.burst, Path(tmp))
+        bench_query_cache(notes, Path(tmp))
+        bench_export(notes, Path(tmp))
+
+    print("=" * 70)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -12,11 +12,37 @@ License: MIT
 import os
 import sys
 import json
+import time
+import threading
+import functools
+import contextlib
+import concurrent.futures
+import hashlib
+import lzma
+import uuid
+import bisect
+import difflib
+import math
 import re
+import random
+import struct
+import tempfile
+import zlib
+from collections import OrderedDict, deque
 from pathlib import Path
 from datetime import datetime
 import argparse
 
+try:
+    import numpy as np
+except ImportError:  # Optional: speeds up related-note scoring
+    np = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: change-feed appends are not locked
+    fcntl = None
+
 # Fix Windows console encoding
 if sys.platform == "win32":
     try:
@@ -27,40 +53,2502 @@ if sys.platform == "win32":
         pass
 
 
+class RecordWriter:
+    """Stream structured records as NDJSON lines or a JSON array.
+
+    Records are encoded compactly and written through a small buffer, so
+    large result sets start arriving right away and parse cheaply.
+    """
+
+    def __init__(self, mode="ndjson", stream=None, buffer_size=65536):
+        """Create a writer for ``mode`` ("json" or "ndjson")."""
+        if mode not in ("json", "ndjson"):
+            raise ValueError(f"Unsupported output mode: {mode}")
+        self.mode = mode
+        self.stream = stream if stream is not None else sys.stdout
+        self.buffer_size = buffer_size
+        self.count = 0
+        self._buffer = []
+        self._buffered = 0
+        self._encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+        # Records may come from several threads of a thread-safe SmartNotes
+        self._mutex = threading.RLock()
+
+    def write(self, record):
+        """Write one record."""
+        text = self._encode(record)
+        with self._mutex:
+            if self.mode == "json":
+                text = ("[\n" if self.count == 0 else ",\n") + text
+            else:
+                text += "\n"
+            self.count += 1
+            self._buffer.append(text)
+            self._buffered += len(text)
+            # Flush the first record immediately so consumers can start parsing
+            if self.count == 1 or self._buffered >= self.buffer_size:
+                self.flush()
+
+    def flush(self):
+        """Write buffered records to the stream."""
+        with self._mutex:
+            if self._buffer:
+                self.stream.write("".join(self._buffer))
+                self._buffer = []
+                self._buffered = 0
+            self.stream.flush()
+
+    def close(self):
+        """Terminate the stream (closing the array in JSON mode) and flush."""
+        if self.mode == "json":
+            self._buffer.append("[]\n" if self.count == 0 else "\n]\n")
+        self.flush()
+
+
+class NoteStats:
+    """Running aggregates over the note store.
+
+    Updated on every mutation so statistics never require a scan. Removing
+    the newest or oldest note marks that extreme stale; it is recomputed the
+    next time the store is saved (which walks every note anyway).
+    """
+
+    def __init__(self):
+        """Create empty aggregates."""
+        self.count = 0
+        self.total_chars = 0
+        self.tags = {}
+        self.days = {}
+        self.newest = None
+        self.oldest = None
+        self._vacated = set()
+
+    @classmethod
+    def from_notes(cls, notes):
+        """Build aggregates from a list of notes."""
+        stats = cls()
+        for note in notes:
+            stats.add(note)
+        return stats
+
+    @classmethod
+    def from_dict(cls, data):
+        """Restore aggregates saved with ``to_dict``."""
+        stats = cls()
+        stats.count = data["count"]
+        stats.total_chars = data["total_chars"]
+        stats.tags = data["tags"]
+        stats.days = data["days"]
+        stats.newest = data["newest"]
+        stats.oldest = data["oldest"]
+        return stats
+
+    def to_dict(self):
+        """Serialize aggregates (extremes must be fresh)."""
+        return {
+            "count": self.count,
+            "total_chars": self.total_chars,
+            "tags": self.tags,
+            "days": self.days,
+            "newest": self.newest,
+            "oldest": self.oldest,
+        }
+
+    @property
+    def stale(self):
+        """True when newest/oldest need recomputing."""
+        return bool(self._vacated)
+
+    def add(self, note):
+        """Account for a note entering the store."""
+        self.count += 1
+        self.total_chars += _content_length(note)
+        for tag in note.get("tags", []):
+            self.tags[tag] = self.tags.get(tag, 0) + 1
+
+        created = note.get("created", "")
+        if not created:
+            return
+        day = created[:10]
+        self.days[day] = self.days.get(day, 0) + 1
+
+        # Re-adding a vacated extreme (e.g. an edit) makes it valid again
+        self._vacated.discard(created)
+        if not self._vacated:
+            if self.newest is None or created > self.newest:
+                self.newest = created
+            if self.oldest is None or created < self.oldest:
+                self.oldest = created
+
+    def remove(self, note):
+        """Account for a note leaving the store."""
+        self.count -= 1
+        self.total_chars -= _content_length(note)
+        for tag in note.get("tags", []):
+            remaining = self.tags.get(tag, 0) - 1
+            if remaining > 0:
+                self.tags[tag] = remaining
+            else:
+                self.tags.pop(tag, None)
+
+        created = note.get("created", "")
+        if not created:
+            return
+        day = created[:10]
+        remaining = self.days.get(day, 0) - 1
+        if remaining > 0:
+            self.days[day] = remaining
+        else:
+            self.days.pop(day, None)
+
+        if created in (self.newest, self.oldest):
+            self._vacated.add(created)
+
+    def refresh_extremes(self, notes):
+        """Recompute newest/oldest after an extreme was removed."""
+        created = [n["created"] for n in notes if n.get("created")]
+        self.newest = max(created) if created else None
+        self.oldest = min(created) if created else None
+        self._vacated.clear()
+
+
+class MinHashIndex:
+    """MinHash signatures with an LSH banding index for near-duplicate lookup.
+
+    Each note is reduced to the set of its word 3-grams and summarized by
+    ``NUM_PERM`` min-hashes; the fraction of equal positions estimates the
+    Jaccard similarity of two notes. Signatures are split into ``BANDS``
+    bands and notes sharing any band bucket become candidates, so a lookup
+    only compares against a handful of notes instead of the whole store.
+    """
+
+    NUM_PERM = 64
+    BANDS = 16
+    ROWS = NUM_PERM // BANDS
+    SHINGLE_SIZE = 3
+    _PRIME = (1 << 61) - 1
+
+    def __init__(self):
+        """Create an empty index."""
+        self.signatures = {}
+        self.buckets = {}
+
+    @classmethod
+    def from_notes(cls, notes):
+        """Build an index over a list of notes."""
+        index = cls()
+        for note in notes:
+            index.add(note["id"], note.get("content", ""))
+        return index
+
+    @classmethod
+    def from_dict(cls, data):
+        """Restore an index saved with ``to_dict``."""
+        index = cls()
+        for note_id, signature in data["signatures"].items():
+            index._insert(int(note_id), signature)
+        return index
+
+    def to_dict(self):
+        """Serialize the signatures (buckets are rebuilt on load)."""
+        return {"signatures": {str(k): v for k, v in self.signatures.items()}}
+
+    @classmethod
+    def signature(cls, text):
+        """Compute the MinHash signature of ``text``, or None if it has no words."""
+        words = re.findall(r'\w+', text.lower())
+        if not words:
+            # Punctuation-only notes would all share one empty shingle
+            return None
+        size = cls.SHINGLE_SIZE
+        if len(words) <= size:
+            grams = [" ".join(words)]
+        else:
+            grams = [" ".join(words[i:i + size]) for i in range(len(words) - size + 1)]
+        hashes = {zlib.crc32(g.encode("utf-8")) for g in grams}
+        prime = cls._PRIME
+        return [min((a * h + b) % prime for h in hashes) & 0xFFFFFFFF
+                for a, b in cls._PERMS]
+
+    @classmethod
+    def similarity(cls, sig_a, sig_b):
+        """Estimate Jaccard similarity from two signatures."""
+        return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / cls.NUM_PERM
+
+    def _band_keys(self, signature):
+        """Yield the LSH bucket key of each band."""
+        rows = self.ROWS
+        for band in range(self.BANDS):
+            chunk = signature[band * rows:(band + 1) * rows]
+            yield (band, zlib.crc32(struct.pack(f"{rows}I", *chunk)))
+
+    def _insert(self, note_id, signature):
+        self.signatures[note_id] = signature
+        for key in self._band_keys(signature):
+            self.buckets.setdefault(key, set()).add(note_id)
+
+    def add(self, note_id, text):
+        """Index a note's content."""
+        self.remove(note_id)
+        signature = self.signature(text)
+        if signature is not None:
+            self._insert(note_id, signature)
+
+    def remove(self, note_id):
+        """Drop a note from the index; returns its signature, if it had one."""
+        signature = self.signatures.pop(note_id, None)
+        if signature is None:
+            return None
+        for key in self._band_keys(signature):
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.discard(note_id)
+                if not bucket:
+                    del self.buckets[key]
+        return signature
+
+    def query(self, text, threshold, exclude=None):
+        """Find notes similar to ``text``; returns [(id, similarity)] best first."""
+        signature = self.signature(text)
+        if signature is None:
+            return []
+        candidates = set()
+        for key in self._band_keys(signature):
+            candidates.update(self.buckets.get(key, ()))
+        candidates.discard(exclude)
+
+        matches = []
+        for note_id in candidates:
+            score = self.similarity(signature, self.signatures[note_id])
+            if score >= threshold:
+                matches.append((note_id, score))
+        matches.sort(key=lambda m: (-m[1], m[0]))
+        return matches
+
+    def clusters(self, threshold):
+        """Group all indexed notes into near-duplicate clusters in one pass."""
+        parent = {}
+
+        def find(x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        checked = set()
+        for bucket in self.buckets.values():
+            if len(bucket) < 2:
+                continue
+            members = sorted(bucket)
+            for i, a in enumerate(members):
+                for b in members[i + 1:]:
+                    if (a, b) in checked:
+                        continue
+                    checked.add((a, b))
+                    if self.similarity(self.signatures[a], self.signatures[b]) >= threshold:
+                        parent.setdefault(a, a)
+                        parent.setdefault(b, b)
+                        root_a, root_b = find(a), find(b)
+                        if root_a != root_b:
+                            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+        groups = {}
+        for note_id in parent:
+            groups.setdefault(find(note_id), set()).add(note_id)
+        return sorted(sorted(group) for group in groups.values() if len(group) > 1)
+
+
+# Fixed seed: signatures are persisted, so the hash family must be stable
+_minhash_rng = random.Random(0x5EED)
+MinHashIndex._PERMS = [
+    (_minhash_rng.randrange(1, MinHashIndex._PRIME), _minhash_rng.randrange(0, MinHashIndex._PRIME))
+    for _ in range(MinHashIndex.NUM_PERM)
+]
+del _minhash_rng
+
+
+class SimilarityIndex:
+    """Hashed TF-IDF vectors for finding related notes.
+
+    Words and tags are hashed into ``DIMENSIONS`` buckets, so vectors stay
+    sparse and the vocabulary never needs to be stored. An inverted index
+    from bucket to note IDs gathers candidates that share the query note's
+    most distinctive terms; only those are scored by cosine similarity
+    (vectorized with NumPy when it is installed).
+    """
+
+    DIMENSIONS = 1 << 20
+    TAG_WEIGHT = 2
+    MAX_QUERY_TERMS = 64
+
+    def __init__(self):
+        """Create an empty index."""
+        self.vectors = {}
+        self.postings = {}
+        self._arrays = {}
+
+    @classmethod
+    def from_notes(cls, notes):
+        """Build an index over a list of notes."""
+        index = cls()
+        for note in notes:
+            index.add(note["id"], note)
+        return index
+
+    @classmethod
+    def from_dict(cls, data):
+        """Restore an index saved with ``to_dict``."""
+        index = cls()
+        for note_id, flat in data["vectors"].items():
+            index._insert(int(note_id), dict(zip(flat[::2], flat[1::2])))
+        return index
+
+    def to_dict(self):
+        """Serialize term counts as flat [bucket, count, ...] lists."""
+        return {"vectors": {str(note_id): [x for item in counts.items() for x in item]
+                            for note_id, counts in self.vectors.items()}}
+
+    @classmethod
+    def term_counts(cls, note):
+        """Hash a note's words and tags into sparse term counts."""
+        counts = {}
+        for word in re.findall(r'\w{2,}', note.get("content", "").lower()):
+            bucket = zlib.crc32(word.encode("utf-8")) % cls.DIMENSIONS
+            counts[bucket] = counts.get(bucket, 0) + 1
+        for tag in note.get("tags", []):
+            bucket = zlib.crc32(f"#{tag}".encode("utf-8")) % cls.DIMENSIONS
+            counts[bucket] = counts.get(bucket, 0) + cls.TAG_WEIGHT
+        return counts
+
+    def _insert(self, note_id, counts):
+        self.vectors[note_id] = counts
+        for bucket in counts:
+            self.postings.setdefault(bucket, set()).add(note_id)
+
+    def add(self, note_id, note):
+        """Index (or re-index) a note."""
+        self.remove(note_id)
+        self._insert(note_id, self.term_counts(note))
+
+    def remove(self, note_id):
+        """Drop a note from the index."""
+        counts = self.vectors.pop(note_id, None)
+        self._arrays.pop(note_id, None)
+        if counts is None:
+            return
+        for bucket in counts:
+            posting = self.postings.get(bucket)
+            if posting is not None:
+                posting.discard(note_id)
+                if not posting:
+                    del self.postings[bucket]
+
+    def _idf(self, bucket, total):
+        return math.log((1 + total) / (1 + len(self.postings.get(bucket, ())))) + 1
+
+    def _weights(self, counts, total):
+        return {b: (1 + math.log(c)) * self._idf(b, total) for b, c in counts.items()}
+
+    def related(self, note_id, k=5):
+        """Return up to ``k`` (note_id, cosine) pairs most similar to ``note_id``."""
+        counts = self.vectors.get(note_id)
+        if not counts:
+            return []
+        total = len(self.vectors)
+        query = self._weights(counts, total)
+        query_norm = math.sqrt(sum(w * w for w in query.values()))
+
+        # Gather candidates from the rarest (most distinctive) terms only
+        terms = sorted(query, key=lambda b: len(self.postings[b]))[:self.MAX_QUERY_TERMS]
+        candidates = set()
+        for bucket in terms:
+            candidates.update(self.postings[bucket])
+        candidates.discard(note_id)
+        if not candidates:
+            return []
+
+        ids = sorted(candidates)
+        if np is not None:
+            scores = self._score_numpy(ids, query, query_norm, total)
+        else:
+            scores = self._score_python(ids, query, query_norm, total)
+
+        ranked = sorted((pair for pair in zip(ids, scores) if pair[1] > 0),
+                        key=lambda pair: (-pair[1], pair[0]))
+        return ranked[:k]
+
+    def _score_python(self, ids, query, query_norm, total):
+        scores = []
+        for note_id in ids:
+            weights = self._weights(self.vectors[note_id], total)
+            dot = sum(w * query.get(b, 0.0) for b, w in weights.items())
+            norm = math.sqrt(sum(w * w for w in weights.values()))
+            scores.append(dot / (norm * query_norm) if norm else 0.0)
+        return scores
+
+    def _array(self, note_id):
+        """Cached (buckets, 1 + log tf) arrays for a note."""
+        arrays = self._arrays.get(note_id)
+        if arrays is None:
+            counts = self.vectors[note_id]
+            buckets = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+            tf = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+            arrays = self._arrays[note_id] = (buckets, 1 + np.log(tf))
+        return arrays
+
+    def _score_numpy(self, ids, query, query_norm, total):
+        arrays = [self._array(note_id) for note_id in ids]
+        buckets = np.concatenate([a[0] for a in arrays])
+        log_tf = np.concatenate([a[1] for a in arrays])
+        rows = np.repeat(np.arange(len(ids)), [len(a[0]) for a in arrays])
+
+        unique, inverse = np.unique(buckets, return_inverse=True)
+        unique_list = unique.tolist()
+        idf = np.array([self._idf(b, total) for b in unique_list])
+        query_weights = np.array([query.get(b, 0.0) for b in unique_list])
+
+        weights = log_tf * idf[inverse]
+        norms = np.sqrt(np.bincount(rows, weights=weights * weights, minlength=len(ids)))
+        dots = np.bincount(rows, weights=weights * query_weights[inverse], minlength=len(ids))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = np.where(norms > 0, dots / (norms * query_norm), 0.0)
+        return scores.tolist()
+
+
+class BlockStore:
+    """Notes stored as independently compressed blocks with a block index.
+
+    Layout: ``MAGIC``, the compressed blocks back to back, a JSON index
+    listing each block's offset, length and note IDs, then a fixed-size
+    footer pointing at the index. Every block is a compact JSON array of up
+    to ``block_size`` notes, so one note can be read by inflating only the
+    block that holds it.
+    """
+
+    MAGIC = b"SNBLOCK1"
+    FOOTER = struct.Struct("<QQ8s")
+    CODECS = ("zlib", "lzma")
+    DEFAULT_LEVEL = 6
+
+    def __init__(self, path, codec="zlib", level=None, block_size=256):
+        """Create a store at ``path`` (codec and level only matter for writing)."""
+        if codec not in self.CODECS:
+            raise ValueError(f"Unsupported compression: {codec}")
+        self.path = Path(path)
+        self.codec = codec
+        self.level = self.DEFAULT_LEVEL if level is None else level
+        self.block_size = max(1, block_size)
+
+    def _compress(self, data):
+        if self.codec == "lzma":
+            return lzma.compress(data, preset=self.level)
+        return zlib.compress(data, self.level)
+
+    @staticmethod
+    def _decompress(codec, data):
+        if codec == "lzma":
+            return lzma.decompress(data)
+        return zlib.decompress(data)
+
+    def write(self, notes, f):
+        """Write ``notes`` to the open binary file ``f``."""
+        f.write(self.MAGIC)
+        blocks = []
+        for start in range(0, len(notes), self.block_size):
+            chunk = notes[start:start + self.block_size]
+            raw = json.dumps(chunk, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            payload = self._compress(raw)
+            blocks.append({"offset": f.tell(), "length": len(payload),
+                           "ids": [n.get("id") for n in chunk]})
+            f.write(payload)
+
+        index = json.dumps({"codec": self.codec, "level": self.level, "count": len(notes),
+                            "blocks": blocks}, separators=(",", ":")).encode("utf-8")
+        index_offset = f.tell()
+        f.write(index)
+        f.write(self.FOOTER.pack(index_offset, len(index), self.MAGIC))
+
+    def _read_index(self, f):
+        f.seek(-self.FOOTER.size, os.SEEK_END)
+        index_offset, index_length, magic = self.FOOTER.unpack(f.read(self.FOOTER.size))
+        if magic != self.MAGIC:
+            raise ValueError(f"{self.path} is not a SmartNotes block store")
+        f.seek(index_offset)
+        return json.loads(f.read(index_length).decode("utf-8"))
+
+    def _read_block(self, f, index, block):
+        f.seek(block["offset"])
+        return json.loads(self._decompress(index["codec"], f.read(block["length"])))
+
+    def read_all(self):
+        """Read every note in store order."""
+        notes = []
+        with open(self.path, "rb") as f:
+            index = self._read_index(f)
+            for block in index["blocks"]:
+                notes.extend(self._read_block(f, index, block))
+        return notes
+
+    def read_note(self, note_id):
+        """Read a single note, inflating only its block. Returns None if absent."""
+        with open(self.path, "rb") as f:
+            index = self._read_index(f)
+            for block in index["blocks"]:
+                if note_id in block["ids"]:
+                    for note in self._read_block(f, index, block):
+                        if note.get("id") == note_id:
+                            return note
+        return None
+
+
+BLOB_FIELDS = ("blob", "length", "preview")
+PREVIEW_CHARS = 80
+
+
+class _BlobNote(dict):
+    """A note whose content lives in a blob file and is read on first access.
+
+    The dict itself holds only the stored fields (``blob``, ``length``,
+    ``preview`` instead of ``content``), so listing and counting never touch
+    the blob. Assigning ``note["content"]`` stores the new text in the dict
+    as usual; the next save moves it back out to a blob.
+    """
+
+    def __init__(self, data, blob_dir):
+        """Wrap stored ``data`` whose blob lives under ``blob_dir``."""
+        super().__init__(data)
+        self._blob_dir = blob_dir
+        self._content = None
+
+    def __missing__(self, key):
+        if key != "content":
+            raise KeyError(key)
+        if self._content is None:
+            with open(_blob_path(self._blob_dir, dict.__getitem__(self, "blob")), "rb") as f:
+                self._content = f.read().decode("utf-8")
+        return self._content
+
+    def get(self, key, default=None):
+        """Like ``dict.get``, loading ``content`` from the blob if needed."""
+        if key == "content" and "content" not in self and "blob" in self:
+            return self["content"]
+        return super().get(key, default)
+
+
+def _blob_path(blob_dir, digest):
+    """Location of a blob (sharded by the first two hex digits)."""
+    return Path(blob_dir) / digest[:2] / digest
+
+
+def _is_blob_stub(note):
+    """True if a note's content is out of line and not loaded into the dict."""
+    return "content" not in note and "blob" in note
+
+
+def _content_length(note):
+    """Length of a note's content, without reading a blob."""
+    if _is_blob_stub(note):
+        return note.get("length", 0)
+    return len(note.get("content", ""))
+
+
+def _content_preview(note, width=PREVIEW_CHARS):
+    """Listing preview (truncated with "..."), without reading a blob."""
+    if _is_blob_stub(note):
+        text = note.get("preview", "")
+    else:
+        text = note.get("content", "")
+    if _content_length(note) > width:
+        return text[:width - 3] + "..."
+    return text
+
+
+def _materialize(note):
+    """Plain-dict copy of a note with its content loaded and no blob fields."""
+    stub = _is_blob_stub(note)
+    payload = {}
+    for key, value in note.items():
+        if key == "blob" and stub:
+            payload["content"] = note["content"]
+        elif key not in BLOB_FIELDS:
+            payload[key] = value
+    return payload
+
+
+def _id_ranges(ids):
+    """Collapse note IDs into sorted ``[first, last]`` runs of consecutive IDs."""
+    ranges = []
+    for i in sorted(ids):
+        if ranges and i == ranges[-1][1] + 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return ranges
+
+
+_JSON_SPACE = re.compile(r"[ \t\r\n]*")
+
+
+def iter_json_array(f, chunk_size=65536, on_error=None):
+    """Yield the elements of a top-level JSON array one at a time.
+
+    Reads ``f`` in chunks, so memory is bounded by the largest single
+    element rather than the whole document.
+
+    Without ``on_error`` a malformed element raises ``ValueError``. With
+    it, ``on_error(offset, message)`` is called instead and parsing
+    resumes at the start of the next element, so one damaged record
+    does not take the rest of the array with it.
+    """
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = "", 0, False
+    read_size = chunk_size
+    consumed = 0          # characters dropped from the front of ``buffer``
+    element_start = None  # pattern that finds the next element when resyncing
+
+    def fill():
+        nonlocal buffer, pos, eof, consumed
+        chunk = f.read(read_size)
+        if not chunk:
+            eof = True
+        consumed += pos
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    def skip_space():
+        nonlocal pos
+        while True:
+            pos = _JSON_SPACE.match(buffer, pos).end()
+            if pos < len(buffer) or eof:
+                return
+            fill()
+
+    def malformed(offset, message):
+        if on_error is None:
+            raise ValueError(f"Malformed JSON array at character {offset}: {message}")
+        on_error(offset, message)
+
+    def incomplete(error):
+        # A decode error caused by the chunk boundary rather than bad data
+        return not eof and (error.msg.startswith("Unterminated string")
+                            or len(buffer) - error.pos < 16)
+
+    def resync(start):
+        # Skip to the next element that begins after ``start``
+        nonlocal pos
+        pos = start
+        while True:
+            match = element_start.search(buffer, pos)
+            if match:
+                pos = match.end() - 1
+                return
+            if eof:
+                pos = len(buffer)
+                return
+            pos = max(pos, len(buffer) - 16)
+            fill()
+
+    skip_space()
+    if pos >= len(buffer) or buffer[pos] != "[":
+        raise ValueError("Expected a JSON array")
+    pos += 1
+
+    after_value = after_comma = False
+    while True:
+        skip_space()
+        if pos >= len(buffer):
+            malformed(consumed + pos, "Unterminated JSON array")
+            return
+        char = buffer[pos]
+        if char == "]":
+            if after_comma:
+                malformed(consumed + pos, "Trailing comma before ']'")
+            return
+        if char == ",":
+            if not after_value:
+                malformed(consumed + pos, "Expecting value before ','")
+            pos += 1
+            after_value, after_comma = False, True
+            continue
+        if after_value:
+            # Keep the element; only the delimiter is missing
+            malformed(consumed + pos, "Expecting ',' delimiter")
+            after_value = False
+        if element_start is None:
+            # Pretty-printed arrays start each element on its own line at a
+            # fixed indent; nested objects are indented deeper.
+            line_start = buffer.rfind("\n", 0, pos)
+            indent = buffer[line_start + 1:pos]
+            if line_start >= 0 and not indent.strip():
+                element_start = re.compile("\n" + re.escape(indent) + r"[\[{]")
+            else:
+                element_start = re.compile(r"[}\]]\s*,\s*[\[{]")
+        try:
+            value, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as e:
+            if incomplete(e):
+                # Element spans the chunk boundary: read more (growing to stay linear)
+                read_size = max(read_size, len(buffer) - pos)
+                fill()
+                continue
+            malformed(consumed + pos, f"{e.msg} (element skipped)")
+            read_size = chunk_size
+            resync(pos + 1)
+            after_comma = False
+            continue
+        if end == len(buffer) and not eof:
+            # A scalar could continue in the next chunk; decode again with more data
+            fill()
+            continue
+        read_size = chunk_size
+        pos = end
+        after_value, after_comma = True, False
+        yield value
+
+
+_TXT_HEADER = re.compile(r'^Note #(\d+)$')
+_MD_HEADER = re.compile(r'^## Note #(\d+)$')
+_EXPORT_FIELD = re.compile(r'^\*{0,2}(\w+):\*{0,2}\s*(.*?)\s*$')
+
+
+def _iter_export_sections(f, header, separator):
+    """Yield (id, field_lines, content_lines) from a txt or md export.
+
+    A header line only starts a new note when it follows a complete
+    separator, so note content may itself contain header-like lines.
+    """
+    current = None
+    trailer = ["", separator, ""]
+    for raw in f:
+        line = raw.rstrip("\n")
+        match = header.match(line)
+        if match and (current is None or current[3][-3:] == trailer):
+            if current is not None:
+                yield current[0], current[2], current[3][:-3]
+            # [id, still reading fields, field lines, content lines]
+            current = [int(match.group(1)), True, [], []]
+            continue
+        if current is None:
+            continue
+        if current[1]:
+            if line:
+                current[2].append(line)
+            elif current[2]:
+                current[1] = False
+        else:
+            current[3].append(line)
+
+    if current is not None:
+        content = current[3]
+        if content[-3:] == trailer:
+            content = content[:-3]
+        elif content[-2:] == trailer[:2]:
+            content = content[:-2]
+        yield current[0], current[2], content
+
+
+def _export_section_to_note(note_id, field_lines, content_lines):
+    """Build a note record from a parsed txt/md export section."""
+    note = {"id": note_id, "content": "\n".join(content_lines)}
+    for line in field_lines:
+        match = _EXPORT_FIELD.match(line)
+        if not match:
+            continue
+        key, value = match.group(1).lower(), match.group(2)
+        if key == "created":
+            note["created"] = value
+        elif key == "tags":
+            if "`" in value:
+                note["tags"] = re.findall(r'`#([^`]+)`', value)
+            else:
+                note["tags"] = [t for t in value.split(", ") if t]
+    return note
+
+
+def iter_text_export(f):
+    """Yield notes from a plain-text export (``export --format txt``)."""
+    for section in _iter_export_sections(f, _TXT_HEADER, "-" * 60):
+        yield _export_section_to_note(*section)
+
+
+def iter_markdown_export(f):
+    """Yield notes from a Markdown export (``export --format md``)."""
+    for section in _iter_export_sections(f, _MD_HEADER, "---"):
+        yield _export_section_to_note(*section)
+
+
+IMPORT_FORMATS = {
+    "txt": iter_text_export,
+    "md": iter_markdown_export,
+    "json": iter_json_array,
+}
+
+
+def _txt_export_header(generated):
+    return f"SmartNotes Export - {generated}\n" + "=" * 60 + "\n\n"
+
+
+def _txt_export_note(note):
+    tags = f"Tags: {', '.join(note['tags'])}\n" if note.get("tags") else ""
+    return (f"Note #{note['id']}\nCreated: {note['created'][:19]}\n{tags}"
+            f"\n{note['content']}\n\n" + "-" * 60 + "\n\n")
+
+
+def _md_export_header(generated):
+    return f"# SmartNotes Export\n\n*Generated: {generated}*\n\n---\n\n"
+
+
+def _md_export_note(note):
+    tags = ""
+    if note.get("tags"):
+        tags = "**Tags:** " + " ".join(f"`#{t}`" for t in note["tags"]) + "  \n"
+    return (f"## Note #{note['id']}\n\n**Created:** {note['created'][:19]}  \n{tags}"
+            f"\n{note['content']}\n\n---\n\n")
+
+
+def _json_export_note(note):
+    # Matches json.dump(notes, indent=2): each element indented one level
+    text = json.dumps(_materialize(note), indent=2, ensure_ascii=False)
+    return "  " + text.replace("\n", "\n  ")
+
+
+def _ndjson_export_note(note):
+    return json.dumps(_materialize(note), ensure_ascii=False) + "\n"
+
+
+# format -> (header(generated), note formatter, separator between notes, footer)
+EXPORT_FORMATS = {
+    "txt": (_txt_export_header, _txt_export_note, "", ""),
+    "md": (_md_export_header, _md_export_note, "", ""),
+    "json": (lambda generated: "[\n", _json_export_note, ",\n", "\n]"),
+    "ndjson": (lambda generated: "", _ndjson_export_note, "", ""),
+}
+
+# Notes per formatting task when an export is split across workers
+EXPORT_CHUNK_NOTES = 2000
+
+
+def parse_id_spec(spec):
+    """Parse an ID list such as ``"5"``, ``"1,4,9"`` or ``"10-20,31"``."""
+    ids = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        low, sep, high = part.partition("-")
+        try:
+            if sep:
+                low, high = int(low), int(high)
+                if high < low:
+                    raise ValueError
+                ids.extend(range(low, high + 1))
+            else:
+                ids.append(int(low))
+        except ValueError:
+            raise ValueError(f"Invalid note ID or range: {part!r}") from None
+    if not ids:
+        raise ValueError(f"No note IDs in {spec!r}")
+    return ids
+
+
+FINE_DIFF_CHARS = 2000
+# Beyond this many changed lines, lines that repeat a lot (heartbeats in a
+# log) are not used as match anchors, which keeps line matching near-linear
+EXACT_DIFF_LINES = 1000
+
+
+def text_delta(new, old):
+    """Delta that rebuilds ``old`` from ``new`` (a reverse delta).
+
+    The delta is a list of ops: ``[start, end]`` copies ``new[start:end]``
+    and a string is inserted as-is, so its size tracks the size of the
+    change. The common leading and trailing lines are copied directly and
+    only the lines between them are matched; changed runs of lines short
+    enough are then matched character by character.
+    """
+    new_lines = new.splitlines(keepends=True)
+    old_lines = old.splitlines(keepends=True)
+    head = 0
+    limit = min(len(new_lines), len(old_lines))
+    while head < limit and new_lines[head] == old_lines[head]:
+        head += 1
+    tail = 0
+    while (tail < limit - head
+           and new_lines[len(new_lines) - 1 - tail] == old_lines[len(old_lines) - 1 - tail]):
+        tail += 1
+    new_offsets = [0]
+    for line in new_lines:
+        new_offsets.append(new_offsets[-1] + len(line))
+
+    ops = []
+
+    def copy(start, end):
+        if start == end:
+            return
+        if ops and isinstance(ops[-1], list) and ops[-1][1] == start:
+            ops[-1][1] = end
+        else:
+            ops.append([start, end])
+
+    def insert(text):
+        if not text:
+            return
+        if ops and isinstance(ops[-1], str):
+            ops[-1] += text
+        else:
+            ops.append(text)
+
+    new_middle = new_lines[head:len(new_lines) - tail]
+    old_middle = old_lines[head:len(old_lines) - tail]
+    exact = max(len(new_middle), len(old_middle)) <= EXACT_DIFF_LINES
+    matcher = difflib.SequenceMatcher(None, new_middle, old_middle, autojunk=not exact)
+    copy(0, new_offsets[head])
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        start, end = new_offsets[head + i1], new_offsets[head + i2]
+        old_text = "".join(old_middle[j1:j2])
+        if tag == "equal":
+            copy(start, end)
+        elif tag == "replace" and max(end - start, len(old_text)) <= FINE_DIFF_CHARS:
+            chars = difflib.SequenceMatcher(None, new[start:end], old_text, autojunk=False)
+            for ctag, c1, c2, d1, d2 in chars.get_opcodes():
+                if ctag == "equal":
+                    copy(start + c1, start + c2)
+                else:
+                    insert(old_text[d1:d2])
+        else:
+            insert(old_text)
+    copy(new_offsets[len(new_lines) - tail], len(new))
+    return ops
+
+
+def apply_text_delta(new, delta):
+    """Rebuild the older text from ``new`` and a delta from ``text_delta``."""
+    return "".join(op if isinstance(op, str) else new[op[0]:op[1]] for op in delta)
+
+
+class MerkleTree:
+    """Digest tree over note UIDs for finding differences between stores.
+
+    Each node covers a UID prefix and its digest is the XOR of the item
+    digests beneath it, answered in O(log n) from a sorted UID list and
+    running XORs. Two trees are compared top-down and only subtrees whose
+    digests differ are expanded, so k differences cost O(k * log n) node
+    comparisons instead of comparing every note.
+    """
+
+    FANOUT = "0123456789abcdef"
+    LEAF_SIZE = 8
+
+    def __init__(self, digests):
+        """Build a tree from ``{uid: int digest}``."""
+        self.digests = digests
+        self.uids = sorted(digests)
+        self._running = [0]
+        acc = 0
+        for uid in self.uids:
+            acc ^= digests[uid]
+            self._running.append(acc)
+
+    @staticmethod
+    def digest(text):
+        """128-bit digest of a string."""
+        return int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:16], "big")
+
+    def _range(self, prefix):
+        lo = bisect.bisect_left(self.uids, prefix)
+        hi = bisect.bisect_left(self.uids, prefix + "\uffff")
+        return lo, hi
+
+    def node(self, prefix):
+        """Return (item count, digest) of the subtree under ``prefix``."""
+        lo, hi = self._range(prefix)
+        return hi - lo, self._running[hi] ^ self._running[lo]
+
+    def items(self, prefix):
+        """Return {uid: digest} of the items under ``prefix``."""
+        lo, hi = self._range(prefix)
+        return {uid: self.digests[uid] for uid in self.uids[lo:hi]}
+
+    def diff(self, other):
+        """Return (sorted differing UIDs, number of nodes compared)."""
+        differing, compared = [], 0
+        stack = [""]
+        while stack:
+            prefix = stack.pop()
+            compared += 1
+            mine, theirs = self.node(prefix), other.node(prefix)
+            if mine == theirs:
+                continue
+            if mine[0] + theirs[0] <= 2 * self.LEAF_SIZE or len(prefix) >= 32:
+                a, b = self.items(prefix), other.items(prefix)
+                differing.extend(uid for uid in a.keys() | b.keys() if a.get(uid) != b.get(uid))
+            else:
+                stack.extend(prefix + c for c in self.FANOUT)
+        return sorted(differing), compared
+
+
+class QueryError(ValueError):
+    """Raised for malformed query expressions."""
+
+
+_DATE_VALUE = re.compile(r'^\d{4}(-\d{2}(-\d{2}([T ][\d:.]+)?)?)?$')
+_COMPARATORS = {
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    "=": lambda a, b: a == b,
+}
+
+
+def _tokenize_query(text):
+    """Split a query expression into tokens."""
+    tokens = []
+    i, length = 0, len(text)
+    while i < length:
+        char = text[i]
+        if char.isspace():
+            i += 1
+        elif char in "()":
+            tokens.append((char, None))
+            i += 1
+        elif char == "-" and i + 1 < length and not text[i + 1].isspace():
+            tokens.append(("NOT", None))
+            i += 1
+        elif char == '"':
+            end = text.find('"', i + 1)
+            if end == -1:
+                raise QueryError("Unterminated quote in query")
+            tokens.append(("phrase", text[i + 1:end]))
+            i = end + 1
+        else:
+            start = i
+            while i < length and not text[i].isspace() and text[i] not in "()":
+                i += 1
+            word = text[start:i]
+            if word in ("AND", "OR", "NOT"):
+                tokens.append((word, None))
+            else:
+                tokens.append(("term", word))
+    return tokens
+
+
+def _parse_term(word):
+    """Turn a single query word into a leaf node."""
+    field, sep, value = word.partition(":")
+    field = field.lower()
+    if sep and field == "tag":
+        if not value:
+            raise QueryError("Empty tag in query")
+        return ("tag", value.lower().lstrip("#"))
+    if sep and field in ("created", "modified"):
+        op = "="
+        for candidate in (">=", "<=", ">", "<", "="):
+            if value.startswith(candidate):
+                op, value = candidate, value[len(candidate):]
+                break
+        if not _DATE_VALUE.match(value):
+            raise QueryError(f"Invalid date in query: {word}")
+        return ("date", field, op, value)
+    if word.startswith("#") and len(word) > 1:
+        return ("tag", word[1:].lower())
+    return ("text", word.lower())
+
+
+def parse_query(text):
+    """Parse a query expression into a syntax tree.
+
+    Supports ``tag:NAME`` (or ``#NAME``), ``created:``/``modified:`` with
+    ``> >= < <= =`` and an ISO date prefix, bare words and "quoted phrases"
+    (case-insensitive content match), ``AND``/``OR``/``NOT``, ``-`` for
+    negation, parentheses, and implicit AND between adjacent terms.
+    """
+    tokens = _tokenize_query(text)
+    position = 0
+
+    def peek():
+        return tokens[position][0] if position < len(tokens) else None
+
+    def take():
+        nonlocal position
+        position += 1
+        return tokens[position - 1]
+
+    def parse_or():
+        children = [parse_and()]
+        while peek() == "OR":
+            take()
+            children.append(parse_and())
+        return children[0] if len(children) == 1 else ("or", children)
+
+    def parse_and():
+        children = [parse_unary()]
+        while peek() not in (None, "OR", ")"):
+            if peek() == "AND":
+                take()
+            children.append(parse_unary())
+        return children[0] if len(children) == 1 else ("and", children)
+
+    def parse_unary():
+        kind = peek()
+        if kind is None:
+            raise QueryError("Unexpected end of query")
+        if kind == "NOT":
+            take()
+            return ("not", parse_unary())
+        if kind == "(":
+            take()
+            node = parse_or()
+            if peek() != ")":
+                raise QueryError("Missing closing parenthesis")
+            take()
+            return node
+        if kind == "phrase":
+            return ("text", take()[1].lower())
+        if kind == "term":
+            return _parse_term(take()[1])
+        raise QueryError(f"Unexpected '{kind}' in query")
+
+    if not tokens:
+        raise QueryError("Empty query")
+    tree = parse_or()
+    if position != len(tokens):
+        raise QueryError(f"Unexpected '{tokens[position][0]}' in query")
+    return tree
+
+
+def _describe(node):
+    """Render a syntax tree node back to query text."""
+    kind = node[0]
+    if kind == "tag":
+        return f"tag:{node[1]}"
+    if kind == "text":
+        return f'"{node[1]}"' if " " in node[1] else node[1]
+    if kind == "date":
+        return f"{node[1]}:{'' if node[2] == '=' else node[2]}{node[3]}"
+    if kind == "not":
+        return f"-{_describe(node[1])}"
+    joiner = " AND " if kind == "and" else " OR "
+    return "(" + joiner.join(_describe(child) for child in node[1]) + ")"
+
+
+class QueryPlan:
+    """One step of an executable query plan."""
+
+    def __init__(self, node, kind, estimate, cost, children=()):
+        """Create a plan step for ``node``."""
+        self.node = node
+        self.kind = kind
+        self.estimate = estimate
+        self.cost = cost
+        self.children = list(children)
+        self.actual = None
+
+    @property
+    def indexed(self):
+        """True when the step's matches come straight from posting lists."""
+        return self.kind in ("index", "union")
+
+    def to_dict(self):
+        """Serialize the plan (for --explain in JSON mode)."""
+        record = {"step": self.kind, "expr": _describe(self.node),
+                  "estimate": round(self.estimate, 1)}
+        if self.actual is not None:
+            record["actual"] = self.actual
+        if self.children:
+            record["children"] = [child.to_dict() for child in self.children]
+        return record
+
+    def lines(self, depth=0):
+        """Render the plan as indented text lines."""
+        actual = f", actual {self.actual}" if self.actual is not None else ""
+        label = self.kind.upper() if self.children else f"{self.kind:<7} {_describe(self.node)}"
+        yield f"{'  ' * depth}{label}  (est. {self.estimate:.0f}{actual})"
+        for child in self.children:
+            yield from child.lines(depth + 1)
+
+
+class QueryPlanner:
+    """Cost-based planner and executor for parsed queries.
+
+    Tag terms are answered from posting lists; inside an AND they are
+    intersected smallest first, and the remaining predicates (dates, content
+    matches, negations) only run on the survivors, cheapest and most
+    selective first. Cardinalities come from the running statistics.
+    """
+
+    TEXT_SELECTIVITY = 0.1
+    PREDICATE_COST = {"date": 1.0, "text": 4.0}
+
+    def __init__(self, notes_by_id, tag_index, stats):
+        """Plan against the store's lookups and statistics."""
+        self.notes_by_id = notes_by_id
+        self.tag_index = tag_index
+        self.stats = stats
+        self.total = len(notes_by_id)
+
+    def _date_estimate(self, field, op, value):
+        if field != "created":
+            return self.total * 0.5
+        compare = _COMPARATORS[op]
+        width = len(value)
+        if width > 10:
+            return self.total * 0.5
+        return sum(count for day, count in self.stats.days.items()
+                   if compare(day[:width], value))
+
+    def plan(self, node):
+        """Build the plan for a syntax tree."""
+        kind = node[0]
+        total = max(self.total, 1)
+        if kind == "tag":
+            return QueryPlan(node, "index", len(self.tag_index.get(node[1], ())), 0.0)
+        if kind == "text":
+            return QueryPlan(node, "filter", total * self.TEXT_SELECTIVITY,
+                             self.PREDICATE_COST["text"])
+        if kind == "date":
+            return QueryPlan(node, "filter", self._date_estimate(*node[1:]),
+                             self.PREDICATE_COST["date"])
+        if kind == "not":
+            child = self.plan(node[1])
+            return QueryPlan(node, "exclude", total - child.estimate, child.cost, [child])
+
+        children = [self.plan(child) for child in node[1]]
+        if kind == "or":
+            estimate = min(total, sum(c.estimate for c in children))
+            if all(c.indexed for c in children):
+                return QueryPlan(node, "union", estimate, 0.0, children)
+            return QueryPlan(node, "or", estimate, sum(c.cost for c in children), children)
+
+        # AND: index lookups smallest first, then predicates by rank
+        indexed = sorted((c for c in children if c.indexed), key=lambda c: c.estimate)
+        filters = sorted((c for c in children if not c.indexed),
+                         key=lambda c: c.cost / max(1e-9, 1 - min(c.estimate / total, 0.999)))
+        estimate = float(total)
+        for child in children:
+            estimate *= min(child.estimate / total, 1.0)
+        return QueryPlan(node, "and", estimate, sum(c.cost for c in filters), indexed + filters)
+
+    def execute(self, plan, within=None):
+        """Run a plan, returning the set of matching note IDs.
+
+        ``within`` restricts evaluation to a candidate set (None = all notes).
+        """
+        kind = plan.kind
+        if kind == "index":
+            result = set(self.tag_index.get(plan.node[1], ()))
+            if within is not None:
+                result &= within
+        elif kind == "union" or kind == "or":
+            result = set()
+            for child in plan.children:
+                result |= self.execute(child, within)
+        elif kind == "filter":
+            candidates = self.notes_by_id.keys() if within is None else within
+            matches = self._predicate(plan.node)
+            result = {i for i in candidates if matches(self.notes_by_id[i])}
+        elif kind == "exclude":
+            candidates = set(self.notes_by_id) if within is None else within
+            result = candidates - self.execute(plan.children[0], candidates)
+        else:
+            result = within
+            for child in plan.children:
+                if result is not None and not result:
+                    break
+                result = self.execute(child, result)
+            if result is None:
+                result = set(self.notes_by_id)
+        plan.actual = len(result)
+        return result
+
+    @staticmethod
+    def _predicate(node):
+        if node[0] == "text":
+            needle = node[1]
+            return lambda note: needle in note.get("content", "").lower()
+        _, field, op, value = node
+        compare = _COMPARATORS[op]
+        width = len(value)
+        return lambda note: compare(note.get(field, "")[:width], value)
+
+
+class QueryCache:
+    """LRU cache of query results (note IDs), valid for one store generation.
+
+    Entries are keyed by a normalized query string. The cache belongs to a
+    single generation of the store; looking it up with any other generation
+    empties it first, so a mutation invalidates every entry at once.
+    Hit and miss counters survive invalidation and are persisted with it.
+    """
+
+    def __init__(self, capacity=128, max_ids=10000):
+        """Create an empty cache holding up to ``capacity`` results."""
+        self.capacity = capacity
+        self.max_ids = max_ids
+        self.generation = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self._mutex = threading.Lock()
+
+    @classmethod
+    def from_dict(cls, data, capacity=128, valid=True):
+        """Restore a cache; with ``valid=False`` only the counters are kept."""
+        cache = cls(capacity)
+        cache.hits = int(data.get("hits", 0))
+        cache.misses = int(data.get("misses", 0))
+        if valid:
+            for key, ids in data.get("entries", [])[-capacity:]:
+                cache.entries[key] = ids
+        return cache
+
+    def to_dict(self):
+        """Serialize entries (least recently used first) and counters."""
+        return {"entries": [[k, v] for k, v in self.entries.items()],
+                "hits": self.hits, "misses": self.misses}
+
+    @property
+    def hit_rate(self):
+        """Fraction of lookups answered from the cache."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _check(self, generation):
+        if generation != self.generation:
+            self.entries.clear()
+            self.generation = generation
+
+    def get(self, key, generation):
+        """Cached IDs for ``key`` at ``generation``, or None (counted as a miss)."""
+        with self._mutex:
+            self._check(generation)
+            ids = self.entries.get(key)
+            if ids is None:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            self.dirty = True
+            return ids
+
+    def put(self, key, ids, generation):
+        """Store the IDs for ``key``; oversized results are not kept."""
+        if self.capacity <= 0 or len(ids) > self.max_ids:
+            return
+        with self._mutex:
+            self._check(generation)
+            self.entries[key] = ids
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Drop every entry and reset the counters."""
+        with self._mutex:
+            self.entries.clear()
+            self.hits = self.misses = 0
+            self.dirty = True
+
+
+class RWLock:
+    """Reentrant reader-writer lock.
+
+    Any number of threads may hold the read lock at once; the write lock is
+    exclusive. Waiting writers block new readers so writes are not starved.
+    A thread may nest reads, nest writes, and read while writing, but cannot
+    upgrade a read lock to a write lock (that would deadlock two readers).
+    """
+
+    def __init__(self):
+        """Create an unlocked lock."""
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = {}
+        self._writer = None
+        self._writer_depth = 0
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        """Block until the calling thread may read."""
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me and me not in self._readers:
+                while self._writer is not None or self._waiting_writers:
+                    self._cond.wait()
+            self._readers[me] = self._readers.get(me, 0) + 1
+
+    def release_read(self):
+        """Release one level of the calling thread's read lock."""
+        me = threading.get_ident()
+        with self._cond:
+            depth = self._readers[me] - 1
+            if depth:
+                self._readers[me] = depth
+            else:
+                del self._readers[me]
+                if not self._readers:
+                    self._cond.notify_all()
+
+    def acquire_write(self):
+        """Block until the calling thread holds the lock exclusively."""
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writer_depth += 1
+                return
+            if me in self._readers:
+                raise RuntimeError("Cannot upgrade a read lock to a write lock")
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+            self._writer_depth = 1
+
+    def release_write(self):
+        """Release one level of the calling thread's write lock."""
+        with self._cond:
+            self._writer_depth -= 1
+            if not self._writer_depth:
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def read(self):
+        """Hold the read lock for a ``with`` block."""
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextlib.contextmanager
+    def write(self):
+        """Hold the write lock for a ``with`` block."""
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class _NullLock:
+    """Stand-in for ``RWLock`` when thread safety is off."""
+
+    @contextlib.contextmanager
+    def read(self):
+        yield
+
+    write = read
+
+
+def _reads(method):
+    """Run a SmartNotes method under the store's read lock."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.read():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _writes(method):
+    """Run a SmartNotes method under the store's write lock."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.write():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class DurabilityPolicy:
+    """When committed files are forced to stable storage (fsync).
+
+    Every commit replaces its file atomically (write to a temp file, then
+    rename), so a crashed process always leaves either the old or the new
+    version. The mode decides what survives a power loss or OS crash:
+
+    - ``strict``: the file and its directory are fsynced on every commit;
+      a commit that returned is never lost.
+    - ``batched``: fsync once ``batch_ops`` commits or ``batch_ms``
+      milliseconds have accumulated since the last fsync, and on ``flush``;
+      at most that window of commits can be lost.
+    - ``relaxed``: never fsync, not even on ``flush``; the OS writes
+      buffers back on its own schedule (typically within ~30 seconds), and
+      those commits can be lost.
+    """
+
+    MODES = ("strict", "batched", "relaxed")
+
+    def __init__(self, mode="batched", batch_ms=1000, batch_ops=32):
+        """Create a policy."""
+        if mode not in self.MODES:
+            raise ValueError(f"Unsupported durability mode: {mode}")
+        self.mode = mode
+        self.batch_ms = batch_ms
+        self.batch_ops = batch_ops
+        self.pending = set()
+        self._unsynced_ops = 0
+        self._last_sync = time.monotonic()
+
+    def should_sync(self):
+        """Decide whether the commit being written must be fsynced."""
+        if self.mode == "strict":
+            return True
+        if self.mode == "relaxed":
+            return False
+        self._unsynced_ops += 1
+        elapsed_ms = (time.monotonic() - self._last_sync) * 1000
+        return self._unsynced_ops >= self.batch_ops or elapsed_ms >= self.batch_ms
+
+    def write(self, path, write, binary=False):
+        """Atomically replace ``path`` with the output of ``write(f)``."""
+        path = Path(path)
+        sync = self.should_sync()
+        f, tmp = _open_temp(path, binary)
+        try:
+            with f:
+                write(f)
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            _remove_quietly(tmp)
+            raise
+
+        if sync:
+            _fsync_directory(path.parent)
+            # A full rewrite makes earlier unsynced versions of this file moot
+            self.pending.discard(path)
+            if self.mode == "batched":
+                self.flush()
+        elif self.mode == "batched":
+            self.pending.add(path)
+
+    def append(self, path, data):
+        """Append ``data`` (bytes) to ``path``; only strict mode fsyncs right away."""
+        path = Path(path)
+        created = not path.exists()
+        with open(path, "ab") as f:
+            f.write(data)
+            self.appended(f, path, created)
+
+    def appended(self, f, path, created=False):
+        """Apply the policy to data just appended to the open file ``f``."""
+        if self.mode == "strict":
+            f.flush()
+            os.fsync(f.fileno())
+            if created:
+                _fsync_directory(path.parent)
+        elif self.mode == "batched":
+            self.pending.add(path)
+
+    def flush(self):
+        """Force every file committed without fsync to stable storage."""
+        for path in list(self.pending):
+            try:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError:
+                pass
+        for directory in {p.parent for p in self.pending}:
+            _fsync_directory(directory)
+        self.pending.clear()
+        self._unsynced_ops = 0
+        self._last_sync = time.monotonic()
+
+
+def _fsync_directory(directory):
+    """Persist a rename by fsyncing its directory (not possible on Windows)."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+# mkstemp creates owner-only files; committed files get the usual permissions
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def _open_temp(path, binary=False):
+    """Open a uniquely named temp file next to ``path`` for an atomic replace.
+
+    Returns ``(file, temp_path)``. Unique names keep concurrent savers from
+    truncating each other's temp file before it is renamed.
+    """
+    path = Path(path)
+    fd, tmp = tempfile.mkstemp(prefix=path.name + ".", suffix=".tmp", dir=path.parent)
+    try:
+        os.chmod(tmp, 0o666 & ~_UMASK)
+        f = os.fdopen(fd, "wb") if binary else os.fdopen(fd, "w", encoding="utf-8")
+    except BaseException:
+        os.close(fd)
+        _remove_quietly(tmp)
+        raise
+    return f, Path(tmp)
+
+
+def _remove_quietly(path):
+    """Delete ``path`` if it exists, ignoring errors."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class ChangeFeed:
+    """Append-only log of store mutations, one JSON event per line.
+
+    Events carry increasing ``seq`` numbers. A reader resumes after a given
+    sequence number by binary-searching the file for its byte offset, then
+    tails it: each poll costs one ``stat`` plus a read of the appended bytes.
+    """
+
+    TAIL_CHUNK = 4096
+
+    def __init__(self, path):
+        """Create a feed backed by ``path``."""
+        self.path = Path(path)
+        # Newest seq and the log size when it was read or written by us
+        self._last_seq = None
+        self._size = None
+
+    @staticmethod
+    def _parse(line):
+        """Decode one log line; returns None for a torn or corrupt line."""
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return None
+        if not isinstance(event, dict) or not isinstance(event.get("seq"), int):
+            return None
+        return event
+
+    def _read_last_seq(self, f):
+        """Scan back from the end of ``f`` for the newest event's sequence number."""
+        end = f.seek(0, os.SEEK_END)
+        pos, tail = end, b""
+        while pos > 0:
+            step = min(self.TAIL_CHUNK, pos)
+            pos -= step
+            f.seek(pos)
+            tail = f.read(step) + tail
+            lines = tail.split(b"\n")
+            # The first piece may be a partial line unless we reached the start
+            candidates = lines if pos == 0 else lines[1:]
+            for line in reversed(candidates):
+                event = self._parse(line) if line.strip() else None
+                if event is not None:
+                    return event["seq"]
+        return 0
+
+    def last_seq(self):
+        """Sequence number of the newest event (0 if the log is empty)."""
+        try:
+            with open(self.path, "rb") as f:
+                size = f.seek(0, os.SEEK_END)
+                if self._last_seq is None or size != self._size:
+                    self._last_seq = self._read_last_seq(f)
+                    self._size = size
+        except OSError:
+            self._last_seq, self._size = 0, 0
+        return self._last_seq
+
+    def append(self, events, durability):
+        """Number ``events`` and append them to the log; returns the numbered events.
+
+        The numbering and the write happen under an exclusive lock on the
+        log, so processes sharing a store never reuse a sequence number.
+        """
+        if not events:
+            return events
+        created = not self.path.exists()
+        with open(self.path, "ab+") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                size = f.seek(0, os.SEEK_END)
+                if self._last_seq is None or size != self._size:
+                    # Another process appended since our last write
+                    self._last_seq = self._read_last_seq(f)
+                seq = self._last_seq
+                numbered = []
+                for event in events:
+                    seq += 1
+                    numbered.append({"seq": seq, **event})
+                data = "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in numbered)
+                # Start on a fresh line if a previous writer was cut off mid-line
+                if size:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        data = "\n" + data
+                f.write(data.encode("utf-8"))
+                f.flush()
+                self._size = f.tell()
+                self._last_seq = seq
+                durability.appended(f, self.path, created)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        return numbered
+
+    def _line_at(self, f, pos):
+        """First complete event starting at or after byte ``pos``: (start, event)."""
+        f.seek(max(pos - 1, 0))
+        if pos > 0:
+            if f.read(1) != b"\n":
+                f.readline()
+        while True:
+            start = f.tell()
+            line = f.readline()
+            if not line:
+                return start, None
+            if not line.endswith(b"\n"):
+                # Still being written
+                return start, None
+            event = self._parse(line)
+            if event is not None:
+                return start, event
+
+    def offset_after(self, f, since):
+        """Byte offset of the first event with ``seq > since`` (binary search)."""
+        lo, hi = 0, f.seek(0, os.SEEK_END)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start, event = self._line_at(f, mid)
+            if event is None or event["seq"] > since:
+                hi = mid
+            else:
+                lo = start + 1
+        return self._line_at(f, lo)[0]
+
+    def events(self, since=0, follow=False, interval=1.0):
+        """Yield events with ``seq > since``; with ``follow``, wait for new ones."""
+        offset = None
+        pending = b""
+        while True:
+            try:
+                size = os.stat(self.path).st_size
+            except OSError:
+                size = 0
+            if offset is not None and size < offset:
+                # Log was truncated or replaced: rescan, skipping seen events
+                offset, pending = None, b""
+            if size and offset != size:
+                with open(self.path, "rb") as f:
+                    if offset is None:
+                        offset = self.offset_after(f, since)
+                    f.seek(offset)
+                    data = f.read(size - offset)
+                offset += len(data)
+                lines = (pending + data).split(b"\n")
+                pending = lines.pop()
+                for line in lines:
+                    event = self._parse(line) if line.strip() else None
+                    if event is not None and event["seq"] > since:
+                        since = event["seq"]
+                        yield event
+            if not follow:
+                return
+            time.sleep(interval)
+
+
 class SmartNotes:
     """Main SmartNotes application class."""
 
-    def __init__(self):
-        """Initialize SmartNotes with config directory."""
-        self.notes_dir = Path.home() / ".smartnotes"
-        self.notes_dir.mkdir(exist_ok=True)
-        self.notes_file = self.notes_dir / "notes.json"
+    # Set by reading the store; deferred with ``lazy=True`` (see __getattr__)
+    _STORE_ATTRS = frozenset({"notes", "_by_id", "_tag_index", "_tag_names"})
+
+    def __init__(self, writer=None, notes_dir=None, thread_safe=False, lazy=False):
+        """Initialize SmartNotes with config directory.
+
+        Pass a ``RecordWriter`` as ``writer`` to emit structured records
+        instead of human-readable output, and ``notes_dir`` to use a store
+        other than ``~/.smartnotes``. With ``thread_safe=True`` the instance
+        may be shared between threads: reads run in parallel under a
+        reader-writer lock and writes are serialized. With ``lazy=True``
+        the notes are only read when first needed, so statistics are served
+        from stats.json alone when it matches the store.
+        """
+        self.writer = writer
+        self._lock = RWLock() if thread_safe else _NullLock()
+        self._batch_depth = 0
+        self._save_pending = False
+        self.notes_dir = Path(notes_dir) if notes_dir else Path.home() / ".smartnotes"
+        self.notes_dir.mkdir(parents=True, exist_ok=True)
         self.config_file = self.notes_dir / "config.json"
-        self.load_notes()
         self.load_config()
+        if self.config["durability"] not in DurabilityPolicy.MODES:
+            self._report(f"Warning: Unknown durability mode {self.config['durability']!r}, using 'batched'",
+                         type="warning", message=f"Unknown durability mode: {self.config['durability']}")
+            self.config["durability"] = "batched"
+        self.durability = DurabilityPolicy(self.config["durability"],
+                                           batch_ms=self.config["durability_batch_ms"],
+                                           batch_ops=self.config["durability_batch_ops"])
+        self.compressed = self.config["storage"] == "compressed"
+        self.json_file = self.notes_dir / "notes.json"
+        self.blocks_file = self.notes_dir / "notes.blk"
+        self.notes_file = self.blocks_file if self.compressed else self.json_file
+        self.stats_file = self.notes_dir / "stats.json"
+        self.minhash_file = self.notes_dir / "minhash.json"
+        self.vectors_file = self.notes_dir / "vectors.json"
+        self.tombstones_file = self.notes_dir / "tombstones.json"
+        self.blobs_dir = self.notes_dir / "blobs"
+        self._blob_refs = set()
+        self._orphan_blobs = set()
+        self.changes = ChangeFeed(self.notes_dir / "changes.log")
+        self._pending_changes = []
+        self._minhash = None
+        self._similarity = None
+        # Similarity indexes changed since their sidecars were written
+        self._derived_dirty = set()
+        # note ID -> (content, MinHash signature) while the note is being updated
+        self._parked_signatures = {}
+        self._tombstones = None
+        self._tombstones_dirty = False
+        self.cache_file = self.notes_dir / "cache.json"
+        self._query_cache = None
+        # Bumped by every mutation; cached query results are tied to it
+        self._generation = 0
+        self._saved_generation = 0
+        if not (lazy and self._load_stats_only()):
+            self.load_notes()
+            self._build_lookups()
+            self.load_stats()
+
+    def __getattr__(self, name):
+        """Read a deferred store the first time its notes are needed."""
+        if name not in self._STORE_ATTRS:
+            raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+        stats_signature = self._loaded_signature
+        self.load_notes()
+        self._build_lookups()
+        if self._loaded_signature is None or self._loaded_signature != stats_signature:
+            # The store changed after stats.json was read
+            self.load_stats()
+        return object.__getattribute__(self, name)
+
+    def _block_store(self):
+        """Block store configured from ``config.json``."""
+        return BlockStore(self.blocks_file, codec=self.config["compression"],
+                          level=self.config["compression_level"],
+                          block_size=self.config["block_size"])
 
     def load_notes(self):
-        """Load notes from JSON file."""
-        if self.notes_file.exists():
-            try:
-                with open(self.notes_file, "r", encoding="utf-8") as f:
-                    self.notes = json.load(f)
-            except Exception as e:
-                print(f"Warning: Could not load notes: {e}")
-                self.notes = []
-        else:
+        """Load notes from the configured store.
+
+        If only the other storage format exists (e.g. right after switching
+        ``storage`` in config.json), notes are read from it; the next save
+        writes the configured format.
+        """
+        source = self.notes_file
+        if not source.exists():
+            other = self.json_file if self.compressed else self.blocks_file
+            source = other if other.exists() else None
+
+        # Sidecars are only valid for the exact file read here; if it changed
+        # while being read, or came from the other format, trust none of them
+        self._loaded_signature = None
+        if source is None:
             self.notes = []
+            return
 
+        before = self._store_signature() if source == self.notes_file else None
+        problems = []
+        try:
+            if source == self.blocks_file:
+                self.notes = BlockStore(source).read_all()
+            else:
+                self.notes = self._stream_notes(source, problems)
+        except Exception as e:
+            self.notes = []
+            backup = self._backup_unreadable(source)
+            self._report(f"Warning: Could not load notes: {e} (original kept as {backup.name})",
+                         type="warning", message=f"Could not load notes: {e}",
+                         backup=str(backup))
+        else:
+            if problems:
+                backup = self._backup_unreadable(source)
+                for offset, reason in problems:
+                    where = "" if offset is None else f" at character {offset}"
+                    self._report(f"Warning: {source.name}{where}: {reason}",
+                                 type="warning", message=reason, offset=offset)
+                self._report(f"Warning: Loaded {len(self.notes)} notes with {len(problems)} "
+                             f"problem(s); original kept as {backup.name}",
+                             type="warning", message="Store loaded with problems",
+                             loaded=len(self.notes), problems=len(problems), backup=str(backup))
+
+        if before is not None and before == self._store_signature():
+            self._loaded_signature = before
+
+        for i, note in enumerate(self.notes):
+            if "blob" in note:
+                self.notes[i] = _BlobNote(note, self.blobs_dir)
+                self._blob_refs.add(note["blob"])
+
+    @staticmethod
+    def _stream_notes(path, problems):
+        """Read a notes.json array record by record.
+
+        Records that fail to parse or are not notes are skipped, and stray
+        delimiters are tolerated; each is appended to ``problems`` as
+        ``(offset, reason)`` instead of aborting the load. Invalid UTF-8 is
+        recorded the same way and the file re-read with the bad bytes
+        replaced.
+        """
+        def on_error(offset, reason):
+            problems.append((offset, reason))
+
+        def read(errors):
+            notes = []
+            with open(path, "r", encoding="utf-8", errors=errors) as f:
+                for record in iter_json_array(f, on_error=on_error):
+                    if (isinstance(record, dict) and isinstance(record.get("id"), int)
+                            and isinstance(record.get("content", record.get("blob")), str)):
+                        notes.append(record)
+                    else:
+                        on_error(None, f"Skipped a record that is not a note: {str(record)[:40]}")
+            return notes
+
+        try:
+            return read("strict")
+        except UnicodeDecodeError:
+            problems.clear()
+            on_error(None, "Invalid UTF-8; undecodable bytes were replaced with U+FFFD")
+            return read("replace")
+
+    def _backup_unreadable(self, source):
+        """Copy a store that did not load cleanly aside before it is overwritten."""
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        backup = source.with_name(f"{source.name}.corrupt-{stamp}")
+        if not backup.exists():
+            with open(source, "rb") as src, open(backup, "wb") as dst:
+                for chunk in iter(functools.partial(src.read, 1 << 20), b""):
+                    dst.write(chunk)
+        return backup
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Group writes into one save, holding the write lock throughout.
+
+        Inside the block every method that would save only marks the store
+        dirty; it is written once when the outermost ``batch`` exits. If the
+        block raises, the notes are rolled back to their state on entry and
+        nothing is saved.
+        """
+        with self._lock.write():
+            checkpoint = None if self._batch_depth else self._checkpoint(self.notes)
+            self._batch_depth += 1
+            try:
+                yield self
+            except BaseException:
+                if checkpoint is not None:
+                    self._rollback(checkpoint)
+                    self._save_pending = False
+                raise
+            finally:
+                self._batch_depth -= 1
+                if not self._batch_depth and self._save_pending:
+                    self._save_pending = False
+                    self.save_notes()
+
+    @_writes
     def save_notes(self):
-        """Save notes to JSON file."""
+        """Save notes to the configured store (deferred inside ``batch``)."""
+        if self._batch_depth:
+            self._save_pending = True
+            return True
         try:
-            with open(self.notes_file, "w", encoding="utf-8") as f:
-                json.dump(self.notes, f, indent=2, ensure_ascii=False)
+            stored = self._stored_notes()
+            if self.compressed:
+                store = self._block_store()
+                self.durability.write(self.notes_file, lambda f: store.write(stored, f),
+                                      binary=True)
+            else:
+                self.durability.write(self.notes_file, lambda f: json.dump(
+                    stored, f, indent=2, ensure_ascii=False))
         except Exception as e:
-            print(f"[X] Error saving notes: {e}")
+            self._fail("save", f"Error saving notes: {e}")
             return False
+        self._adopt_stored(stored)
+        self._loaded_signature = self._store_signature()
+        self._saved_generation = self._generation
+
+        # Keep the superseded format around as a backup after switching
+        other = self.json_file if self.compressed else self.blocks_file
+        if other.exists():
+            try:
+                os.replace(other, other.with_name(other.name + ".bak"))
+            except OSError:
+                pass
+
+        if self._tombstones_dirty:
+            try:
+                self.durability.write(self.tombstones_file, lambda f: json.dump(
+                    self._tombstones, f, ensure_ascii=False))
+                self._tombstones_dirty = False
+            except Exception as e:
+                self._fail("save", f"Error saving tombstones: {e}")
+                return False
+
+        if self._pending_changes:
+            try:
+                self.changes.append(self._pending_changes, self.durability)
+            except OSError as e:
+                self._report(f"Warning: Could not append to change feed: {e}",
+                             type="warning", message=f"Could not append to change feed: {e}")
+            self._pending_changes = []
+
+        self.save_stats()
+        self._parked_signatures.clear()
         return True
 
+    @_writes
+    def close(self):
+        """Fsync batched commits not yet synced (relaxed mode never fsyncs)."""
+        self.durability.flush()
+        self._remove_orphan_blobs()
+        self.save_query_cache()
+        self.save_derived()
+
+    @property
+    def query_cache(self):
+        """Query result cache, loaded from cache.json on first use."""
+        if self._query_cache is None:
+            capacity = self.config["query_cache_size"]
+            data = None
+            if self.cache_file.exists():
+                try:
+                    with open(self.cache_file, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                except Exception:
+                    data = None
+            if isinstance(data, dict):
+                # Entries only apply to the store version they were computed on
+                valid = data.get("signature") == self._loaded_signature
+                try:
+                    self._query_cache = QueryCache.from_dict(data, capacity, valid=valid)
+                except (TypeError, ValueError):
+                    pass
+            if self._query_cache is None:
+                self._query_cache = QueryCache(capacity)
+            self._query_cache.generation = self._generation
+        return self._query_cache
+
+    def save_query_cache(self):
+        """Persist the query cache if it changed and matches the saved store."""
+        cache = self._query_cache
+        if cache is None or not cache.dirty:
+            return
+        if cache.generation != self._saved_generation or self._generation != self._saved_generation:
+            # Results computed from unsaved changes must not outlive them
+            cache.entries.clear()
+        data = cache.to_dict()
+        data["signature"] = self._loaded_signature
+        tmp = None
+        try:
+            f, tmp = _open_temp(self.cache_file)
+            with f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp, self.cache_file)
+            cache.dirty = False
+        except Exception:
+            if tmp is not None:
+                _remove_quietly(tmp)
+            # The cache only saves work; losing it is harmless
+            pass
+
+    def _cached_ids(self, key, compute):
+        """IDs for a normalized query ``key``, from the cache or ``compute()``."""
+        if self.config["query_cache_size"] <= 0:
+            return compute()
+        ids = self.query_cache.get(key, self._generation)
+        if ids is None:
+            ids = compute()
+            self.query_cache.put(key, ids, self._generation)
+        return ids
+
+    @_writes
+    def show_cache(self, clear=False):
+        """Report (or reset) the query cache and its hit rate."""
+        cache = self.query_cache
+        if clear:
+            cache.clear()
+            self._ok("cache", "Query cache cleared")
+            return True
+        record = {"type": "cache", "entries": len(cache.entries), "capacity": cache.capacity,
+                  "hits": cache.hits, "misses": cache.misses, "hit_rate": round(cache.hit_rate, 4)}
+        if self.writer is not None:
+            self.writer.write(record)
+            return True
+        print(f"\n[Query cache] {record['entries']}/{record['capacity']} entries")
+        print(f"  Hits:     {cache.hits}")
+        print(f"  Misses:   {cache.misses}")
+        print(f"  Hit rate: {cache.hit_rate:.1%}\n")
+        return True
+
+    def _stored_notes(self):
+        """Notes as written to the store, with large contents moved out to blobs.
+
+        Blobs are named by the SHA-256 of their content, so identical bodies
+        are stored once, and are written before the store that references them.
+        """
+        threshold = self.config["blob_threshold"]
+        stored = []
+        for note in self.notes:
+            if "content" not in note:
+                # Blob note whose content was never replaced
+                stored.append(note)
+                continue
+            content = note["content"]
+            if threshold and len(content) > threshold:
+                stored.append(self._store_blob(note, content))
+            elif "blob" in note:
+                stored.append({k: v for k, v in note.items() if k not in BLOB_FIELDS})
+            else:
+                stored.append(note)
+        return stored
+
+    def _store_blob(self, note, content):
+        """Write ``content`` as a blob; returns the note's stored form."""
+        data = content.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        path = _blob_path(self.blobs_dir, digest)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.durability.write(path, lambda f: f.write(data), binary=True)
+
+        stored = {}
+        for key, value in note.items():
+            if key == "content":
+                stored.update(blob=digest, length=len(content),
+                              preview=content[:PREVIEW_CHARS])
+            elif key not in BLOB_FIELDS:
+                stored[key] = value
+        return stored
+
+    def _adopt_stored(self, stored):
+        """After a save, keep the stored form in memory and track unused blobs."""
+        refs = set()
+        for i, kept in enumerate(stored):
+            if kept is not self.notes[i]:
+                if "blob" in kept:
+                    kept = _BlobNote(kept, self.blobs_dir)
+                self.notes[i] = kept
+                self._by_id[kept["id"]] = kept
+            if "blob" in kept:
+                refs.add(kept["blob"])
+        self._orphan_blobs |= self._blob_refs - refs
+        self._orphan_blobs -= refs
+        self._blob_refs = refs
+        if self.durability.mode == "strict":
+            self._remove_orphan_blobs()
+
+    def _remove_orphan_blobs(self):
+        """Delete blobs no longer referenced, once the store dropping them is durable."""
+        for digest in self._orphan_blobs - self._blob_refs:
+            try:
+                os.remove(_blob_path(self.blobs_dir, digest))
+            except OSError:
+                pass
+        self._orphan_blobs.clear()
+
+    def _store_signature(self):
+        """Identify the current notes file contents (size, mtime)."""
+        try:
+            st = os.stat(self.notes_file)
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime_ns]
+
+    def _read_sidecar(self, path):
+        """Read derived data saved next to the store, if it matches the store."""
+        if not path.exists():
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception:
+            return None
+        # Compared with the version held in memory, not the file as it is
+        # now: another process may have saved since this one loaded
+        if data.get("signature") != self._loaded_signature:
+            return None
+        return data
+
+    def _write_sidecar(self, path, data):
+        """Save derived data tagged with the signature of the store in memory."""
+        data["signature"] = self._loaded_signature
+        tmp = None
+        try:
+            # Never fsynced: a stale or missing sidecar is simply rebuilt
+            f, tmp = _open_temp(path)
+            with f:
+                # json.dumps uses the C encoder; json.dump streams through Python
+                f.write(json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+            os.replace(tmp, path)
+        except Exception:
+            # Derived data is rebuilt from the notes on next load
+            if tmp is not None:
+                _remove_quietly(tmp)
+
+    def load_stats(self):
+        """Load running statistics, rebuilding them if they don't match the store."""
+        self.stats = self._read_stats()
+        if self.stats is None:
+            self.stats = NoteStats.from_notes(self.notes)
+            if self.notes_file.exists():
+                self.save_stats()
+
+    def _read_stats(self):
+        """Statistics from stats.json, or None if missing or out of date."""
+        data = self._read_sidecar(self.stats_file)
+        try:
+            return NoteStats.from_dict(data) if data else None
+        except (KeyError, TypeError):
+            return None
+
+    def _load_stats_only(self):
+        """Take statistics from stats.json without reading the notes.
+
+        Returns False, having loaded nothing, unless stats.json matches the
+        notes file as it is now.
+        """
+        self._loaded_signature = self._store_signature()
+        stats = self._read_stats() if self._loaded_signature is not None else None
+        if stats is None:
+            return False
+        self.stats = stats
+        return True
+
+    def save_stats(self):
+        """Persist running statistics next to the store."""
+        if self.stats.stale:
+            self.stats.refresh_extremes(self.notes)
+        self._write_sidecar(self.stats_file, self.stats.to_dict())
+
+    def _load_derived(self, path, index_class):
+        """Load an index saved next to the store, rebuilding it if out of date."""
+        # With unsaved changes the file on disk no longer describes self.notes
+        data = self._read_sidecar(path) if self._generation == self._saved_generation else None
+        if data:
+            try:
+                return index_class.from_dict(data)
+            except (KeyError, TypeError, ValueError):
+                pass
+        self._derived_dirty.add(path)
+        return index_class.from_notes(self.notes)
+
+    def save_derived(self):
+        """Write the similarity sidecars changed in this process.
+
+        Mutations only update an index that is already loaded, and the
+        sidecars are written here (on close) rather than on every save; a
+        sidecar left behind by an unloaded index fails its signature check
+        and is rebuilt on next use.
+        """
+        if not self._derived_dirty or self._generation != self._saved_generation:
+            return
+        if self._minhash is not None and self.minhash_file in self._derived_dirty:
+            self._write_sidecar(self.minhash_file, self._minhash.to_dict())
+        if self._similarity is not None and self.vectors_file in self._derived_dirty:
+            self._write_sidecar(self.vectors_file, self._similarity.to_dict())
+        self._derived_dirty.clear()
+
+    @property
+    def minhash(self):
+        """Near-duplicate index, loaded (or rebuilt) on first use."""
+        if self._minhash is None:
+            self._minhash = self._load_derived(self.minhash_file, MinHashIndex)
+        return self._minhash
+
+    @property
+    def similarity(self):
+        """Related-notes index, loaded (or rebuilt) on first use."""
+        if self._similarity is None:
+            self._similarity = self._load_derived(self.vectors_file, SimilarityIndex)
+        return self._similarity
+
+    def _build_lookups(self):
+        """Build the in-memory ID map, tag posting lists and sorted tag names."""
+        self._by_id = {}
+        self._tag_index = {}
+        for note in self.notes:
+            self._by_id[note.get("id")] = note
+            for tag in note.get("tags", []):
+                self._tag_index.setdefault(tag, set()).add(note.get("id"))
+        self._tag_names = sorted(self._tag_index)
+
+    def _index_note(self, note, derived=True):
+        """Update derived state for a note entering the store.
+
+        With ``derived=False`` only the lookups and statistics are updated;
+        call ``_invalidate_derived`` afterwards so the similarity indexes
+        are rebuilt when next needed.
+        """
+        self._generation += 1
+        self._by_id[note["id"]] = note
+        for tag in note.get("tags", []):
+            posting = self._tag_index.get(tag)
+            if posting is None:
+                posting = self._tag_index[tag] = set()
+                bisect.insort(self._tag_names, tag)
+            posting.add(note["id"])
+        self.stats.add(note)
+        if derived:
+            if self._minhash is not None:
+                content = note.get("content", "")
+                parked = self._parked_signatures.pop(note["id"], None)
+                if parked is not None and parked[0] == content:
+                    # Only tags or metadata changed: keep the signature
+                    self._minhash._insert(note["id"], parked[1])
+                else:
+                    self._minhash.add(note["id"], content)
+                self._derived_dirty.add(self.minhash_file)
+            if self._similarity is not None:
+                self._similarity.add(note["id"], note)
+                self._derived_dirty.add(self.vectors_file)
+
+    def _invalidate_derived(self):
+        """Drop the similarity indexes; stale sidecars are ignored on next load."""
+        self._minhash = None
+        self._similarity = None
+        self._derived_dirty.clear()
+        self._parked_signatures.clear()
+
+    def _unindex_note(self, note, derived=True):
+        """Update derived state for a note leaving the store."""
+        self._generation += 1
+        self._by_id.pop(note["id"], None)
+        for tag in note.get("tags", []):
+            posting = self._tag_index.get(tag)
+            if posting is not None:
+                posting.discard(note["id"])
+                if not posting:
+                    del self._tag_index[tag]
+                    del self._tag_names[bisect.bisect_left(self._tag_names, tag)]
+        self.stats.remove(note)
+        if derived:
+            if self._minhash is not None:
+                signature = self._minhash.remove(note["id"])
+                if signature is not None:
+                    self._parked_signatures[note["id"]] = (note.get("content", ""), signature)
+                self._derived_dirty.add(self.minhash_file)
+            if self._similarity is not None:
+                self._similarity.remove(note["id"])
+                self._derived_dirty.add(self.vectors_file)
+
+    def _record_change(self, op, note):
+        """Queue a change-feed event; it is appended once the store is saved."""
+        event = {"op": op, "id": note.get("id"), "uid": note.get("uid"),
+                 "time": datetime.now().isoformat()}
+        if op == "delete":
+            pass
+        elif _is_blob_stub(note):
+            # Unchanged large content stays in its blob; the event carries its
+            # digest, length and preview instead of a copy of the body
+            event["note"] = {k: v for k, v in note.items() if k != "history"}
+        else:
+            event["note"] = _materialize(note)
+            event["note"].pop("history", None)
+        self._pending_changes.append(event)
+
+    def iter_changes(self, since=0, follow=False, interval=1.0):
+        """Iterate over change-feed events with ``seq > since``.
+
+        With ``follow=True`` the iterator never ends: it polls the log every
+        ``interval`` seconds and yields events as other processes append them.
+        """
+        return self.changes.events(since=since, follow=follow, interval=interval)
+
+    def watch(self, since=None, follow=True, interval=1.0):
+        """Print change-feed events, by default only those made from now on."""
+        if since is None:
+            since = self.changes.last_seq()
+        try:
+            for event in self.iter_changes(since, follow=follow, interval=interval):
+                if self.writer is not None:
+                    self.writer.write({"type": "change", **event})
+                    self.writer.flush()
+                    continue
+                if event["op"] == "import":
+                    print(f"[{event['seq']}] import: {event['count']} note(s) from "
+                          f"{event['source']}", flush=True)
+                    continue
+                line = f"[{event['seq']}] {event['op']} #{event['id']}"
+                if "note" in event:
+                    line += f": {event['note'].get('content', '')[:60].replace(chr(10), ' ')}"
+                print(line, flush=True)
+        except KeyboardInterrupt:
+            pass
+
+    def _touch(self, note):
+        """Mark a note as modified, bumping its sync version."""
+        note["modified"] = datetime.now().isoformat()
+        note["version"] = note.get("version", 1) + 1
+
+    def _bury(self, note):
+        """Leave a tombstone for a deleted note so sync propagates the deletion."""
+        if note.get("uid"):
+            self.tombstones[note["uid"]] = {
+                "uid": note["uid"],
+                "version": note.get("version", 1) + 1,
+                "deleted": datetime.now().isoformat(),
+            }
+            self._tombstones_dirty = True
+
+    @property
+    def tombstones(self):
+        """UID -> tombstone of deleted notes, loaded on first use."""
+        if self._tombstones is None:
+            self._tombstones = {}
+            if self.tombstones_file.exists():
+                try:
+                    with open(self.tombstones_file, "r", encoding="utf-8") as f:
+                        self._tombstones = json.load(f)
+                except Exception:
+                    self._tombstones = {}
+        return self._tombstones
+
+    def _next_id(self):
+        """Return an ID not used by any existing note."""
+        return max((n.get("id", 0) for n in self.notes), default=0) + 1
+
+    def _report(self, text, **record):
+        """Print ``text``, or emit ``record`` when structured output is on."""
+        if self.writer is None:
+            print(text)
+        else:
+            self.writer.write(record)
+
+    def _ok(self, action, message, **extra):
+        """Report a successful action."""
+        self._report(f"[OK] {message}", type="result", action=action, ok=True, **extra)
+
+    def _fail(self, action, message, **extra):
+        """Report a failed action."""
+        self._report(f"[X] {message}", type="error", action=action, ok=False,
+                     message=message, **extra)
+
+    def _note_record(self, note):
+        """Build the structured record for a note (full content, no truncation)."""
+        record = {"type": "note"}
+        record.update(_materialize(note))
+        record.pop("history", None)
+        return record
+
     def load_config(self):
         """Load configuration."""
         if self.config_file.exists():
@@ -71,6 +2559,17 @@ class SmartNotes:
                 self.config = {"default_tags": []}
         else:
             self.config = {"default_tags": []}
+        self.config.setdefault("duplicates", "flag")
+        self.config.setdefault("duplicate_threshold", 0.8)
+        self.config.setdefault("storage", "json")
+        self.config.setdefault("compression", "zlib")
+        self.config.setdefault("compression_level", BlockStore.DEFAULT_LEVEL)
+        self.config.setdefault("block_size", 256)
+        self.config.setdefault("durability", "batched")
+        self.config.setdefault("durability_batch_ms", 1000)
+        self.config.setdefault("durability_batch_ops", 32)
+        self.config.setdefault("blob_threshold", 4096)
+        self.config.setdefault("query_cache_size", 128)
 
     def extract_tags(self, text):
         """Extract hashtags from text."""
@@ -86,13 +2585,21 @@ class SmartNotes:
                       'were', 'said', 'each', 'which', 'their', 'there', 'would',
                       'make', 'like', 'into', 'time', 'than', 'them', 'some'}
         keywords = [w for w in words if w not in stop_words]
-        # Return top keywords (max 3)
-        return list(set(keywords))[:3]
-
-    def add_note(self, content, tags=None):
-        """Add a new note."""
+        # Return the first three distinct keywords; the choice must not depend
+        # on hash order, since replace re-derives it to find automatic tags
+        return list(dict.fromkeys(keywords))[:3]
+
+    @_writes
+    def add_note(self, content, tags=None, on_duplicate=None):
+        """Add a new note.
+
+        ``on_duplicate`` (default: the ``duplicates`` config setting) decides
+        what happens when the content is a near-duplicate of an existing note:
+        "flag" adds it and reports the match, "merge" folds the new tags into
+        the most similar note instead, and "off" skips the check.
+        """
         if not content.strip():
-            print("[X] Cannot add empty note!")
+            self._fail("add", "Cannot add empty note!")
             return False
 
         # Extract hashtags from content
@@ -109,8 +2616,18 @@ class SmartNotes:
         # Remove duplicates
         all_tags = list(set(all_tags))
 
+        on_duplicate = on_duplicate or self.config["duplicates"]
+        duplicates = []
+        if on_duplicate != "off":
+            duplicates = [match for match in self.minhash.query(content, self.config["duplicate_threshold"])
+                          if match[0] in self._by_id]
+        if duplicates and on_duplicate == "merge":
+            return self._merge_into(duplicates[0], all_tags)
+
         note = {
-            "id": len(self.notes) + 1,
+            "id": self._next_id(),
+            "uid": uuid.uuid4().hex,
+            "version": 1,
             "content": content,
             "tags": all_tags,
             "created": datetime.now().isoformat(),
@@ -118,63 +2635,221 @@ class SmartNotes:
         }
 
         self.notes.append(note)
+        self._index_note(note)
+        self._record_change("add", note)
 
         if self.save_notes():
-            print(f"[OK] Note #{note['id']} added")
+            message = f"Note #{note['id']} added"
             if all_tags:
-                print(f"     Tags: {', '.join(all_tags)}")
+                message += f"\n     Tags: {', '.join(all_tags)}"
+            extra = {}
+            if duplicates:
+                dup_id, score = duplicates[0]
+                message += f"\n[!] Looks like a near-duplicate of note #{dup_id} ({score:.0%} similar)"
+                extra["duplicates"] = [{"id": i, "similarity": round(sc, 3)} for i, sc in duplicates]
+            self._ok("add", message, id=note["id"], tags=all_tags, **extra)
             return True
         return False
 
-    def list_notes(self, tag_filter=None, search_term=None, limit=None):
-        """List all notes or filtered notes."""
-        filtered_notes = self.notes
-
-        # Filter by tag
-        if tag_filter:
-            filtered_notes = [n for n in filtered_notes if tag_filter.lower() in n.get("tags", [])]
+    def _merge_into(self, match, tags):
+        """Fold a near-duplicate add into an existing note."""
+        note_id, score = match
+        note = self.get_note_by_id(note_id)
+        self._unindex_note(note)
+        note["tags"] = list(set(note.get("tags", []) + tags))
+        self._touch(note)
+        self._index_note(note)
+        self._record_change("update", note)
 
-        # Filter by search term
-        if search_term:
-            search_lower = search_term.lower()
-            filtered_notes = [n for n in filtered_notes if search_lower in n.get("content", "").lower()]
+        if self.save_notes():
+            self._ok("add", f"Merged into note #{note_id} ({score:.0%} similar)",
+                     id=note_id, tags=note["tags"], merged=True, similarity=round(score, 3))
+            return True
+        return False
 
-        # Sort by created date (newest first)
-        filtered_notes = sorted(filtered_notes, key=lambda x: x.get("created", ""), reverse=True)
+    @_reads
+    def find_duplicates(self, threshold=None):
+        """Return near-duplicate clusters (lists of note IDs) across the store."""
+        if threshold is None:
+            threshold = self.config["duplicate_threshold"]
+        clusters = ([i for i in cluster if i in self._by_id]
+                    for cluster in self.minhash.clusters(threshold))
+        return [cluster for cluster in clusters if len(cluster) > 1]
+
+    @_writes
+    def dedupe(self, threshold=None, merge=False):
+        """Report near-duplicate clusters, optionally merging each into its oldest note."""
+        clusters = self.find_duplicates(threshold)
+
+        if not merge:
+            if self.writer is not None:
+                for cluster in clusters:
+                    self.writer.write({"type": "cluster", "ids": cluster})
+                self.writer.write({"type": "summary", "action": "dedupe", "count": len(clusters)})
+                return clusters
+
+            if not clusters:
+                print("No near-duplicates found.")
+                return clusters
+            print(f"\n[{len(clusters)} duplicate cluster(s) found]\n")
+            for cluster in clusters:
+                print(f"  {' '.join(f'#{i}' for i in cluster)}")
+                print(f"    {_content_preview(self.get_note_by_id(cluster[0]))}")
+            print()
+            return clusters
+
+        removed = set()
+        for cluster in clusters:
+            members = sorted((self.get_note_by_id(i) for i in cluster),
+                             key=lambda n: (n.get("created", ""), n["id"]))
+            keeper, others = members[0], members[1:]
+            self._unindex_note(keeper)
+            merged_tags = set(keeper.get("tags", []))
+            for other in others:
+                merged_tags.update(other.get("tags", []))
+                self._unindex_note(other)
+                self._bury(other)
+                self._record_change("delete", other)
+                removed.add(other["id"])
+            keeper["tags"] = list(merged_tags)
+            self._touch(keeper)
+            self._index_note(keeper)
+            self._record_change("update", keeper)
+
+        if not removed:
+            self._ok("dedupe", "No near-duplicates found.", clusters=0, removed=0)
+            return clusters
+
+        self.notes = [n for n in self.notes if n.get("id") not in removed]
+        if self.save_notes():
+            self._ok("dedupe", f"Merged {len(clusters)} cluster(s), removed {len(removed)} note(s)",
+                     clusters=len(clusters), removed=len(removed))
+        return clusters
 
-        # Limit results
-        if limit:
-            filtered_notes = filtered_notes[:limit]
+    @_reads
+    def list_notes(self, tag_filter=None, search_term=None, limit=None):
+        """List all notes or filtered notes (results are cached until the next write)."""
+        tag_filter = tag_filter.lower().lstrip("#") if tag_filter else ""
+        search_lower = search_term.lower() if search_term else ""
+        key = json.dumps(["list", tag_filter, search_lower, limit or 0])
+
+        def compute():
+            filtered_notes = self.notes
+
+            # Filter by tag (straight from the posting lists; "py*" matches a prefix)
+            if tag_filter:
+                if tag_filter.endswith("*"):
+                    ids = set()
+                    for tag in self.tags_with_prefix(tag_filter[:-1]):
+                        ids |= self._tag_index[tag]
+                else:
+                    ids = self._tag_index.get(tag_filter, ())
+                filtered_notes = [self._by_id[i] for i in ids]
+
+            # Filter by search term
+            if search_lower:
+                filtered_notes = [n for n in filtered_notes
+                                  if search_lower in n.get("content", "").lower()]
+
+            # Sort by created date (newest first)
+            filtered_notes = sorted(filtered_notes, key=lambda x: x.get("created", ""), reverse=True)
+
+            # Limit results
+            if limit:
+                filtered_notes = filtered_notes[:limit]
+            return [n["id"] for n in filtered_notes]
+
+        ids = self._cached_ids(key, compute)
+        self._print_notes([self._by_id[i] for i in ids], "list")
+
+    def _print_notes(self, notes, action):
+        """Print (or emit) a list of notes with truncated previews."""
+        if self.writer is not None:
+            for note in notes:
+                self.writer.write(self._note_record(note))
+            self.writer.write({"type": "summary", "action": action, "count": len(notes)})
+            return
 
-        if not filtered_notes:
+        if not notes:
             print("No notes found.")
             return
 
-        print(f"\n[{len(filtered_notes)} note(s) found]\n")
+        print(f"\n[{len(notes)} note(s) found]\n")
 
-        for note in filtered_notes:
+        for note in notes:
             note_id = note.get("id", "?")
-            content = note.get("content", "")
+            content = _content_preview(note)
             tags = note.get("tags", [])
             created = note.get("created", "")[:19]
 
-            # Truncate long notes
-            if len(content) > 80:
-                content = content[:77] + "..."
-
             print(f"#{note_id} | {created}")
             print(f"    {content}")
             if tags:
                 print(f"    Tags: {', '.join(tags)}")
             print()
 
+    @_reads
+    def query_notes(self, expression, limit=None, explain=False):
+        """Return notes matching a query expression, newest first.
+
+        With ``explain``, returns ``(notes, plan)`` where ``plan`` is the
+        executed ``QueryPlan`` annotated with actual cardinalities.
+        """
+        node = parse_query(expression)
+        planner = QueryPlanner(self._by_id, self._tag_index, self.stats)
+
+        def compute(plan):
+            ids = planner.execute(plan)
+            matches = sorted((self._by_id[i] for i in ids),
+                             key=lambda x: x.get("created", ""), reverse=True)
+            if limit:
+                matches = matches[:limit]
+            return [n["id"] for n in matches]
+
+        if explain:
+            plan = planner.plan(node)
+            return [self._by_id[i] for i in compute(plan)], plan
+        key = json.dumps(["query", _describe(node), limit or 0])
+        ids = self._cached_ids(key, lambda: compute(planner.plan(node)))
+        return [self._by_id[i] for i in ids]
+
+    @_reads
+    def run_query(self, expression, limit=None, explain=False):
+        """Show notes matching a query expression."""
+        try:
+            if explain:
+                matches, plan = self.query_notes(expression, limit=limit, explain=True)
+            else:
+                matches = self.query_notes(expression, limit=limit)
+        except QueryError as e:
+            self._fail("query", f"Invalid query: {e}", query=expression)
+            return False
+
+        if explain:
+            if self.writer is not None:
+                record = {"type": "plan"}
+                record.update(plan.to_dict())
+                self.writer.write(record)
+            else:
+                print("\nQuery plan:")
+                for line in plan.lines(1):
+                    print(line)
+
+        self._print_notes(matches, "query")
+        return True
+
+    @_reads
     def show_note(self, note_id):
         """Show full note details."""
         note = self.get_note_by_id(note_id)
         if not note:
-            print(f"[X] Note #{note_id} not found!")
+            self._fail("show", f"Note #{note_id} not found!", id=note_id)
             return False
 
+        if self.writer is not None:
+            self.writer.write(self._note_record(note))
+            return True
+
         print(f"\n{'='*60}")
         print(f"Note #{note['id']}")
         print(f"{'='*60}")
@@ -188,169 +2863,814 @@ class SmartNotes:
         print(f"\n{'='*60}\n")
         return True
 
+    @_reads
+    def read_note(self, note_id):
+        """Read one note straight from disk.
+
+        With compressed storage only the block holding the note is inflated.
+        """
+        if self.compressed:
+            if not self.notes_file.exists():
+                return None
+            note = BlockStore(self.notes_file).read_note(note_id)
+            if note is not None and "blob" in note:
+                note = _BlobNote(note, self.blobs_dir)
+            return note
+        return self.get_note_by_id(note_id)
+
+    @_reads
+    def related_notes(self, note_id, k=5):
+        """Return up to ``k`` (note, similarity) pairs most similar to a note."""
+        # The index is derived data: never hand out an ID the store lacks
+        return [(self._by_id[i], score)
+                for i, score in self.similarity.related(note_id, k) if i in self._by_id]
+
+    @_reads
+    def show_related(self, note_id, k=5):
+        """Show the notes most similar to a note."""
+        if not self.get_note_by_id(note_id):
+            self._fail("related", f"Note #{note_id} not found!", id=note_id)
+            return False
+
+        related = self.related_notes(note_id, k)
+
+        if self.writer is not None:
+            for note, score in related:
+                record = self._note_record(note)
+                record["similarity"] = round(score, 4)
+                self.writer.write(record)
+            self.writer.write({"type": "summary", "action": "related", "id": note_id,
+                               "count": len(related)})
+            return True
+
+        if not related:
+            print(f"No notes related to #{note_id}.")
+            return True
+
+        print(f"\n[{len(related)} note(s) related to #{note_id}]\n")
+        for note, score in related:
+            content = _content_preview(note)
+            print(f"#{note['id']} | {score:.0%} similar")
+            print(f"    {content}")
+            print()
+        return True
+
+    @_reads
     def get_note_by_id(self, note_id):
         """Get note by ID."""
-        for note in self.notes:
-            if note.get("id") == note_id:
-                return note
-        return None
+        return self._by_id.get(note_id)
+
+    def _set_content(self, note, new_content):
+        """Replace a note's content, keeping the old version as a reverse delta.
+
+        The current content stays in full; ``history`` holds one entry per
+        earlier revision (oldest first), each rebuilding the revision before
+        it from the one after.
+        """
+        old_content = note.get("content", "")
+        entry = {"modified": note.get("modified"), "length": len(old_content),
+                 "delta": text_delta(new_content, old_content)}
+        # A new list, so checkpoints holding the old one stay intact
+        note["history"] = note.get("history", []) + [entry]
+        note["content"] = new_content
+        self._touch(note)
+
+    def revisions(self, note):
+        """Yield ``(rev, modified, content)`` for every revision, newest first."""
+        history = note.get("history", [])
+        content = note.get("content", "")
+        yield len(history) + 1, note.get("modified", ""), content
+        for rev in range(len(history), 0, -1):
+            entry = history[rev - 1]
+            content = apply_text_delta(content, entry["delta"])
+            yield rev, entry.get("modified") or "", content
+
+    @_reads
+    def get_revision(self, note, rev):
+        """Content of revision ``rev`` of a note, or None if it does not exist."""
+        if not 1 <= rev <= len(note.get("history", [])) + 1:
+            return None
+        for number, _, content in self.revisions(note):
+            if number == rev:
+                return content
+
+    @_reads
+    def show_history(self, note_id, rev=None):
+        """List a note's revisions, or print the full text of one revision."""
+        note = self.get_note_by_id(note_id)
+        if not note:
+            self._fail("history", f"Note #{note_id} not found!", id=note_id)
+            return False
+
+        if rev is not None:
+            content = self.get_revision(note, rev)
+            if content is None:
+                self._fail("history", f"Note #{note_id} has no revision {rev}", id=note_id, rev=rev)
+                return False
+            if self.writer is not None:
+                self.writer.write({"type": "revision", "id": note_id, "rev": rev, "content": content})
+            else:
+                print(f"\nNote #{note_id}, revision {rev}:\n\n{content}\n")
+            return True
+
+        current = len(note.get("history", [])) + 1
+        if self.writer is not None:
+            for number, modified, content in self.revisions(note):
+                self.writer.write({"type": "revision", "id": note_id, "rev": number,
+                                   "modified": modified, "length": len(content),
+                                   "current": number == current})
+            return True
+
+        print(f"\n[{current} revision(s) of note #{note_id}]\n")
+        for number, modified, content in self.revisions(note):
+            label = " (current)" if number == current else ""
+            print(f"rev {number}{label} | {modified[:19]} | {len(content)} chars")
+            print(f"    {_content_preview({'content': content})}")
+            print()
+        return True
 
-    def edit_note(self, note_id, new_content):
+    @_writes
+    def revert_note(self, note_id, rev):
+        """Make an earlier revision current again (recorded as a new revision)."""
+        note = self.get_note_by_id(note_id)
+        if not note:
+            self._fail("revert", f"Note #{note_id} not found!", id=note_id)
+            return False
+        content = self.get_revision(note, rev)
+        if content is None:
+            self._fail("revert", f"Note #{note_id} has no revision {rev}", id=note_id, rev=rev)
+            return False
+        if content == note.get("content", ""):
+            self._ok("revert", f"Note #{note_id} already matches revision {rev}", id=note_id, rev=rev)
+            return True
+        return self.edit_note(note_id, content, action="revert",
+                              message=f"Note #{note_id} reverted to revision {rev}")
+
+    @_writes
+    def edit_note(self, note_id, new_content, action="edit", message=None):
         """Edit an existing note."""
         note = self.get_note_by_id(note_id)
         if not note:
-            print(f"[X] Note #{note_id} not found!")
+            self._fail(action, f"Note #{note_id} not found!", id=note_id)
             return False
 
-        note["content"] = new_content
-        note["modified"] = datetime.now().isoformat()
+        self._unindex_note(note)
+        self._set_content(note, new_content)
 
         # Re-extract tags
         extracted_tags = self.extract_tags(new_content)
         keywords = self.extract_keywords(new_content)
         note["tags"] = list(set(extracted_tags + keywords))
+        self._index_note(note)
+        self._record_change("update", note)
 
         if self.save_notes():
-            print(f"[OK] Note #{note_id} updated")
+            self._ok(action, message or f"Note #{note_id} updated", id=note_id, tags=note["tags"],
+                     revision=len(note["history"]) + 1)
             return True
         return False
 
+    @_writes
     def delete_note(self, note_id):
         """Delete a note."""
         note = self.get_note_by_id(note_id)
         if not note:
-            print(f"[X] Note #{note_id} not found!")
+            self._fail("delete", f"Note #{note_id} not found!", id=note_id)
             return False
 
         self.notes = [n for n in self.notes if n.get("id") != note_id]
+        self._unindex_note(note)
+        self._bury(note)
+        self._record_change("delete", note)
 
         if self.save_notes():
-            print(f"[OK] Note #{note_id} deleted")
+            self._ok("delete", f"Note #{note_id} deleted", id=note_id)
             return True
         return False
 
+    @_writes
     def tag_note(self, note_id, tags):
         """Add tags to a note."""
         note = self.get_note_by_id(note_id)
         if not note:
-            print(f"[X] Note #{note_id} not found!")
+            self._fail("tag", f"Note #{note_id} not found!", id=note_id)
             return False
 
         existing_tags = note.get("tags", [])
         new_tags = [t.lower().strip().strip('#') for t in tags]
+        self._unindex_note(note)
         note["tags"] = list(set(existing_tags + new_tags))
-        note["modified"] = datetime.now().isoformat()
+        self._touch(note)
+        self._index_note(note)
+        self._record_change("update", note)
 
         if self.save_notes():
-            print(f"[OK] Tags added to note #{note_id}: {', '.join(new_tags)}")
+            self._ok("tag", f"Tags added to note #{note_id}: {', '.join(new_tags)}",
+                     id=note_id, tags=note["tags"])
             return True
         return False
 
-    def list_tags(self):
-        """List all unique tags."""
-        all_tags = set()
-        for note in self.notes:
-            all_tags.update(note.get("tags", []))
+    def _select_notes(self, action, ids=None, where=None):
+        """Resolve bulk-operation targets from IDs and/or a query.
 
-        if not all_tags:
+        Returns ``(notes, missing_ids)``, or None after reporting an invalid
+        query. With neither ``ids`` nor ``where``, every note is selected.
+        """
+        missing = []
+        if where:
+            planner = QueryPlanner(self._by_id, self._tag_index, self.stats)
+            try:
+                selected = set(planner.execute(planner.plan(parse_query(where))))
+            except QueryError as e:
+                self._fail(action, f"Invalid query: {e}", query=where)
+                return None
+        else:
+            selected = None
+        if ids is not None:
+            wanted = []
+            for note_id in dict.fromkeys(ids):
+                if note_id not in self._by_id:
+                    missing.append(note_id)
+                elif selected is None or note_id in selected:
+                    wanted.append(note_id)
+            selected = wanted
+        elif selected is None:
+            selected = list(self._by_id)
+        return [self._by_id[i] for i in sorted(selected)], missing
+
+    def _checkpoint(self, notes):
+        """Remember ``notes`` and the store's shape so a failed commit can be undone."""
+        return {
+            "notes": list(self.notes),
+            "originals": [(note, dict(note)) for note in notes],
+            "tombstones": None if self._tombstones is None else dict(self._tombstones),
+            "tombstones_dirty": self._tombstones_dirty,
+            "changes": len(self._pending_changes),
+        }
+
+    def _rollback(self, checkpoint):
+        """Restore the in-memory store to ``checkpoint`` after a failed commit."""
+        for note, original in checkpoint["originals"]:
+            note.clear()
+            note.update(original)
+        self.notes = checkpoint["notes"]
+        self._tombstones = checkpoint["tombstones"]
+        self._tombstones_dirty = checkpoint["tombstones_dirty"]
+        del self._pending_changes[checkpoint["changes"]:]
+        # Results cached from the undone state must not be served again
+        self._generation += 1
+        self._build_lookups()
+        self.stats = NoteStats.from_notes(self.notes)
+        self._invalidate_derived()
+
+    def _commit_bulk(self, action, checkpoint, changed, missing, message, **extra):
+        """Save a bulk change once, rolling back if the save fails."""
+        if changed and not self.save_notes():
+            self._rollback(checkpoint)
+            return False
+        if missing:
+            message += f" ({len(missing)} ID(s) not found: {', '.join(map(str, missing[:10]))}"
+            message += ", ...)" if len(missing) > 10 else ")"
+        self._ok(action, message, count=len(changed), ids=changed, missing=missing, **extra)
+        return True
+
+    def _retag(self, notes, update):
+        """Apply ``update(tags) -> tags`` to each note; returns the IDs that changed."""
+        changed = []
+        for note in notes:
+            old_tags = note.get("tags", [])
+            new_tags = update(old_tags)
+            if set(new_tags) == set(old_tags):
+                continue
+            self._unindex_note(note)
+            note["tags"] = new_tags
+            self._touch(note)
+            self._index_note(note)
+            self._record_change("update", note)
+            changed.append(note["id"])
+        return changed
+
+    @_writes
+    def tag_notes(self, tags, ids=None, where=None):
+        """Add tags to every note selected by ``ids`` and/or ``where``, in one commit."""
+        selection = self._select_notes("tag", ids, where)
+        if selection is None:
+            return False
+        notes, missing = selection
+        new_tags = [t.lower().strip().strip('#') for t in tags]
+        checkpoint = self._checkpoint(notes)
+        changed = self._retag(notes, lambda old: list(set(old + new_tags)))
+        return self._commit_bulk("tag", checkpoint, changed, missing,
+                                 f"Tagged {len(changed)} note(s) with: {', '.join(new_tags)}",
+                                 tags=new_tags)
+
+    @_writes
+    def untag_notes(self, tags, ids=None, where=None):
+        """Remove tags from every note selected by ``ids`` and/or ``where``, in one commit."""
+        selection = self._select_notes("untag", ids, where)
+        if selection is None:
+            return False
+        notes, missing = selection
+        drop = {t.lower().strip().strip('#') for t in tags}
+        checkpoint = self._checkpoint(notes)
+        changed = self._retag(notes, lambda old: [t for t in old if t not in drop])
+        return self._commit_bulk("untag", checkpoint, changed, missing,
+                                 f"Removed {', '.join(sorted(drop))} from {len(changed)} note(s)",
+                                 tags=sorted(drop))
+
+    @_writes
+    def delete_notes(self, ids=None, where=None):
+        """Delete every note selected by ``ids`` and/or ``where``, in one commit."""
+        if ids is None and not where:
+            self._fail("delete", "Refusing to delete without IDs or a query")
+            return False
+        selection = self._select_notes("delete", ids, where)
+        if selection is None:
+            return False
+        notes, missing = selection
+        checkpoint = self._checkpoint(notes)
+        changed = []
+        for note in notes:
+            self._unindex_note(note)
+            self._bury(note)
+            self._record_change("delete", note)
+            changed.append(note["id"])
+        if changed:
+            removed = set(changed)
+            self.notes = [n for n in self.notes if n.get("id") not in removed]
+        return self._commit_bulk("delete", checkpoint, changed, missing,
+                                 f"Deleted {len(changed)} note(s)")
+
+    @_writes
+    def replace_in_notes(self, find, replacement, ids=None, where=None, regex=False):
+        """Find and replace text across the selected notes (default: all), in one commit.
+
+        Tags extracted from the old content are replaced by those extracted
+        from the new content; tags added by hand are kept.
+        """
+        try:
+            pattern = re.compile(find if regex else re.escape(find))
+        except re.error as e:
+            self._fail("replace", f"Invalid pattern: {e}", pattern=find)
+            return False
+        selection = self._select_notes("replace", ids, where)
+        if selection is None:
+            return False
+        notes, missing = selection
+
+        repl = replacement if regex else (lambda match: replacement)
+        # Compute every new body first so a bad replacement template changes nothing
+        edits = []
+        replacements = 0
+        try:
+            for note in notes:
+                content = note.get("content", "")
+                new_content, n = pattern.subn(repl, content)
+                if new_content != content:
+                    edits.append((note, content, new_content))
+                    replacements += n
+        except (re.error, IndexError) as e:
+            self._fail("replace", f"Invalid replacement: {e}", replacement=replacement)
+            return False
+
+        checkpoint = self._checkpoint([note for note, _, _ in edits])
+        changed = []
+        for note, content, new_content in edits:
+            old_auto = set(self.extract_tags(content) + self.extract_keywords(content))
+            new_auto = set(self.extract_tags(new_content) + self.extract_keywords(new_content))
+            self._unindex_note(note)
+            self._set_content(note, new_content)
+            note["tags"] = list((set(note.get("tags", [])) - old_auto) | new_auto)
+            self._index_note(note)
+            self._record_change("update", note)
+            changed.append(note["id"])
+        return self._commit_bulk("replace", checkpoint, changed, missing,
+                                 f"Replaced {replacements} occurrence(s) in {len(changed)} note(s)",
+                                 replacements=replacements)
+
+    @_reads
+    def tags_with_prefix(self, prefix):
+        """Tags starting with ``prefix``, in order (binary search, no full scan)."""
+        prefix = prefix.lower().lstrip("#")
+        names = self._tag_names
+        start = bisect.bisect_left(names, prefix)
+        end = start
+        while end < len(names) and names[end].startswith(prefix):
+            end += 1
+        return names[start:end]
+
+    @_reads
+    def list_tags(self, prefix=None, names_only=False):
+        """List all unique tags, or those starting with ``prefix``.
+
+        ``names_only`` prints bare tag names, one per line, for shell completion.
+        """
+        tag_counts = self.stats.tags
+        sorted_tags = self.tags_with_prefix(prefix) if prefix else self._tag_names
+
+        if names_only:
+            for tag in sorted_tags:
+                print(tag)
+            return
+
+        if self.writer is not None:
+            for tag in sorted_tags:
+                self.writer.write({"type": "tag", "tag": tag, "count": tag_counts[tag]})
+            return
+
+        if not sorted_tags:
             print("No tags found.")
             return
 
-        sorted_tags = sorted(all_tags)
         print(f"\n[{len(sorted_tags)} unique tag(s)]\n")
         for tag in sorted_tags:
-            # Count notes with this tag
-            count = sum(1 for n in self.notes if tag in n.get("tags", []))
-            print(f"  #{tag} ({count} note(s))")
+            print(f"  #{tag} ({tag_counts[tag]} note(s))")
         print()
 
-    def export_notes(self, format="txt", output_file=None):
-        """Export notes to file."""
+    @_reads
+    def export_notes(self, format="txt", output_file=None, workers=None,
+                     chunk_size=EXPORT_CHUNK_NOTES):
+        """Export notes to one file per format.
+
+        ``format`` is a format name or a list of them. Notes are sorted once;
+        each format is then formatted in chunks of ``chunk_size`` notes (in
+        creation order, so each chunk is a time range) and written on a
+        thread pool of ``workers`` threads. With several formats,
+        ``output_file`` is a directory or a base name that gets each
+        format's extension.
+        """
+        formats = [format] if isinstance(format, str) else list(dict.fromkeys(format))
         if not self.notes:
-            print("[X] No notes to export!")
+            self._fail("export", "No notes to export!")
             return False
+        for fmt in formats:
+            if fmt not in EXPORT_FORMATS:
+                self._fail("export", f"Unsupported format: {fmt}", format=fmt)
+                return False
+
+        paths = self._export_paths(formats, output_file)
+        ordered = sorted(self.notes, key=lambda x: x.get("created", ""))
+        starts = range(0, len(ordered), chunk_size)
+        generated = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        workers = workers or min(len(formats) * len(starts), os.cpu_count() or 1, 8)
+        # Rendered chunks held per format: written ones are dropped, so memory
+        # stays at a few chunks per format however large the export is
+        window = max(2, workers)
+
+        def render(fmt, start):
+            _, note_text, separator, _ = EXPORT_FORMATS[fmt]
+            return separator.join(map(note_text, ordered[start:start + chunk_size]))
 
+        def write(fmt):
+            header, _, separator, footer = EXPORT_FORMATS[fmt]
+            pending = deque()
+
+            def write_next(f, first):
+                if not first:
+                    f.write(separator)
+                f.write(pending.popleft().result())
+
+            try:
+                with open(paths[fmt], "w", encoding="utf-8") as f:
+                    f.write(header(generated))
+                    written = 0
+                    for start in starts:
+                        pending.append(renderers.submit(render, fmt, start))
+                        if len(pending) >= window:
+                            write_next(f, written == 0)
+                            written += 1
+                    while pending:
+                        write_next(f, written == 0)
+                        written += 1
+                    f.write(footer)
+            finally:
+                for future in pending:
+                    future.cancel()
+
+        ok = True
+        # Writers get their own threads so one waiting on a chunk never
+        # holds a worker that chunk needs
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as renderers, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=len(formats)) as writers:
+            writes = {fmt: writers.submit(write, fmt) for fmt in formats}
+            for fmt in formats:
+                try:
+                    writes[fmt].result()
+                except Exception as e:
+                    self._fail("export", f"Export failed: {e}", format=fmt)
+                    ok = False
+                else:
+                    self._ok("export", f"Notes exported to: {paths[fmt]}",
+                             format=fmt, path=str(paths[fmt]), count=len(ordered))
+        return ok
+
+    @staticmethod
+    def _export_paths(formats, output_file):
+        """Output path for each export format."""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        if output_file and len(formats) == 1:
+            return {formats[0]: output_file}
         if not output_file:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            output_file = f"notes_export_{timestamp}.{format}"
+            return {fmt: f"notes_export_{timestamp}.{fmt}" for fmt in formats}
+        output = Path(output_file)
+        if output.is_dir():
+            return {fmt: output / f"notes_export_{timestamp}.{fmt}" for fmt in formats}
+        if output.suffix.lstrip(".") in EXPORT_FORMATS:
+            output = output.with_suffix("")
+        return {fmt: output.with_name(f"{output.name}.{fmt}") for fmt in formats}
+
+    @_writes
+    def import_notes(self, path, format=None):
+        """Import notes from a SmartNotes txt, md or json export.
+
+        The file is parsed as a stream and the store is written once at the
+        end, so the import is all-or-nothing and runs in time linear in the
+        file size. Original IDs, timestamps and tags are kept; an ID already
+        in use is replaced by a fresh one. The change feed gets one ``import``
+        event listing the new IDs rather than an event per note.
+        """
+        path = Path(path)
+        format = (format or path.suffix.lstrip(".")).lower()
+        if format not in IMPORT_FORMATS:
+            self._fail("import", f"Unsupported format: {format}", format=format)
+            return False
+
+        start = len(self.notes)
+        next_id = self._next_id()
+        uids = {n["uid"] for n in self.notes if n.get("uid")}
+        counts = {"imported": 0, "renumbered": 0, "skipped": 0}
 
         try:
-            if format == "txt":
-                self._export_txt(output_file)
-            elif format == "md":
-                self._export_markdown(output_file)
-            elif format == "json":
-                self._export_json(output_file)
-            else:
-                print(f"[X] Unsupported format: {format}")
-                return False
+            with open(path, "r", encoding="utf-8") as f:
+                for record in IMPORT_FORMATS[format](f):
+                    note = self._normalize_imported(record)
+                    if note is None:
+                        counts["skipped"] += 1
+                        continue
+                    if not isinstance(note.get("id"), int) or note["id"] in self._by_id:
+                        note["id"] = next_id
+                        counts["renumbered"] += 1
+                    if note.get("uid") in uids:
+                        # A second copy of a note: give it its own identity
+                        note["uid"] = uuid.uuid4().hex
+                        note["version"] = 1
+                    if note.get("uid"):
+                        uids.add(note["uid"])
+                    next_id = max(next_id, note["id"] + 1)
+                    self.notes.append(note)
+                    self._index_note(note, derived=False)
+                    counts["imported"] += 1
+        except (OSError, ValueError) as e:
+            # Roll back everything applied so far
+            for note in self.notes[start:]:
+                self._unindex_note(note, derived=False)
+            del self.notes[start:]
+            self._fail("import", f"Import failed: {e}", path=str(path))
+            return False
 
-            print(f"[OK] Notes exported to: {output_file}")
-            return True
-        except Exception as e:
-            print(f"[X] Export failed: {e}")
+        if counts["imported"]:
+            self._pending_changes.append({
+                "op": "import", "id": None, "uid": None, "time": datetime.now().isoformat(),
+                "count": counts["imported"], "source": str(path),
+                "ids": _id_ranges(n["id"] for n in self.notes[start:])})
+        self._invalidate_derived()
+        if not self.save_notes():
             return False
 
-    def _export_txt(self, filename):
-        """Export as plain text."""
-        with open(filename, "w", encoding="utf-8") as f:
-            f.write(f"SmartNotes Export - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write("=" * 60 + "\n\n")
-
-            for note in sorted(self.notes, key=lambda x: x.get("created", "")):
-                f.write(f"Note #{note['id']}\n")
-                f.write(f"Created: {note['created'][:19]}\n")
-                if note.get("tags"):
-                    f.write(f"Tags: {', '.join(note['tags'])}\n")
-                f.write(f"\n{note['content']}\n")
-                f.write("\n" + "-" * 60 + "\n\n")
-
-    def _export_markdown(self, filename):
-        """Export as Markdown."""
-        with open(filename, "w", encoding="utf-8") as f:
-            f.write(f"# SmartNotes Export\n\n")
-            f.write(f"*Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}*\n\n")
-            f.write("---\n\n")
-
-            for note in sorted(self.notes, key=lambda x: x.get("created", "")):
-                f.write(f"## Note #{note['id']}\n\n")
-                f.write(f"**Created:** {note['created'][:19]}  \n")
-                if note.get("tags"):
-                    tags_md = " ".join([f"`#{t}`" for t in note['tags']])
-                    f.write(f"**Tags:** {tags_md}  \n")
-                f.write(f"\n{note['content']}\n\n")
-                f.write("---\n\n")
-
-    def _export_json(self, filename):
-        """Export as JSON."""
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump(self.notes, f, indent=2, ensure_ascii=False)
-
-    def get_stats(self):
-        """Get statistics about notes."""
-        if not self.notes:
-            print("No notes yet. Add one with: smartnotes add \"Your note here\"")
-            return
+        message = f"Imported {counts['imported']} note(s) from {path}"
+        if counts["renumbered"]:
+            message += f" ({counts['renumbered']} renumbered)"
+        if counts["skipped"]:
+            message += f", skipped {counts['skipped']} invalid record(s)"
+        self._ok("import", message, path=str(path), format=format, **counts)
+        return True
 
-        total_notes = len(self.notes)
-        all_tags = set()
+    @staticmethod
+    def _normalize_imported(record):
+        """Validate an imported record; returns a note dict or None."""
+        if not isinstance(record, dict):
+            return None
+        content = record.get("content")
+        if not isinstance(content, str) or not content.strip():
+            return None
+        note = {k: v for k, v in record.items() if k not in BLOB_FIELDS}
+        now = datetime.now().isoformat()
+        if not isinstance(note.get("created"), str) or not note["created"]:
+            note["created"] = now
+        if not isinstance(note.get("modified"), str) or not note["modified"]:
+            note["modified"] = note["created"]
+        tags = note.get("tags")
+        # Kept as written, like tags given explicitly to add
+        note["tags"] = [t for t in tags if isinstance(t, str)] if isinstance(tags, list) else []
+        return note
+
+    def _ensure_uids(self):
+        """Give legacy notes a UID and version; returns True if any changed."""
+        changed = False
+        for note in self.notes:
+            if not note.get("uid"):
+                note["uid"] = uuid.uuid4().hex
+                note.setdefault("version", 1)
+                changed = True
+        return changed
+
+    def _sync_entries(self):
+        """UID -> note or tombstone, whichever is newer."""
+        entries = dict(self.tombstones)
         for note in self.notes:
-            all_tags.update(note.get("tags", []))
+            buried = entries.get(note["uid"])
+            if buried is None or note.get("version", 1) > buried["version"]:
+                entries[note["uid"]] = note
+        return entries
+
+    @staticmethod
+    def _entry_digest(entry):
+        """Digest of a sync entry (everything except the store-local ID)."""
+        if "deleted" in entry:
+            return MerkleTree.digest(f"{entry['uid']}:{entry['version']}:deleted")
+        payload = {k: v for k, v in entry.items() if k != "id" and k not in BLOB_FIELDS}
+        # Hash the content (a blob is already named by it) so digests match
+        # however each store happens to keep the body
+        if _is_blob_stub(entry):
+            payload["content"] = entry["blob"]
+        else:
+            payload["content"] = hashlib.sha256(entry.get("content", "").encode("utf-8")).hexdigest()
+        payload["tags"] = sorted(payload.get("tags", []))
+        return MerkleTree.digest(json.dumps(payload, sort_keys=True, ensure_ascii=False))
+
+    @classmethod
+    def _sync_rank(cls, entry):
+        """Deterministic conflict order: version, then timestamp, then digest."""
+        if entry is None:
+            return (-1, "", 0)
+        stamp = entry.get("deleted") or entry.get("modified", "")
+        return (entry.get("version", 1), stamp, cls._entry_digest(entry))
+
+    def _apply_sync_entry(self, entry, by_uid, next_id):
+        """Make this store hold ``entry`` (a note or tombstone from another store).
+
+        Deleted notes are only dropped from the lookups here; the caller
+        compacts ``self.notes`` once after applying every entry. ``next_id``
+        is the lowest unused ID; the updated value is returned.
+        """
+        existing = by_uid.pop(entry["uid"], None)
+        if existing is not None:
+            self._unindex_note(existing)
+
+        if "deleted" in entry:
+            self.tombstones[entry["uid"]] = dict(entry)
+            self._tombstones_dirty = True
+            if existing is not None:
+                self._record_change("delete", existing)
+            return next_id
+
+        if existing is not None:
+            local_id = existing["id"]
+            existing.clear()
+            existing.update(entry)
+            existing["id"] = local_id
+            note = existing
+        else:
+            note = dict(entry)
+            if not isinstance(note.get("id"), int) or note["id"] in self._by_id:
+                note["id"] = next_id
+            next_id = max(next_id, note["id"] + 1)
+            self.notes.append(note)
+        self._index_note(note)
+        self._record_change("update" if existing is not None else "add", note)
+        by_uid[note["uid"]] = note
+        if self.tombstones.pop(note["uid"], None) is not None:
+            self._tombstones_dirty = True
+        return next_id
+
+    @_writes
+    def sync(self, other_dir, init=False):
+        """Two-way sync with the store in ``other_dir``.
+
+        Notes are matched by UID. Merkle trees over both stores locate the
+        differing notes without comparing every note, and only those are
+        exchanged. Conflicts go to the higher version, then the later
+        modification/deletion time, then the larger digest, so both sides
+        always converge on the same result. Unless ``init`` is set,
+        ``other_dir`` must already hold a store, so a mistyped path is not
+        silently turned into a new one.
+        """
+        if Path(other_dir).resolve() == self.notes_dir.resolve():
+            self._fail("sync", "Cannot sync a store with itself", path=str(other_dir))
+            return False
+        if not init and not any((Path(other_dir) / name).exists() for name in ("notes.json", "notes.blk")):
+            self._fail("sync", f"No SmartNotes store in {other_dir} (use --init to create one)",
+                       path=str(other_dir))
+            return False
+        other = SmartNotes(writer=self.writer, notes_dir=other_dir)
+        try:
+            return self._sync_with(other)
+        finally:
+            # Fsync the remote store's commits and drop its orphaned blobs
+            other.close()
+
+    def _sync_with(self, other):
+        """Exchange differing notes with the open store ``other``."""
+        dirty_local = self._ensure_uids()
+        dirty_remote = other._ensure_uids()
+        local, remote = self._sync_entries(), other._sync_entries()
+        local_tree = MerkleTree({uid: self._entry_digest(e) for uid, e in local.items()})
+        remote_tree = MerkleTree({uid: self._entry_digest(e) for uid, e in remote.items()})
+        differing, compared = local_tree.diff(remote_tree)
+
+        local_uids = {n["uid"]: n for n in self.notes}
+        remote_uids = {n["uid"]: n for n in other.notes}
+        # Running counters: _next_id() scans every note, once per call
+        next_local, next_remote = self._next_id(), other._next_id()
+        sent = received = conflicts = 0
+        for uid in differing:
+            mine, theirs = local.get(uid), remote.get(uid)
+            if mine is not None and theirs is not None:
+                conflicts += 1
+            if self._sync_rank(mine) > self._sync_rank(theirs):
+                next_remote = other._apply_sync_entry(_materialize(mine), remote_uids, next_remote)
+                sent += 1
+                dirty_remote = True
+            else:
+                next_local = self._apply_sync_entry(_materialize(theirs), local_uids, next_local)
+                received += 1
+                dirty_local = True
+
+        # Drop notes that were replaced by tombstones
+        for store in (self, other):
+            if len(store.notes) != len(store._by_id):
+                store.notes = [n for n in store.notes if store._by_id.get(n.get("id")) is n]
 
-        total_chars = sum(len(n.get("content", "")) for n in self.notes)
-        avg_length = total_chars // total_notes if total_notes > 0 else 0
+        if dirty_remote and not other.save_notes():
+            self._fail("sync", f"Could not save {other.notes_file}", path=str(other.notes_dir))
+            return False
+        if dirty_local and not self.save_notes():
+            return False
 
-        # Find most recent note
-        recent = max(self.notes, key=lambda x: x.get("created", ""))
+        self._ok("sync", f"Synced with {other.notes_dir}: sent {sent}, received {received}, "
+                         f"{conflicts} conflict(s) resolved ({compared} tree nodes compared)",
+                 path=str(other.notes_dir), sent=sent, received=received,
+                 conflicts=conflicts, compared=compared)
+        return True
+
+    @_reads
+    def get_stats(self, breakdown=False, top=10):
+        """Get statistics about notes.
+
+        Answered from the running aggregates in ``self.stats``, so the cost
+        does not depend on the number of notes. With ``breakdown``, also
+        show the ``top`` most used tags and notes per day.
+        """
+        stats = self.stats
+        if not stats.count:
+            self._report("No notes yet. Add one with: smartnotes add \"Your note here\"",
+                         type="stats", total_notes=0, total_tags=0, total_chars=0,
+                         average_length=0, most_recent=None, oldest=None,
+                         storage=str(self.notes_file))
+            return
+
+        if stats.stale:
+            stats.refresh_extremes(self.notes)
+
+        avg_length = stats.total_chars // stats.count
+        top_tags = sorted(stats.tags.items(), key=lambda item: (-item[1], item[0]))[:top]
+
+        if self.writer is not None:
+            record = {
+                "type": "stats",
+                "total_notes": stats.count,
+                "total_tags": len(stats.tags),
+                "total_chars": stats.total_chars,
+                "average_length": avg_length,
+                "most_recent": stats.newest,
+                "oldest": stats.oldest,
+                "storage": str(self.notes_file),
+            }
+            if breakdown:
+                record["top_tags"] = dict(top_tags)
+                record["per_day"] = dict(sorted(stats.days.items()))
+            self.writer.write(record)
+            return
 
         print(f"\n{'='*40}")
         print(f"  SmartNotes Statistics")
         print(f"{'='*40}")
-        print(f"Total notes:      {total_notes}")
-        print(f"Total tags:       {len(all_tags)}")
+        print(f"Total notes:      {stats.count}")
+        print(f"Total tags:       {len(stats.tags)}")
+        print(f"Total characters: {stats.total_chars}")
         print(f"Average length:   {avg_length} characters")
-        print(f"Most recent:      {recent['created'][:19]}")
+        print(f"Most recent:      {(stats.newest or '')[:19]}")
+        print(f"Oldest:           {(stats.oldest or '')[:19]}")
         print(f"Storage location: {self.notes_file}")
+
+        if breakdown:
+            print(f"\nTop tags:")
+            for tag, count in top_tags:
+                print(f"  #{tag} ({count})")
+            print(f"\nNotes per day:")
+            for day, count in sorted(stats.days.items()):
+                print(f"  {day}  {count}")
+
         print(f"{'='*40}\n")
 
 
@@ -365,60 +3685,178 @@ Examples:
   smartnotes add "Python tip: use list comprehensions" --tags python coding
   smartnotes list
   smartnotes list --tag important
+  smartnotes list --tag 'py*'
+  smartnotes tags --prefix py
   smartnotes search "Python"
+  smartnotes query "tag:python AND (deploy OR rollout) -tag:archived" --explain
   smartnotes show 5
+  smartnotes related 5
   smartnotes edit 5 "Updated note content"
+  smartnotes history 5
+  smartnotes revert 5 1
   smartnotes delete 5
+  smartnotes tag --where "tag:deploy created:<2026-01-01" archived
+  smartnotes replace "staging-db" "staging-db-2" --where "tag:ops"
   smartnotes export --format md --output my_notes.md
+  smartnotes import my_notes.md
+  smartnotes sync /mnt/laptop/.smartnotes
+  smartnotes watch --since 0 --ndjson
+  smartnotes dedupe --merge
   smartnotes stats
+  smartnotes list --tag important --ndjson
         """,
     )
 
+    # Output options shared by every command
+    output_parser = argparse.ArgumentParser(add_help=False)
+    output_group = output_parser.add_mutually_exclusive_group()
+    output_group.add_argument("--json", dest="output_mode", action="store_const", const="json",
+                              help="Emit structured records as a JSON array")
+    output_group.add_argument("--ndjson", dest="output_mode", action="store_const", const="ndjson",
+                              help="Emit structured records as newline-delimited JSON")
+
     subparsers = parser.add_subparsers(dest="command", help="Command to execute")
 
     # Add command
-    parser_add = subparsers.add_parser("add", help="Add a new note")
+    parser_add = subparsers.add_parser("add", help="Add a new note", parents=[output_parser])
     parser_add.add_argument("content", help="Note content")
     parser_add.add_argument("--tags", nargs="+", help="Additional tags")
+    parser_add.add_argument("--on-duplicate", choices=["flag", "merge", "off"],
+                            help="Handling of near-duplicate notes (default: config 'duplicates')")
 
     # List command
-    parser_list = subparsers.add_parser("list", help="List all notes")
-    parser_list.add_argument("--tag", help="Filter by tag")
+    parser_list = subparsers.add_parser("list", help="List all notes", parents=[output_parser])
+    parser_list.add_argument("--tag", help="Filter by tag ('py*' matches every tag starting with py)")
     parser_list.add_argument("--limit", type=int, help="Limit number of results")
 
     # Search command
-    parser_search = subparsers.add_parser("search", help="Search notes")
+    parser_search = subparsers.add_parser("search", help="Search notes", parents=[output_parser])
     parser_search.add_argument("term", help="Search term")
     parser_search.add_argument("--limit", type=int, help="Limit number of results")
 
+    # Query command
+    parser_query = subparsers.add_parser("query", help="Find notes with a boolean query",
+                                         parents=[output_parser])
+    parser_query.add_argument("expression",
+                              help="e.g. 'tag:python AND (deploy OR rollout) -tag:archived created:>2026-01-01'")
+    parser_query.add_argument("--limit", type=int, help="Limit number of results")
+    parser_query.add_argument("--explain", action="store_true",
+                              help="Show the query plan and its cardinalities")
+
     # Show command
-    parser_show = subparsers.add_parser("show", help="Show full note")
+    parser_show = subparsers.add_parser("show", help="Show full note", parents=[output_parser])
     parser_show.add_argument("id", type=int, help="Note ID")
 
+    # Related command
+    parser_related = subparsers.add_parser("related", help="Show notes similar to a note",
+                                           parents=[output_parser])
+    parser_related.add_argument("id", type=int, help="Note ID")
+    parser_related.add_argument("--limit", type=int, default=5, help="Number of related notes")
+
     # Edit command
-    parser_edit = subparsers.add_parser("edit", help="Edit a note")
+    parser_edit = subparsers.add_parser("edit", help="Edit a note", parents=[output_parser])
     parser_edit.add_argument("id", type=int, help="Note ID")
     parser_edit.add_argument("content", help="New content")
 
+    # Replace command
+    parser_replace = subparsers.add_parser("replace", help="Find and replace text across notes",
+                                           parents=[output_parser])
+    parser_replace.add_argument("find", help="Text to find")
+    parser_replace.add_argument("replacement", help="Replacement text")
+    parser_replace.add_argument("--ids", help="Only these notes, e.g. 1,4,10-20")
+    parser_replace.add_argument("--where", help="Only notes matching this query")
+    parser_replace.add_argument("--regex", action="store_true",
+                                help="Treat FIND as a regular expression")
+
+    # History command
+    parser_history = subparsers.add_parser("history", help="List the revisions of a note",
+                                           parents=[output_parser])
+    parser_history.add_argument("id", type=int, help="Note ID")
+    parser_history.add_argument("--rev", type=int, help="Print the full text of this revision")
+
+    # Revert command
+    parser_revert = subparsers.add_parser("revert", help="Restore an earlier revision of a note",
+                                          parents=[output_parser])
+    parser_revert.add_argument("id", type=int, help="Note ID")
+    parser_revert.add_argument("rev", type=int, help="Revision number (see 'history')")
+
     # Delete command
-    parser_delete = subparsers.add_parser("delete", help="Delete a note")
-    parser_delete.add_argument("id", type=int, help="Note ID")
+    parser_delete = subparsers.add_parser("delete", help="Delete notes", parents=[output_parser])
+    parser_delete.add_argument("id", nargs="?", help="Note ID(s), e.g. 5 or 1,4,10-20")
+    parser_delete.add_argument("--where", help="Delete every note matching this query")
 
     # Tag command
-    parser_tag = subparsers.add_parser("tag", help="Add tags to a note")
-    parser_tag.add_argument("id", type=int, help="Note ID")
+    parser_tag = subparsers.add_parser("tag", help="Add tags to notes", parents=[output_parser])
+    parser_tag.add_argument("id", nargs="?", help="Note ID(s), e.g. 5 or 1,4,10-20 (omit with --where)")
     parser_tag.add_argument("tags", nargs="+", help="Tags to add")
+    parser_tag.add_argument("--where", help="Tag every note matching this query")
+
+    # Untag command
+    parser_untag = subparsers.add_parser("untag", help="Remove tags from notes", parents=[output_parser])
+    parser_untag.add_argument("id", nargs="?", help="Note ID(s), e.g. 5 or 1,4,10-20 (omit with --where)")
+    parser_untag.add_argument("tags", nargs="+", help="Tags to remove")
+    parser_untag.add_argument("--where", help="Untag every note matching this query")
 
     # Tags command
-    subparsers.add_parser("tags", help="List all tags")
+    parser_tags = subparsers.add_parser("tags", help="List all tags", parents=[output_parser])
+    parser_tags.add_argument("--prefix", help="Only tags starting with this prefix")
+    parser_tags.add_argument("--names-only", action="store_true",
+                             help="Print bare tag names, one per line (for shell completion)")
+
+    # Completion command
+    parser_completion = subparsers.add_parser("completion", help="Print a shell completion script")
+    parser_completion.add_argument("shell", choices=["bash"], help="Shell to generate for")
+    parser_completion.add_argument("--prog", default="smartnotes",
+                                   help="Command name to complete (default: smartnotes)")
 
     # Export command
-    parser_export = subparsers.add_parser("export", help="Export notes")
-    parser_export.add_argument("--format", choices=["txt", "md", "json"], default="txt", help="Export format")
-    parser_export.add_argument("--output", help="Output filename")
+    parser_export = subparsers.add_parser("export", help="Export notes", parents=[output_parser])
+    parser_export.add_argument("--format", nargs="+", choices=list(EXPORT_FORMATS), default=["txt"],
+                               help="Export format(s); several are written in one run")
+    parser_export.add_argument("--output",
+                               help="Output filename (with several formats: a directory or base name)")
+    parser_export.add_argument("--workers", type=int, help="Formatting threads (default: one per CPU, up to 8)")
+
+    # Dedupe command
+    parser_dedupe = subparsers.add_parser("dedupe", help="Find near-duplicate notes",
+                                          parents=[output_parser])
+    parser_dedupe.add_argument("--threshold", type=float,
+                               help="Minimum similarity (0-1, default: config 'duplicate_threshold')")
+    parser_dedupe.add_argument("--merge", action="store_true",
+                               help="Merge each cluster into its oldest note")
+
+    # Import command
+    parser_import = subparsers.add_parser("import", help="Import notes from an export",
+                                          parents=[output_parser])
+    parser_import.add_argument("file", help="Export file (.txt, .md or .json)")
+    parser_import.add_argument("--format", choices=sorted(IMPORT_FORMATS),
+                               help="Export format (default: from file extension)")
+
+    # Sync command
+    parser_sync = subparsers.add_parser("sync", help="Two-way sync with another store directory",
+                                        parents=[output_parser])
+    parser_sync.add_argument("directory", help="Other store directory (e.g. a mounted ~/.smartnotes)")
+    parser_sync.add_argument("--init", action="store_true",
+                             help="Create the other store if it does not exist yet")
+
+    # Watch command
+    parser_watch = subparsers.add_parser("watch", help="Stream changes to the store as they happen",
+                                         parents=[output_parser])
+    parser_watch.add_argument("--since", type=int,
+                              help="Replay changes after this sequence number (default: only new ones)")
+    parser_watch.add_argument("--interval", type=float, default=1.0, help="Seconds between polls")
+    parser_watch.add_argument("--once", action="store_true",
+                              help="Print the pending changes and exit instead of following")
+
+    # Cache command
+    parser_cache = subparsers.add_parser("cache", help="Show query cache hit rate",
+                                         parents=[output_parser])
+    parser_cache.add_argument("--clear", action="store_true", help="Empty the cache and reset counters")
 
     # Stats command
-    subparsers.add_parser("stats", help="Show statistics")
+    parser_stats = subparsers.add_parser("stats", help="Show statistics", parents=[output_parser])
+    parser_stats.add_argument("--breakdown", action="store_true",
+                              help="Show top tags and notes per day")
 
     args = parser.parse_args()
 
@@ -426,10 +3864,33 @@ Examples:
         parser.print_help()
         return
 
-    notes = SmartNotes()
+    if args.command == "completion":
+        print(bash_completion(args.prog, sorted(subparsers.choices)))
+        return
 
+    writer = RecordWriter(args.output_mode) if args.output_mode else None
+    # stats.json answers `stats` by itself; other commands read the notes anyway
+    notes = SmartNotes(writer=writer, lazy=args.command == "stats")
+
+    try:
+        try:
+            _run_command(notes, args)
+        finally:
+            notes.close()
+            if writer is not None:
+                writer.close()
+    except BrokenPipeError:
+        # The reader went away (e.g. `| head -1`): send what is left, including
+        # the interpreter's final flush of stdout, to devnull instead
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(1)
+
+
+def _run_command(notes, args):
+    """Dispatch a parsed command to the SmartNotes instance."""
     if args.command == "add":
-        notes.add_note(args.content, args.tags)
+        notes.add_note(args.content, args.tags, on_duplicate=args.on_duplicate)
 
     elif args.command == "list":
         notes.list_notes(tag_filter=args.tag, limit=args.limit)
@@ -437,26 +3898,126 @@ Examples:
     elif args.command == "search":
         notes.list_notes(search_term=args.term, limit=args.limit)
 
+    elif args.command == "query":
+        notes.run_query(args.expression, limit=args.limit, explain=args.explain)
+
     elif args.command == "show":
         notes.show_note(args.id)
 
+    elif args.command == "related":
+        notes.show_related(args.id, k=args.limit)
+
     elif args.command == "edit":
         notes.edit_note(args.id, args.content)
 
     elif args.command == "delete":
-        notes.delete_note(args.id)
+        ids = _cli_ids(notes, "delete", args.id)
+        if ids is False:
+            return
+        if len(ids or ()) == 1 and not args.where:
+            notes.delete_note(ids[0])
+        else:
+            notes.delete_notes(ids=ids, where=args.where)
+
+    elif args.command in ("tag", "untag"):
+        tags = args.tags
+        if args.where and args.id is not None:
+            # With --where there is no ID argument: it was the first tag
+            ids, tags = None, [args.id] + tags
+        else:
+            ids = _cli_ids(notes, args.command, args.id)
+            if ids is False:
+                return
+            if ids is None and not args.where:
+                notes._fail(args.command, "Give note ID(s) or --where QUERY")
+                return
+        if args.command == "untag":
+            notes.untag_notes(tags, ids=ids, where=args.where)
+        elif len(ids or ()) == 1 and not args.where:
+            notes.tag_note(ids[0], tags)
+        else:
+            notes.tag_notes(tags, ids=ids, where=args.where)
 
-    elif args.command == "tag":
-        notes.tag_note(args.id, args.tags)
+    elif args.command == "history":
+        notes.show_history(args.id, rev=args.rev)
+
+    elif args.command == "revert":
+        notes.revert_note(args.id, args.rev)
+
+    elif args.command == "replace":
+        ids = _cli_ids(notes, "replace", args.ids)
+        if ids is False:
+            return
+        notes.replace_in_notes(args.find, args.replacement, ids=ids, where=args.where,
+                               regex=args.regex)
 
     elif args.command == "tags":
-        notes.list_tags()
+        notes.list_tags(prefix=args.prefix, names_only=args.names_only)
 
     elif args.command == "export":
-        notes.export_notes(format=args.format, output_file=args.output)
+        notes.export_notes(format=args.format, output_file=args.output, workers=args.workers)
+
+    elif args.command == "import":
+        notes.import_notes(args.file, format=args.format)
+
+    elif args.command == "sync":
+        notes.sync(args.directory, init=args.init)
+
+    elif args.command == "watch":
+        notes.watch(since=args.since, follow=not args.once, interval=args.interval)
+
+    elif args.command == "dedupe":
+        notes.dedupe(threshold=args.threshold, merge=args.merge)
+
+    elif args.command == "cache":
+        notes.show_cache(clear=args.clear)
 
     elif args.command == "stats":
-        notes.get_stats()
+        notes.get_stats(breakdown=args.breakdown)
+
+
+BASH_COMPLETION = """\
+_{func}_complete() {{
+    local cur prev
+    cur="${{COMP_WORDS[COMP_CWORD]}}"
+    prev="${{COMP_WORDS[COMP_CWORD-1]}}"
+    if [ "$COMP_CWORD" -eq 1 ]; then
+        COMPREPLY=($(compgen -W "{commands}" -- "$cur"))
+        return
+    fi
+    case "$prev" in
+        --tag|--tags)
+            COMPREPLY=($({prog} tags --names-only --prefix "${{cur#\\#}}" 2>/dev/null))
+            return
+            ;;
+    esac
+    case "${{COMP_WORDS[1]}}" in
+        tag|untag)
+            if [ "$COMP_CWORD" -ge 3 ] && [[ "$cur" != -* ]]; then
+                COMPREPLY=($({prog} tags --names-only --prefix "${{cur#\\#}}" 2>/dev/null))
+            fi
+            ;;
+    esac
+}}
+complete -F _{func}_complete {prog}
+"""
+
+
+def bash_completion(prog, commands):
+    """Bash completion script: commands, plus live tag names for tags."""
+    func = re.sub(r"\W", "_", prog)
+    return BASH_COMPLETION.format(func=func, prog=prog, commands=" ".join(commands))
+
+
+def _cli_ids(notes, action, spec):
+    """Parse an ID-list argument; reports and returns False if invalid."""
+    if spec is None:
+        return None
+    try:
+        return parse_id_spec(spec)
+    except ValueError as e:
+        notes._fail(action, str(e))
+        return False
 
 
 if __name__ == "__main__":
@@ -17,16 +17,26 @@ Run: python test_smartnotes.py
 import unittest
 import sys
 import os
+import io
+import hashlib
 import json
+import random
 import tempfile
 import shutil
+import subprocess
+import threading
+import time
+import tracemalloc
+from contextlib import redirect_stdout
 from pathlib import Path
 from datetime import datetime
 
 # Add parent directory to path for imports
 sys.path.insert(0, str(Path(__file__).parent))
 
-from smartnotes import SmartNotes
+import smartnotes
+from smartnotes import SmartNotes, RecordWriter, NoteStats, MinHashIndex
+from smartnotes import parse_query, QueryError, BlockStore, iter_json_array, MerkleTree, DurabilityPolicy
 
 
 class TestSmartNotesInitialization(unittest.TestCase):
@@ -393,6 +403,84 @@ class TestSmartNotesExport(unittest.TestCase):
         self.assertFalse(result)
 
 
+class TestSmartNotesParallelExport(unittest.TestCase):
+    """Test exporting several formats in one run."""
+
+    def setUp(self):
+        """Set up a store with notes created out of ID order."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.out_dir = Path(self.temp_dir) / "out"
+        self.out_dir.mkdir()
+        self.notes = SmartNotes(writer=RecordWriter("ndjson", stream=io.StringIO()),
+                                notes_dir=Path(self.temp_dir) / ".smartnotes")
+        for i in range(10):
+            self.notes.add_note(f"Parallel note {i} #export", on_duplicate="off")
+        for note in self.notes.notes:
+            note["created"] = f"2026-01-{30 - note['id']:02d}T00:00:00"
+
+    def tearDown(self):
+        """Clean up."""
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_all_formats_from_base_name(self):
+        """Test that a base name gets each format's extension."""
+        self.assertTrue(self.notes.export_notes(["txt", "md", "json", "ndjson"],
+                                                self.out_dir / "backup.json", chunk_size=3))
+        self.assertEqual(sorted(p.name for p in self.out_dir.iterdir()),
+                         ["backup.json", "backup.md", "backup.ndjson", "backup.txt"])
+        with open(self.out_dir / "backup.json", encoding="utf-8") as f:
+            exported = json.load(f)
+        with open(self.out_dir / "backup.ndjson", encoding="utf-8") as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(exported, lines)
+        self.assertEqual([n["id"] for n in exported], list(range(10, 0, -1)))
+
+    def test_chunked_matches_single_chunk(self):
+        """Test that chunks are concatenated in order."""
+        for fmt in ("txt", "md", "json"):
+            self.notes.export_notes(fmt, self.out_dir / f"one.{fmt}")
+            self.notes.export_notes(fmt, self.out_dir / f"many.{fmt}", workers=4, chunk_size=2)
+            one = (self.out_dir / f"one.{fmt}").read_text(encoding="utf-8")
+            many = (self.out_dir / f"many.{fmt}").read_text(encoding="utf-8")
+            self.assertEqual(one.splitlines()[3:], many.splitlines()[3:])
+
+    def test_rendered_chunks_are_bounded(self):
+        """Test that only a window of rendered chunks is held at once."""
+        body = "x" * 10000
+        self.notes.notes = [{"id": i, "content": body, "tags": [], "created": f"2026-01-01T{i:06d}"}
+                            for i in range(1, 2001)]
+        tracemalloc.start()
+        try:
+            self.assertTrue(self.notes.export_notes(["txt", "ndjson"], self.out_dir / "big",
+                                                    workers=2, chunk_size=10))
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        # Each format renders about 20 MB in total
+        self.assertLess(peak, 5 * 1024 * 1024)
+        with open(self.out_dir / "big.ndjson", encoding="utf-8") as f:
+            self.assertEqual(sum(1 for _ in f), 2000)
+
+    def test_directory_output(self):
+        """Test that a directory receives timestamped files."""
+        self.assertTrue(self.notes.export_notes(["md", "ndjson"], self.out_dir))
+        self.assertEqual(sorted(p.suffix for p in self.out_dir.iterdir()), [".md", ".ndjson"])
+
+    def test_invalid_format_writes_nothing(self):
+        """Test that one bad format rejects the whole export."""
+        self.assertFalse(self.notes.export_notes(["txt", "pdf"], self.out_dir / "x"))
+        self.assertEqual(list(self.out_dir.iterdir()), [])
+
+    def test_failed_target_reported(self):
+        """Test that a failing target does not stop the others."""
+        self.notes.writer = RecordWriter("ndjson", stream=io.StringIO())
+        (self.out_dir / "taken.txt").mkdir()
+        self.assertFalse(self.notes.export_notes(["txt", "json"], self.out_dir / "taken"))
+        self.notes.writer.flush()
+        records = [json.loads(line) for line in self.notes.writer.stream.getvalue().splitlines()]
+        self.assertEqual([(r["format"], r["ok"]) for r in records], [("txt", False), ("json", True)])
+
+
 class TestSmartNotesStats(unittest.TestCase):
     """Test statistics functionality."""
 
@@ -420,6 +508,1659 @@ class TestSmartNotesStats(unittest.TestCase):
         self.notes.get_stats()
 
 
+class TestSmartNotesRunningStats(unittest.TestCase):
+    """Test incrementally maintained statistics."""
+
+    def setUp(self):
+        """Set up test environment with a few notes."""
+        self.temp_dir = tempfile.mkdtemp()
+        os.environ['HOME'] = self.temp_dir
+        os.environ['USERPROFILE'] = self.temp_dir
+        self.notes = SmartNotes()
+        self.notes.add_note("First note #alpha")
+        self.notes.add_note("Second note #beta")
+        self.notes.add_note("Third note #alpha #gamma")
+
+    def tearDown(self):
+        """Clean up."""
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def assertStatsConsistent(self, notes):
+        """Running stats must equal a full recomputation."""
+        expected = NoteStats.from_notes(notes.notes).to_dict()
+        if notes.stats.stale:
+            notes.stats.refresh_extremes(notes.notes)
+        self.assertEqual(notes.stats.to_dict(), expected)
+
+    def test_stats_track_mutations(self):
+        """Test that add, edit, tag and delete keep stats consistent."""
+        self.notes.edit_note(2, "Second note rewritten #delta")
+        self.notes.tag_note(1, ["extra"])
+        self.notes.delete_note(3)
+        self.assertStatsConsistent(self.notes)
+        self.assertEqual(self.notes.stats.count, 2)
+        self.assertNotIn("gamma", self.notes.stats.tags)
+
+    def test_delete_newest_refreshes_extremes(self):
+        """Test that removing the newest note updates the newest timestamp."""
+        self.notes.delete_note(3)
+        self.assertEqual(self.notes.stats.newest, self.notes.notes[-1]["created"])
+
+    def test_stats_persist_across_sessions(self):
+        """Test that a new session reuses the saved aggregates."""
+        notes2 = SmartNotes()
+        self.assertEqual(notes2.stats.to_dict(), self.notes.stats.to_dict())
+
+    def test_stats_rebuilt_when_store_changes_externally(self):
+        """Test that stats are rebuilt if notes.json was modified elsewhere."""
+        with open(self.notes.notes_file, "w", encoding="utf-8") as f:
+            json.dump(self.notes.notes[:1], f)
+        notes2 = SmartNotes()
+        self.assertEqual(notes2.stats.count, 1)
+        self.assertStatsConsistent(notes2)
+
+    def test_lazy_stats_skip_loading_notes(self):
+        """Test that a lazy session answers stats from stats.json alone."""
+        stream = io.StringIO()
+        notes2 = SmartNotes(writer=RecordWriter("ndjson", stream=stream), lazy=True)
+        notes2.get_stats()
+        notes2.close()
+        notes2.writer.flush()
+        self.assertNotIn("notes", vars(notes2))
+        self.assertEqual(json.loads(stream.getvalue())["total_notes"], 3)
+
+    def test_lazy_session_loads_notes_on_use(self):
+        """Test that a lazy session reads the store when notes are needed."""
+        notes2 = SmartNotes(lazy=True)
+        self.assertEqual(notes2.get_note_by_id(2)["content"], "Second note #beta")
+        notes2.add_note("Fourth note #alpha")
+        self.assertEqual(notes2.stats.count, 4)
+        self.assertStatsConsistent(notes2)
+
+    def test_lazy_stats_rebuilt_when_store_changes_externally(self):
+        """Test that a lazy session reads the notes if stats.json is out of date."""
+        with open(self.notes.notes_file, "w", encoding="utf-8") as f:
+            json.dump(self.notes.notes[:1], f)
+        notes2 = SmartNotes(lazy=True)
+        self.assertIn("notes", vars(notes2))
+        self.assertEqual(notes2.stats.count, 1)
+
+
+class TestSmartNotesDuplicates(unittest.TestCase):
+    """Test near-duplicate detection."""
+
+    LOG = "Deploy failed on host alpha: connection refused by database server"
+
+    def setUp(self):
+        """Set up test environment."""
+        self.temp_dir = tempfile.mkdtemp()
+        os.environ['HOME'] = self.temp_dir
+        os.environ['USERPROFILE'] = self.temp_dir
+        self.notes = SmartNotes()
+        self.notes.add_note(self.LOG)
+
+    def tearDown(self):
+        """Clean up."""
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_signature_similarity(self):
+        """Test that similar texts have similar signatures."""
+        sig_a = MinHashIndex.signature(self.LOG)
+        sig_b = MinHashIndex.signature(self.LOG + " again")
+        sig_c = MinHashIndex.signature("Completely unrelated grocery shopping list for the weekend")
+        self.assertGreater(MinHashIndex.similarity(sig_a, sig_b), 0.6)
+        self.assertLess(MinHashIndex.similarity(sig_a, sig_c), 0.2)
+
+    def test_flag_adds_note(self):
+        """Test that flag mode still adds the duplicate."""
+        self.assertTrue(self.notes.add_note(self.LOG, on_duplicate="flag"))
+        self.assertEqual(len(self.notes.notes), 2)
+
+    def test_merge_folds_tags(self):
+        """Test that merge mode updates the existing note instead of adding."""
+        self.assertTrue(self.notes.add_note(self.LOG, tags=["incident"], on_duplicate="merge"))
+        self.assertEqual(len(self.notes.notes), 1)
+        self.assertIn("incident", self.notes.notes[0]["tags"])
+
+    def test_distinct_note_not_merged(self):
+        """Test that unrelated notes are added normally in merge mode."""
+        self.notes.add_note("Buy milk and eggs at the store", on_duplicate="merge")
+        self.assertEqual(len(self.notes.notes), 2)
+
+    def test_dedupe_clusters(self):
+        """Test that dedupe finds clusters across the store."""
+        self.notes.add_note("Unrelated note about gardening tomatoes")
+        self.notes.add_note(self.LOG)
+        self.assertEqual(self.notes.find_duplicates(), [[1, 3]])
+
+    def test_dedupe_merge_keeps_oldest(self):
+        """Test that dedupe --merge keeps the oldest note of each cluster."""
+        self.notes.add_note(self.LOG, tags=["later"])
+        self.notes.dedupe(merge=True)
+        self.assertEqual([n["id"] for n in self.notes.notes], [1])
+        self.assertIn("later", self.notes.notes[0]["tags"])
+        self.assertEqual(self.notes.stats.count, 1)
+
+    def test_index_persists(self):
+        """Test that signatures are written on close and reused by a new session."""
+        self.notes.add_note(self.LOG)
+        self.notes.close()
+        notes2 = SmartNotes()
+        self.assertIsNotNone(notes2._read_sidecar(notes2.minhash_file))
+        self.assertEqual(notes2.minhash.signatures, self.notes.minhash.signatures)
+
+    def test_punctuation_only_not_duplicate(self):
+        """Test that notes without words are never treated as duplicates."""
+        self.notes.add_note("!!!")
+        self.assertTrue(self.notes.add_note("???", on_duplicate="merge"))
+        self.assertEqual([n["content"] for n in self.notes.notes][-2:], ["!!!", "???"])
+        self.assertEqual(self.notes.find_duplicates(), [])
+
+    def test_retag_keeps_signature(self):
+        """Test that tag changes do not recompute MinHash signatures."""
+        self.notes.minhash
+        original = MinHashIndex.signature
+        calls = []
+        MinHashIndex.signature = classmethod(lambda cls, text: calls.append(text) or original(text))
+        try:
+            self.notes.tag_notes(["incident"], ids=[1])
+            self.notes.tag_note(1, ["more"])
+        finally:
+            MinHashIndex.signature = original
+        self.assertEqual(calls, [])
+        self.assertIn(1, self.notes.minhash.signatures)
+
+    def test_mutation_leaves_unloaded_index_alone(self):
+        """Test that mutations do not load the index or rewrite its sidecar."""
+        self.notes.close()
+        before = os.stat(self.notes.minhash_file).st_mtime_ns
+        notes2 = SmartNotes()
+        notes2.tag_note(1, ["quiet"])
+        notes2.close()
+        self.assertIsNone(notes2._minhash)
+        self.assertEqual(os.stat(notes2.minhash_file).st_mtime_ns, before)
+        self.assertIsNone(notes2._read_sidecar(notes2.minhash_file))
+        self.assertIn(1, SmartNotes().minhash.signatures)
+
+    def test_sidecar_from_newer_store_ignored(self):
+        """Test that a session ignores signatures saved by a later writer."""
+        self.notes.close()
+        stale = SmartNotes()
+        other = SmartNotes()
+        other.add_note("Kafka consumer lag keeps growing on the billing topic")
+        other.minhash
+        other.close()
+        self.assertIsNone(stale._read_sidecar(stale.minhash_file))
+        self.assertTrue(stale.add_note("Kafka consumer lag keeps growing on the billing topic",
+                                       on_duplicate="merge"))
+        self.assertEqual(len(stale.notes), 2)
+        self.assertEqual(stale.find_duplicates(), [])
+
+    def test_ids_not_reused_after_delete(self):
+        """Test that new notes never reuse an existing ID."""
+        self.notes.add_note("Second note")
+        self.notes.delete_note(1)
+        self.notes.add_note("Third note")
+        ids = [n["id"] for n in self.notes.notes]
+        self.assertEqual(len(ids), len(set(ids)))
+
+
+class TestSmartNotesRelated(unittest.TestCase):
+    """Test the related-notes similarity engine."""
+
+    def setUp(self):
+        """Set up test environment with related and unrelated notes."""
+        self.temp_dir = tempfile.mkdtemp()
+        os.environ['HOME'] = self.temp_dir
+        os.environ['USERPROFILE'] = self.temp_dir
+        self.notes = SmartNotes()
+        self.notes.add_note("Kubernetes rollout stuck waiting for pods #deploy")
+        self.notes.add_note("Rollback the kubernetes deployment when pods crash #deploy")
+        self.notes.add_note("Grandma's apple pie recipe needs cinnamon #baking")
+        self.notes.add_note("Pie crust tips: keep butter cold #baking")
+
+    def tearDown(self):
+        """Clean up."""
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_related_ranks_similar_first(self):
+        """Test that the most similar note is ranked first."""
+        related = self.notes.related_notes(1, k=2)
+        self.assertEqual(related[0][0]["id"], 2)
+        self.assertNotIn(1, [note["id"] for note, _ in related])
+
+    def test_related_limit(self):
+        """Test that k limits the number of results."""
+        self.assertEqual(len(self.notes.related_notes(3, k=1)), 1)
+
+    def test_related_updates_on_edit(self):
+        """Test that a loaded index is updated in place when a note is edited."""
+        self.notes.related_notes(3)
+        index = self.notes.similarity
+        self.notes.edit_note(4, "Kubernetes pods rollout checklist #deploy")
+        ids = [note["id"] for note, _ in self.notes.related_notes(3)]
+        self.assertIs(self.notes.similarity, index)
+        self.assertNotIn(4, ids)
+
+    def test_unused_index_not_loaded(self):
+        """Test that adding notes never loads or writes the vectors."""
+        self.notes.add_note("Another pie recipe #baking")
+        self.notes.close()
+        self.assertIsNone(self.notes._similarity)
+        self.assertFalse(self.notes.vectors_file.exists())
+        self.assertIn(5, SmartNotes().similarity.vectors)
+
+    def test_related_missing_note(self):
+        """Test related for a note that doesn't exist."""
+        self.assertFalse(self.notes.show_related(999))
+        self.assertEqual(self.notes.related_notes(999), [])
+
+    def test_vectors_persist(self):
+        """Test that a new session reuses the vectors saved on close."""
+        self.notes.related_notes(1)
+        self.notes.close()
+        notes2 = SmartNotes()
+        self.assertIsNotNone(notes2._read_sidecar(notes2.vectors_file))
+        self.assertEqual(notes2.similarity.vectors, self.notes.similarity.vectors)
+
+    def test_sidecar_from_newer_store_ignored(self):
+        """Test that related never returns notes this session has not loaded."""
+        self.notes.close()
+        stale = SmartNotes()
+        other = SmartNotes()
+        other.add_note("Kubernetes rollout stuck again, pods pending #deploy")
+        other.related_notes(1)
+        other.close()
+        related = stale.related_notes(1)
+        self.assertTrue(related)
+        self.assertNotIn(None, [note for note, _ in related])
+        self.assertNotIn(5, stale.similarity.vectors)
+
+    @unittest.skipIf(smartnotes.np is None, "NumPy not installed")
+    def test_numpy_matches_pure_python(self):
+        """Test that vectorized and pure-Python scoring agree."""
+        vectorized = self.notes.similarity.related(1, k=3)
+        original_np = smartnotes.np
+        smartnotes.np = None
+        try:
+            plain = self.notes.similarity.related(1, k=3)
+        finally:
+            smartnotes.np = original_np
+        self.assertEqual([i for i, _ in vectorized], [i for i, _ in plain])
+        for (_, a), (_, b) in zip(vectorized, plain):
+            self.assertAlmostEqual(a, b)
+
+
+class TestSmartNotesQuery(unittest.TestCase):
+    """Test the boolean query language and planner."""
+
+    def setUp(self):
+        """Set up test environment with tagged notes."""
+        self.temp_dir = tempfile.mkdtemp()
+        os.environ['HOME'] = self.temp_dir
+        os.environ['USERPROFILE'] = self.temp_dir
+        self.notes = SmartNotes()
+        self.notes.add_note("Deploy the api service #python")
+        self.notes.add_note("Rollout plan for the worker #python #archived")
+        self.notes.add_note("Rollout checklist #ops")
+        self.notes.add_note("Python packaging notes #python")
+        self.notes.notes[0]["created"] = "2025-12-31T10:00:00"
+
+    def tearDown(self):
+        """Clean up."""
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def ids(self, expression):
+        """Return sorted IDs matching an expression."""
+        return sorted(n["id"] for n in self.notes.query_notes(expression))
+
+    def test_parse_precedence(self):
+        """Test that AND binds tighter than OR and '-' negates."""
+        tree = parse_query("tag:a b OR -c")
+        self.assertEqual(tree, ("or", [("and", [("tag", "a"), ("text", "b")]),
+                                       ("not", ("text", "c"))]))
+
+    def test_parse_errors(self):
+        """Test that malformed queries raise QueryError."""
+        for bad in ["", "(tag:a", "tag:a )", "created:>yesterday", 'say "hi', "tag:"]:
+            with self.assertRaises(QueryError):
+                parse_query(bad)
+
+    def test_combined_query(self):
+        """Test tag, text, negation and grouping together."""
+        self.assertEqual(self.ids("tag:python AND (deploy OR rollout) -tag:archived"), [1])
+
+    def test_or_of_tags(self):
+        """Test a union of posting lists."""
+        self.assertEqual(self.ids("tag:ops OR tag:archived"), [2, 3])
+
+    def test_date_filter(self):
+        """Test created date comparisons."""
+        self.assertEqual(self.ids("tag:python created:>=2026-01-01"), [2, 4])
+        self.assertEqual(self.ids("created:<2026"), [1])
+
+    def test_pure_negation(self):
+        """Test a query made only of a negation."""
+        self.assertEqual(self.ids("-tag:python"), [3])
+
+    def test_phrase(self):
+        """Test quoted phrase matching."""
+        self.assertEqual(self.ids('"rollout plan"'), [2])
+
+    def test_explain_orders_smallest_posting_first(self):
+        """Test that the planner intersects the smallest posting list first."""
+        _, plan = self.notes.query_notes("tag:python tag:archived rollout", explain=True)
+        steps = [(child.kind, child.node) for child in plan.children]
+        self.assertEqual(steps[0], ("index", ("tag", "archived")))
+        self.assertEqual(steps[1], ("index", ("tag", "python")))
+        self.assertEqual(steps[2][0], "filter")
+        self.assertEqual(plan.actual, 1)
+
+    def test_run_query_invalid(self):
+        """Test that run_query reports invalid queries."""
+        self.assertFalse(self.notes.run_query("(broken"))
+
+
+class TestSmartNotesCompressedStorage(unittest.TestCase):
+    """Test the block-compressed storage format."""
+
+    def setUp(self):
+        """Set up test environment configured for compressed storage."""
+        self.temp_dir = tempfile.mkdtemp()
+        os.environ['HOME'] = self.temp_dir
+        os.environ['USERPROFILE'] = self.temp_dir
+        self.notes_dir = Path(self.temp_dir) / ".smartnotes"
+        self.notes_dir.mkdir()
+        self.write_config({"storage": "compressed", "block_size": 2})
+
+    def tearDown(self):
+        """Clean up."""
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def write_config(self, config):
+        """Write config.json."""
+        with open(self.notes_dir / "config.json", "w") as f:
+            json.dump(config, f)
+
+    def test_block_store_round_trip(self):
+        """Test that both codecs round-trip notes and single-note reads."""
+        notes = [{"id": i, "content": f"log line {i} " * 20, "tags": []} for i in range(1, 8)]
+        for codec in BlockStore.CODECS:
+            store = BlockStore(self.notes_dir / f"test-{codec}.blk", codec=codec, block_size=3)
+            with open(store.path, "wb") as f:
+                store.write(notes, f)
+            self.assertEqual(store.read_all(), notes)
+            self.assertEqual(store.read_note(5), notes[4])
+            self.assertIsNone(store.read_note(99))
+
+    def test_rejects_foreign_file(self):
+        """Test that a non-block file is rejected."""
+        path = self.notes_dir / "bogus.blk"
+        path.write_bytes(b"x" * 64)
+        with self.assertRaises(ValueError):
+            BlockStore(path).read_all()
+
+    def test_compressed_session_round_trip(self):
+        """Test that notes persist in the compressed store."""
+        notes = SmartNotes()
+        for i in range(5):
+            notes.add_note(f"Compressed note number {i} #blk")
+        self.assertTrue((self.notes_dir / "notes.blk").exists())
+        self.assertFalse((self.notes_dir / "notes.json").exists())
+
+        notes2 = SmartNotes()
+        self.assertEqual(notes2.notes, notes.notes)
+        self.assertEqual(notes2.read_note(4)["content"], "Compressed note number 3 #blk")
+
+    def test_migrates_from_json(self):
+        """Test switching an existing JSON store to compressed storage."""
+        self.write_config({})
+        SmartNotes().add_note("Written as JSON")
+        self.write_config({"storage": "compressed", "compression": "lzma"})
+
+        notes = SmartNotes()
+        self.assertEqual(notes.notes[0]["content"], "Written as JSON")
+        notes.add_note("Written compressed")
+        self.assertTrue((self.notes_dir / "notes.json.bak").exists())
+        self.assertEqual(len(SmartNotes().notes), 2)
+
+
+class TestSmartNotesImport(unittest.TestCase):
+    """Test importing exports back into a store."""
+
+    TRICKY = "Line one\n\n---\n\nNote #7\n" + "-" * 60 + "\n## Note #8\ntrailing\n"
+
+    def setUp(self):
+        """Set up a source store with a few notes."""
+        self.temp_dir = tempfile.mkdtemp()
+        os.environ['HOME'] = self.temp_dir
+        os.environ['USERPROFILE'] = self.temp_dir
+        self.source = SmartNotes()
+        self.source.add_note("First #alpha")
+        self.source.add_note(self.TRICKY, tags=["tricky"])
+        self.source.add_note("Third note\nwith two lines #beta")
+        self.source.delete_note(1)
+
+    def tearDown(self):
+        """Clean up."""
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def export_and_import(self, fmt):
+        """Export the source store and import it into a fresh one."""
+        export_file = str(Path(self.temp_dir) / f"export.{fmt}")
+        self.source.export_notes(format=fmt, output_file=export_file)
+        target_home = Path(self.temp_dir) / f"target-{fmt}"
+        target_home.mkdir()
+        os.environ['HOME'] = str(target_home)
+        os.environ['USERPROFILE'] = str(target_home)
+        target = SmartNotes()
+        self.assertTrue(target.import_notes(export_file))
+        return target
+
+    def assertImported(self, target, exact_timestamps):
+        """Imported notes must match the source."""
+        self.assertEqual([n["id"] for n in target.notes], [2, 3])
+        for original in self.source.notes:
+            imported = target.get_note_by_id(original["id"])
+            self.assertEqual(imported["content"], original["content"])
+            self.assertEqual(sorted(imported["tags"]), sorted(original["tags"]))
+            expected = original["created"] if exact_timestamps else original["created"][:19]
+            self.assertEqual(imported["created"], expected)
+        self.assertEqual(target.stats.count, 2)
+
+    def test_import_txt(self):
+        """Test round-tripping a plain-text export."""
+        self.assertImported(self.export_and_import("txt"), exact_timestamps=False)
+
+    def test_import_markdown(self):
+        """Test round-tripping a Markdown export."""
+        self.assertImported(self.export_and_import("md"), exact_timestamps=False)
+
+    def test_import_json(self):
+        """Test round-tripping a JSON export."""
+        target = self.export_and_import("json")
+        self.assertImported(target, exact_timestamps=True)
+        self.assertEqual(target.notes, self.source.notes)
+
+    def test_conflicting_ids_renumbered(self):
+        """Test that IDs already in use get fresh IDs."""
+        export_file = str(Path(self.temp_dir) / "export.json")
+        self.source.export_notes(format="json", output_file=export_file)
+        self.assertTrue(self.source.import_notes(export_file))
+        ids = [n["id"] for n in self.source.notes]
+        self.assertEqual(ids, [2, 3, 4, 5])
+
+    def test_malformed_import_rolls_back(self):
+        """Test that a failed import leaves the store untouched."""
+        bad_file = Path(self.temp_dir) / "bad.json"
+        bad_file.write_text('[{"id": 50, "content": "ok"}, {"id": 51, "content": ', encoding="utf-8")
+        self.assertFalse(self.source.import_notes(bad_file))
+        self.assertEqual([n["id"] for n in self.source.notes], [2, 3])
+        self.assertIsNone(self.source.get_note_by_id(50))
+        self.assertNotIn("import", [e["op"] for e in self.source.iter_changes()])
+
+    def test_import_records_one_change_event(self):
+        """Test that an import adds a single summary event to the change feed."""
+        export_file = str(Path(self.temp_dir) / "export.json")
+        self.source.export_notes(format="json", output_file=export_file)
+        before = self.source.changes.last_seq()
+        self.assertTrue(self.source.import_notes(export_file))
+        events = list(self.source.iter_changes(since=before))
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]["op"], "import")
+        self.assertEqual((events[0]["count"], events[0]["ids"]), (2, [[4, 5]]))
+        self.assertNotIn("note", events[0])
+
+    def test_import_keeps_tag_case(self):
+        """Test that imported tags keep their case, as explicit tags do on add."""
+        source_file = Path(self.temp_dir) / "tags.json"
+        source_file.write_text(json.dumps([{"content": "Tagged", "tags": ["ProjectX", "urgent"]}]),
+                               encoding="utf-8")
+        self.assertTrue(self.source.import_notes(source_file))
+        self.assertEqual(self.source.notes[-1]["tags"], ["ProjectX", "urgent"])
+
+    def test_iter_json_array_small_chunks(self):
+        """Test streaming parse across chunk boundaries."""
+        data = [{"id": i, "content": "x" * i} for i in range(50)] + [12345, "tail"]
+        items = list(iter_json_array(io.StringIO(json.dumps(data, indent=2)), chunk_size=7))
+        self.assertEqual(items, data)
+
+
+class TestSmartNotesSync(unittest.TestCase):
+    """Test syncing two stores."""
+
+    def setUp(self):
+        """Set up two independent stores."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.dir_a = Path(self.temp_dir) / "a"
+        self.dir_b = Path(self.temp_dir) / "b"
+        self.a = SmartNotes(notes_dir=self.dir_a)
+        self.b = SmartNotes(notes_dir=self.dir_b)
+
+    def tearDown(self):
+        """Clean up."""
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def contents(self, store):
+        """Map uid -> content for a store (reloaded from disk)."""
+        fresh = SmartNotes(notes_dir=store.notes_dir)
+        return {n["uid"]: n["content"] for n in fresh.notes}
+
+    def sync(self, init=False):
+        """Sync a with b and reload b."""
+        self.assertTrue(self.a.sync(self.dir_b, init=init))
+        self.b = SmartNotes(notes_dir=self.dir_b)
+
+    def test_sync_closes_remote_store(self):
+        """Test that the remote store is closed (and its commits fsynced) after a sync."""
+        self.a.add_note("From host A")
+        self.b.add_note("From host B")
+        closed = []
+        original = SmartNotes.close
+        SmartNotes.close = lambda store: closed.append(store.notes_dir) or original(store)
+        try:
+            self.sync()
+        finally:
+            SmartNotes.close = original
+        self.assertEqual(closed, [self.dir_b])
+
+    def test_sync_requires_existing_store(self):
+        """Test that a path without a store is rejected unless init is set."""
+        self.a.add_note("From host A")
+        typo = Path(self.temp_dir) / "typo_dir"
+        self.assertFalse(self.a.sync(typo))
+        self.assertFalse(typo.exists())
+        self.assertTrue(self.a.sync(typo, init=True))
+        self.assertEqual(len(SmartNotes(notes_dir=typo).notes), 1)
+
+    def test_colliding_ids_renumbered_in_one_pass(self):
+        """Test that received notes get fresh IDs without rescanning the store."""
+        for i in range(30):
+            self.a.add_note(f"Host A note {i}", on_duplicate="off")
+            self.b.add_note(f"Host B note {i}", on_duplicate="off")
+        calls = []
+        original = SmartNotes._next_id
+        SmartNotes._next_id = lambda store: calls.append(1) or original(store)
+        try:
+            self.sync()
+        finally:
+            SmartNotes._next_id = original
+        self.assertLessEqual(len(calls), 2)
+        for store in (self.a, self.b):
+            ids = [n["id"] for n in SmartNotes(notes_dir=store.notes_dir).notes]
+            self.assertEqual(sorted(ids), list(range(1, 61)))
+
+    def test_remote_messages_use_structured_output(self):
+        """Test that the remote store reports through the caller's writer."""
+        self.a.add_note("From host A")
+        (self.dir_b / "notes.json").write_text('{"broken": true}', encoding="utf-8")
+        self.a.writer = RecordWriter("ndjson", stream=io.StringIO())
+        printed = io.StringIO()
+        with redirect_stdout(printed):
+            self.assertTrue(self.a.sync(self.dir_b))
+        self.a.writer.flush()
+        types = [json.loads(line)["type"] for line in self.a.writer.stream.getvalue().splitlines()]
+        self.assertEqual(printed.getvalue(), "")
+        self.assertEqual(types, ["warning", "result"])
+
+    def test_notes_get_uid_and_version(self):
+        """Test that new notes carry a UID and a version that bumps on edit."""
+        self.a.add_note("Versioned note")
+        note = self.a.notes[0]
+        self.assertEqual(len(note["uid"]), 32)
+        self.assertEqual(note["version"], 1)
+        self.a.edit_note(1, "Versioned note, edited")
+        self.assertEqual(note["version"], 2)
+
+    def test_sync_copies_both_ways(self):
+        """Test that notes from each side reach the other."""
+        self.a.add_note("From host A")
+        self.b.add_note("From host B")
+        self.sync()
+        self.assertEqual(self.contents(self.a), self.contents(self.b))
+        self.assertEqual(len(self.b.notes), 2)
+
+    def test_sync_propagates_edits_and_deletes(self):
+        """Test that edits and deletions propagate."""
+        self.a.add_note("Keep me")
+        self.a.add_note("Delete me")
+        self.sync(init=True)
+        self.b.edit_note(1, "Keep me, edited on B")
+        self.a.delete_note(2)
+        self.assertTrue(self.a.sync(self.dir_b))
+        self.b = SmartNotes(notes_dir=self.dir_b)
+        self.a = SmartNotes(notes_dir=self.dir_a)
+        self.assertEqual([n["content"] for n in self.a.notes], ["Keep me, edited on B"])
+        self.assertEqual([n["content"] for n in self.b.notes], ["Keep me, edited on B"])
+
+    def test_concurrent_edits_converge(self):
+        """Test deterministic resolution of same-version conflicts."""
+        self.a.add_note("Shared note")
+        self.sync(init=True)
+        self.a.edit_note(1, "Edited on A")
+        self.b.edit_note(1, "Edited on B")
+        self.sync()
+        self.assertEqual(self.contents(self.a), self.contents(self.b))
+        # A second sync has nothing left to exchange
+        stream = io.StringIO()
+        self.a.writer = RecordWriter("ndjson", stream=stream)
+        self.a.sync(self.dir_b)
+        self.a.writer.flush()
+        result = json.loads(stream.getvalue())
+        self.assertEqual((result["sent"], result["received"]), (0, 0))
+
+    def test_legacy_notes_get_uids(self):
+        """Test that notes without UIDs are assigned one on sync."""
+        self.a.notes_file.write_text(json.dumps([
+            {"id": 1, "content": "Legacy", "tags": [], "created": "2025-01-01T00:00:00",
+             "modified": "2025-01-01T00:00:00"}]), encoding="utf-8")
+        self.a = SmartNotes(notes_dir=self.dir_a)
+        self.sync(init=True)
+        self.assertEqual(self.b.notes[0]["content"], "Legacy")
+        self.assertEqual(self.b.notes[0]["uid"], SmartNotes(notes_dir=self.dir_a).notes[0]["uid"])
+
+    def test_merkle_diff_is_sublinear(self):
+        """Test that one difference among many needs few node comparisons."""
+        uids = [hashlib.md5(str(i).encode()).hexdigest() for i in range(5000)]
+        digests = {uid: MerkleTree.digest(uid) for uid in uids}
+        changed = dict(digests)
+        some_uid = sorted(digests)[1234]
+        changed[some_uid] ^= 1
+        differing, compared = MerkleTree(digests).diff(MerkleTree(changed))
+        self.assertEqual(differing, [some_uid])
+        self.assertLess(compared, 200)
+
+
+class TestSmartNotesDurability(unittest.TestCase):
+    """Test durability modes for commits."""
+
+    def setUp(self):
+        """Set up test environment."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.notes_dir = Path(self.temp_dir) / ".smartnotes"
+
+    def tearDown(self):
+        """Clean up."""
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def make_store(self, mode, **extra):
+        """Create a store configured with the given durability mode."""
+        self.notes_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.notes_dir / "config.json", "w") as f:
+            json.dump({"durability": mode, **extra}, f)
+        return SmartNotes(notes_dir=self.notes_dir)
+
+    def test_default_mode_is_batched(self):
+        """Test that stores default to batched durability."""
+        notes = SmartNotes(notes_dir=self.notes_dir)
+        self.assertEqual(notes.durability.mode, "batched")
+
+    def test_invalid_mode_rejected(self):
+        """Test that the policy rejects unknown modes."""
+        with self.assertRaises(ValueError):
+            DurabilityPolicy("sometimes")
+
+    def test_invalid_config_falls_back(self):
+        """Test that an unknown configured mode falls back to batched."""
+        notes = self.make_store("sometimes")
+        self.assertEqual(notes.durability.mode, "batched")
+
+    def test_strict_leaves_nothing_pending(self):
+        """Test that strict mode syncs every commit."""
+        notes = self.make_store("strict")
+        notes.add_note("Strict note")
+        self.assertEqual(notes.durability.pending, set())
+
+    def test_batched_syncs_after_batch_ops(self):
+        """Test that batched mode fsyncs once the op budget is used up."""
+        notes = self.make_store("batched", durability_batch_ops=3, durability_batch_ms=60000)
+        notes.add_note("One")
+        notes.add_note("Two")
+        self.assertIn(notes.notes_file, notes.durability.pending)
+        notes.add_note("Three")
+        self.assertNotIn(notes.notes_file, notes.durability.pending)
+
+    def test_relaxed_never_fsyncs(self):
+        """Test that relaxed mode leaves write-back to the OS, even on close."""
+        notes = self.make_store("relaxed")
+        original, calls = os.fsync, []
+        os.fsync = lambda fd: calls.append(fd)
+        try:
+            for i in range(5):
+                notes.add_note(f"Relaxed {i}")
+            notes.close()
+        finally:
+            os.fsync = original
+        self.assertEqual(calls, [])
+        self.assertEqual(notes.durability.pending, set())
+
+    def test_concurrent_writes_use_separate_temp_files(self):
+        """Test that overlapping commits of one file never share a temp file."""
+        self.notes_dir.mkdir(parents=True)
+        target = self.notes_dir / "notes.json"
+        policy = DurabilityPolicy("relaxed")
+        temps = []
+
+        def outer(f):
+            temps.append(f.name)
+            f.write("outer")
+            policy.write(target, lambda g: temps.append(g.name) or g.write("inner"))
+
+        policy.write(target, outer)
+        self.assertNotEqual(temps[0], temps[1])
+        self.assertEqual(target.read_text(encoding="utf-8"), "outer")
+        self.assertEqual(list(self.notes_dir.glob("*.tmp")), [])
+
+    def test_failed_write_removes_temp_file(self):
+        """Test that a commit that raises leaves the old file and no temp file."""
+        self.notes_dir.mkdir(parents=True)
+        target = self.notes_dir / "notes.json"
+        target.write_text("old", encoding="utf-8")
+
+        def fail(f):
+            f.write("partial")
+            raise RuntimeError("boom")
+
+        with self.assertRaises(RuntimeError):
+            DurabilityPolicy("strict").write(target, fail)
+        self.assertEqual(target.read_text(encoding="utf-8"), "old")
+        self.assertEqual(list(self.notes_dir.glob("*.tmp")), [])
+
+    def test_commits_are_atomic_and_persist(self):
+        """Test that commits leave no temp files and survive a reload."""
+        for mode in DurabilityPolicy.MODES:
+            shutil.rmtree(self.notes_dir, ignore_errors=True)
+            notes = self.make_store(mode)
+            notes.add_note(f"Persisted in {mode} #durable")
+            notes.close()
+            self.assertEqual(list(self.notes_dir.glob("*.tmp")), [])
+            reloaded = SmartNotes(notes_dir=self.notes_dir)
+            self.assertEqual(reloaded.notes[0]["content"], f"Persisted in {mode} #durable")
+
+
+class TestSmartNotesChangeFeed(unittest.TestCase):
+    """Test the change feed and watch command."""
+
+    def setUp(self):
+        """Set up test environment."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.notes_dir = Path(self.temp_dir) / ".smartnotes"
+        self.notes = SmartNotes(notes_dir=self.notes_dir)
+
+    def tearDown(self):
+        """Clean up."""
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_mutations_are_logged_in_order(self):
+        """Test that each mutation appends one numbered event."""
+        self.notes.add_note("Feed note #feed")
+        self.notes.edit_note(1, "Feed note edited")
+        self.notes.tag_note(1, ["extra"])
+        self.notes.delete_note(1)
+        events = list(self.notes.iter_changes())
+        self.assertEqual([e["seq"] for e in events], [1, 2, 3, 4])
+        self.assertEqual([e["op"] for e in events], ["add", "update", "update", "delete"])
+        self.assertEqual(events[1]["note"]["content"], "Feed note edited")
+        self.assertNotIn("note", events[3])
+
+    def test_interleaved_writers_never_reuse_seq(self):
+        """Test that two open instances of one store number events consistently."""
+        other = SmartNotes(notes_dir=self.notes_dir)
+        self.notes.add_note("From A", on_duplicate="off")
+        other.add_note("From B", on_duplicate="off")
+        self.notes.add_note("From A again", on_duplicate="off")
+        events = list(self.notes.iter_changes(0))
+        self.assertEqual([e["seq"] for e in events], [1, 2, 3])
+        self.assertEqual([e["seq"] for e in other.iter_changes(2)], [3])
+
+    def test_concurrent_processes_never_reuse_seq(self):
+        """Test that appends from several processes are serialized."""
+        script = str(Path(__file__).parent / "smartnotes.py")
+        code = ("import sys, smartnotes\n"
+                "feed = smartnotes.ChangeFeed(sys.argv[1])\n"
+                "policy = smartnotes.DurabilityPolicy('relaxed')\n"
+                "for i in range(50):\n"
+                "    feed.append([{'op': 'add'}], policy)\n")
+        log = self.notes_dir / "changes.log"
+        env = dict(os.environ, PYTHONPATH=str(Path(script).parent))
+        procs = [subprocess.Popen([sys.executable, "-c", code, str(log)], env=env) for _ in range(4)]
+        for proc in procs:
+            self.assertEqual(proc.wait(), 0)
+        seqs = [e["seq"] for e in self.notes.iter_changes(0)]
+        self.assertEqual(sorted(seqs), list(range(1, 201)))
+
+    def test_resume_from_sequence(self):
+        """Test resuming after a sequence number, across instances."""
+        for i in range(5):
+            self.notes.add_note(f"Note {i}")
+        reopened = SmartNotes(notes_dir=self.notes_dir)
+        reopened.add_note("Note 5")
+        events = list(reopened.iter_changes(since=3))
+        self.assertEqual([e["seq"] for e in events], [4, 5, 6])
+        self.assertEqual(events[-1]["note"]["content"], "Note 5")
+        self.assertEqual(list(reopened.iter_changes(since=6)), [])
+
+    def test_binary_search_matches_scan(self):
+        """Test that the offset search finds the first event after every seq."""
+        feed = smartnotes.ChangeFeed(self.notes_dir / "big.log")
+        policy = smartnotes.DurabilityPolicy("relaxed")
+        feed.append([{"op": "add", "id": i, "pad": "x" * (i % 37)} for i in range(300)], policy)
+        with open(feed.path, "rb") as f:
+            lines = f.readlines()
+            starts = [sum(len(l) for l in lines[:i]) for i in range(len(lines) + 1)]
+            for since in (0, 1, 2, 150, 299, 300, 500):
+                self.assertEqual(feed.offset_after(f, since), starts[min(since, 300)])
+
+    def test_torn_last_line_is_skipped(self):
+        """Test that a partially written event does not break the feed."""
+        self.notes.add_note("Before crash")
+        with open(self.notes.changes.path, "ab") as f:
+            f.write(b'{"seq": 2, "op": "ad')
+        reopened = SmartNotes(notes_dir=self.notes_dir)
+        reopened.add_note("After crash")
+        events = list(reopened.iter_changes())
+        self.assertEqual([e["seq"] for e in events], [1, 2])
+        self.assertEqual(events[1]["note"]["content"], "After crash")
+
+    def test_follow_yields_new_events(self):
+        """Test that a following iterator picks up later appends."""
+        self.notes.add_note("Old note")
+        follower = self.notes.iter_changes(since=self.notes.changes.last_seq(),
+                                           follow=True, interval=0.01)
+        self.notes.add_note("New note")
+        self.assertEqual(next(follower)["note"]["content"], "New note")
+        self.notes.delete_note(1)
+        self.assertEqual(next(follower)["op"], "delete")
+
+    def test_failed_import_logs_nothing(self):
+        """Test that a rolled-back import leaves no events behind."""
+        bad = Path(self.temp_dir) / "bad.json"
+        bad.write_text('[{"content": "ok"}, {"content": ', encoding="utf-8")
+        self.assertFalse(self.notes.import_notes(bad))
+        self.notes.add_note("After failed import")
+        events = list(self.notes.iter_changes())
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]["note"]["content"], "After failed import")
+
+    def test_watch_once_ndjson(self):
+        """Test watch output as NDJSON records."""
+        self.notes.add_note("Watched note")
+        stream = io.StringIO()
+        self.notes.writer = RecordWriter("ndjson", stream=stream)
+        self.notes.watch(since=0, follow=False)
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(records[0]["type"], "change")
+        self.assertEqual(records[0]["op"], "add")
+        self.assertEqual(records[0]["id"], 1)
+
+
+class TestSmartNotesBulkOperations(unittest.TestCase):
+    """Test bulk tag, untag, delete and replace."""
+
+    def setUp(self):
+        """Set up a store with a few notes."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.notes_dir = Path(self.temp_dir) / ".smartnotes"
+        self.notes = SmartNotes(writer=RecordWriter("ndjson", stream=io.StringIO()),
+                                notes_dir=self.notes_dir)
+        for i in range(1, 7):
+            topic = "deploy" if i % 2 else "review"
+            self.notes.add_note(f"Note {i} about {topic} on staging-db #{topic}",
+                                tags=["manual"], on_duplicate="off")
+        self.saves = 0
+        original_save = self.notes.save_notes
+
+        def counting_save():
+            self.saves += 1
+            return original_save()
+        self.notes.save_notes = counting_save
+
+    def tearDown(self):
+        """Clean up."""
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def reload(self):
+        """Reload the store from disk."""
+        return SmartNotes(notes_dir=self.notes_dir)
+
+    def test_parse_id_spec(self):
+        """Test ID list parsing."""
+        self.assertEqual(smartnotes.parse_id_spec("5"), [5])
+        self.assertEqual(smartnotes.parse_id_spec("1,3, 7-9"), [1, 3, 7, 8, 9])
+        for bad in ("", "a", "5-3", "1,,x"):
+            with self.assertRaises(ValueError):
+                smartnotes.parse_id_spec(bad)
+
+    def test_tag_by_ids_saves_once(self):
+        """Test tagging many notes with a single save and an accurate count."""
+        self.notes.tag_notes(["archived"], ids=[1, 2, 3])
+        self.notes.tag_notes(["archived"], ids=[2, 3, 4, 99])
+        self.assertEqual(self.saves, 2)
+        self.notes.writer.flush()
+        record = json.loads(self.notes.writer.stream.getvalue().splitlines()[-1])
+        self.assertEqual(record["count"], 1)
+        self.assertEqual(record["ids"], [4])
+        self.assertEqual(record["missing"], [99])
+        self.assertEqual(sorted(self.reload()._tag_index["archived"]), [1, 2, 3, 4])
+
+    def test_tag_and_untag_by_query(self):
+        """Test selecting notes with a query."""
+        self.assertTrue(self.notes.tag_notes(["ops"], where="tag:deploy"))
+        self.assertEqual(sorted(self.notes._tag_index["ops"]), [1, 3, 5])
+        self.assertTrue(self.notes.untag_notes(["ops", "manual"], where="tag:ops"))
+        self.assertNotIn("ops", self.notes._tag_index)
+        self.assertEqual(sorted(self.notes._tag_index["manual"]), [2, 4, 6])
+        self.assertFalse(self.notes.tag_notes(["x"], where="tag:(("))
+
+    def test_delete_by_query(self):
+        """Test deleting matching notes in one commit, with tombstones."""
+        self.assertTrue(self.notes.delete_notes(where="tag:review"))
+        self.assertEqual(self.saves, 1)
+        store = self.reload()
+        self.assertEqual(sorted(n["id"] for n in store.notes), [1, 3, 5])
+        self.assertEqual(len(store.tombstones), 3)
+        self.assertFalse(self.notes.delete_notes())
+        self.assertEqual(len(self.notes.notes), 3)
+
+    def test_replace_literal_keeps_manual_tags(self):
+        """Test literal find and replace re-extracts only automatic tags."""
+        self.notes.replace_in_notes("staging-db", "prod-db (v2.*)", ids=[1, 2])
+        store = self.reload()
+        note = store.get_note_by_id(1)
+        self.assertEqual(note["content"], "Note 1 about deploy on prod-db (v2.*) #deploy")
+        self.assertIn("manual", note["tags"])
+        self.assertIn("deploy", note["tags"])
+        self.assertIn("staging-db", store.get_note_by_id(3)["content"])
+        self.assertEqual(self.saves, 1)
+
+    def test_replace_drops_stale_keywords_in_any_process(self):
+        """Test that keyword tags are re-derived the same way under any hash seed."""
+        home = Path(self.temp_dir) / "home"
+        script = str(Path(__file__).parent / "smartnotes.py")
+
+        def run(seed, *args):
+            env = dict(os.environ, HOME=str(home), USERPROFILE=str(home), PYTHONHASHSEED=seed)
+            subprocess.run([sys.executable, script, *args], env=env, check=True,
+                           stdout=subprocess.DEVNULL)
+        run("1", "add", "apples bananas cherries dates elderberries figs grapes")
+        run("7", "replace", "apples bananas cherries dates elderberries figs", "kiwis", "--ids", "1")
+        note = SmartNotes(notes_dir=home / ".smartnotes").get_note_by_id(1)
+        self.assertEqual(sorted(note["tags"]), ["grapes", "kiwis"])
+
+    def test_replace_regex(self):
+        """Test regex find and replace with group references."""
+        self.notes.replace_in_notes(r"Note (\d)", r"Item \1", regex=True, where="tag:review")
+        self.assertEqual(self.notes.get_note_by_id(2)["content"][:6], "Item 2")
+        self.assertEqual(self.notes.get_note_by_id(1)["content"][:6], "Note 1")
+        self.assertFalse(self.notes.replace_in_notes("Note", r"\9", regex=True))
+        self.assertEqual(self.notes.get_note_by_id(1)["content"][:6], "Note 1")
+
+    def test_failed_save_rolls_back(self):
+        """Test that a failed commit leaves memory as it was."""
+        before = json.dumps(self.notes.notes, sort_keys=True)
+        tag_index = {t: set(ids) for t, ids in self.notes._tag_index.items()}
+        self.notes.save_notes = lambda: False
+        self.assertFalse(self.notes.tag_notes(["archived"], where="tag:deploy"))
+        self.assertFalse(self.notes.delete_notes(ids=[1, 2]))
+        self.assertFalse(self.notes.replace_in_notes("Note", "Entry"))
+        self.assertEqual(json.dumps(self.notes.notes, sort_keys=True), before)
+        self.assertEqual(self.notes._tag_index, tag_index)
+        self.assertEqual(self.notes.stats.count, 6)
+        self.assertEqual(self.notes._pending_changes, [])
+
+
+class TestSmartNotesBlobStorage(unittest.TestCase):
+    """Test out-of-line blob storage for large notes."""
+
+    def setUp(self):
+        """Set up a store with a small blob threshold."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.notes_dir = Path(self.temp_dir) / ".smartnotes"
+        self.notes_dir.mkdir()
+        with open(self.notes_dir / "config.json", "w") as f:
+            json.dump({"blob_threshold": 200, "duplicates": "off"}, f)
+        self.notes = SmartNotes(notes_dir=self.notes_dir)
+        self.trace = "Traceback (most recent call last):\n" + "  File \"app.py\", line 1\r\n" * 20
+
+    def tearDown(self):
+        """Clean up."""
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def reload(self):
+        """Reload the store from disk."""
+        return SmartNotes(notes_dir=self.notes_dir)
+
+    def blobs(self):
+        """Blob files currently on disk."""
+        return sorted(p.name for p in (self.notes_dir / "blobs").rglob("*") if p.is_file())
+
+    def test_change_events_do_not_copy_blobs(self):
+        """Test that a tag change on a large note logs the blob reference, not the body."""
+        self.notes.add_note(self.trace)
+        store = self.reload()
+        store.tag_note(1, ["crash"])
+        event = list(store.iter_changes())[-1]
+        self.assertNotIn("content", event["note"])
+        self.assertEqual(event["note"]["length"], len(self.trace))
+        self.assertIn("crash", event["note"]["tags"])
+
+    def test_large_note_stored_out_of_line(self):
+        """Test that only a preview, length and hash stay in the store."""
+        self.notes.add_note(self.trace)
+        self.notes.add_note("Short note")
+        with open(self.notes_dir / "notes.json", encoding="utf-8") as f:
+            stored = json.load(f)
+        self.assertNotIn("content", stored[0])
+        self.assertEqual(stored[0]["length"], len(self.trace))
+        self.assertEqual(stored[0]["blob"], hashlib.sha256(self.trace.encode()).hexdigest())
+        self.assertEqual(stored[0]["preview"], self.trace[:80])
+        self.assertEqual(stored[1]["content"], "Short note")
+        self.assertEqual(self.blobs(), [stored[0]["blob"]])
+
+    def test_listing_does_not_read_blobs(self):
+        """Test that list and stats work from the preview and length."""
+        self.notes.add_note(self.trace)
+        store = self.reload()
+        with redirect_stdout(io.StringIO()) as out:
+            store.list_notes()
+        self.assertIn(self.trace[:77] + "...", out.getvalue())
+        self.assertIsNone(store.notes[0]._content)
+        self.assertEqual(store.stats.total_chars, len(self.trace))
+        self.assertEqual(store.notes[0]["content"], self.trace)
+        self.assertEqual(store.get_note_by_id(1).get("content"), self.trace)
+
+    def test_identical_payloads_stored_once(self):
+        """Test content-addressed deduplication of blobs."""
+        self.notes.add_note(self.trace)
+        self.notes.add_note(self.trace)
+        self.assertEqual(len(self.blobs()), 1)
+        self.notes.delete_note(1)
+        self.notes.close()
+        self.assertEqual(len(self.blobs()), 1)
+        self.notes.delete_note(2)
+        self.notes.close()
+        self.assertEqual(self.blobs(), [])
+
+    def test_edit_moves_content_back_inline(self):
+        """Test that shrinking a note inlines it and drops the unused blob."""
+        self.notes.add_note(self.trace)
+        store = self.reload()
+        store.edit_note(1, "Fixed: trace resolved")
+        store.close()
+        self.assertEqual(self.blobs(), [])
+        note = self.reload().get_note_by_id(1)
+        self.assertEqual(note["content"], "Fixed: trace resolved")
+        self.assertNotIn("blob", note)
+
+    def test_exports_materialize_content(self):
+        """Test that exports and structured records carry the full body."""
+        self.notes.add_note(self.trace)
+        store = self.reload()
+        export_file = Path(self.temp_dir) / "export.json"
+        store.export_notes(format="json", output_file=str(export_file))
+        with open(export_file, encoding="utf-8") as f:
+            exported = json.load(f)
+        self.assertEqual(exported[0]["content"], self.trace)
+        self.assertNotIn("blob", exported[0])
+        self.assertEqual(store._note_record(store.notes[0])["content"], self.trace)
+
+    def test_sync_with_inline_store(self):
+        """Test that stores with different thresholds converge."""
+        self.notes.add_note(self.trace)
+        other_dir = Path(self.temp_dir) / "other"
+        other_dir.mkdir()
+        with open(other_dir / "config.json", "w") as f:
+            json.dump({"blob_threshold": 0}, f)
+        store = self.reload()
+        self.assertTrue(store.sync(other_dir, init=True))
+        other = SmartNotes(notes_dir=other_dir)
+        self.assertEqual(other.notes[0]["content"], self.trace)
+        self.assertNotIn("blob", other.notes[0])
+        self.assertEqual(store._entry_digest(store.notes[0]), other._entry_digest(other.notes[0]))
+
+    def test_compressed_storage(self):
+        """Test blobs together with block-compressed storage."""
+        with open(self.notes_dir / "config.json", "w") as f:
+            json.dump({"blob_threshold": 200, "storage": "compressed"}, f)
+        store = self.reload()
+        store.add_note(self.trace)
+        self.assertEqual(self.reload().read_note(1)["content"], self.trace)
+
+
+class TestSmartNotesTagPrefix(unittest.TestCase):
+    """Test tag prefix lookup and completion."""
+
+    def setUp(self):
+        """Set up a store with a few tagged notes."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.notes = SmartNotes(notes_dir=Path(self.temp_dir) / ".smartnotes")
+        self.notes.add_note("One", tags=["python", "pytest"], on_duplicate="off")
+        self.notes.add_note("Two", tags=["pyramid", "rust"], on_duplicate="off")
+        self.notes.add_note("Three", tags=["py", "ops"], on_duplicate="off")
+
+    def tearDown(self):
+        """Clean up."""
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_prefix_lookup(self):
+        """Test that prefix lookup returns matching tags in order."""
+        self.assertEqual(self.notes.tags_with_prefix("py"), ["py", "pyramid", "pytest", "python"])
+        self.assertEqual(self.notes.tags_with_prefix("#PYT"), ["pytest", "python"])
+        self.assertEqual(self.notes.tags_with_prefix("zz"), [])
+        self.assertEqual(len(self.notes.tags_with_prefix("")), len(self.notes._tag_index))
+
+    def test_sorted_tags_follow_index(self):
+        """Test that the sorted tag array tracks the posting lists."""
+        self.notes.tag_note(2, ["pygame"])
+        self.notes.delete_note(1)
+        self.notes.untag_notes(["py"], ids=[3])
+        self.assertEqual(self.notes._tag_names, sorted(self.notes._tag_index))
+        self.assertNotIn("python", self.notes._tag_names)
+        self.assertIn("pygame", self.notes._tag_names)
+
+    def test_list_with_tag_prefix(self):
+        """Test list --tag with a trailing wildcard."""
+        stream = io.StringIO()
+        self.notes.writer = RecordWriter("ndjson", stream=stream)
+        self.notes.list_notes(tag_filter="pyt*")
+        self.notes.list_notes(tag_filter="py*")
+        self.notes.writer.flush()
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        summaries = [r["count"] for r in records if r["type"] == "summary"]
+        self.assertEqual(summaries, [1, 3])
+
+    def test_tags_names_only(self):
+        """Test bare tag output used by shell completion."""
+        with redirect_stdout(io.StringIO()) as out:
+            self.notes.list_tags(prefix="py", names_only=True)
+        self.assertEqual(out.getvalue().split(), ["py", "pyramid", "pytest", "python"])
+
+    def test_bash_completion_script(self):
+        """Test the generated bash completion script."""
+        script = smartnotes.bash_completion("my-notes", ["add", "list", "tags"])
+        self.assertIn("complete -F _my_notes_complete my-notes", script)
+        self.assertIn('compgen -W "add list tags"', script)
+        self.assertIn("my-notes tags --names-only --prefix", script)
+
+
+class TestSmartNotesHistory(unittest.TestCase):
+    """Test revision history, history and revert."""
+
+    def setUp(self):
+        """Set up test environment."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.notes_dir = Path(self.temp_dir) / ".smartnotes"
+        self.notes = SmartNotes(writer=RecordWriter("ndjson", stream=io.StringIO()),
+                                notes_dir=self.notes_dir)
+
+    def tearDown(self):
+        """Clean up."""
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_delta_round_trip(self):
+        """Test that deltas rebuild the older text exactly."""
+        rng = random.Random(3)
+        words = ["alpha", "beta", "gamma", "\n", "\r\n", " ", "ünïcode", "x" * 50]
+        for _ in range(200):
+            old = "".join(rng.choice(words) for _ in range(rng.randint(0, 60)))
+            new = list(old)
+            for _ in range(rng.randint(0, 5)):
+                pos = rng.randint(0, len(new))
+                new[pos:pos + rng.randint(0, 8)] = rng.choice(words)
+            new = "".join(new)
+            delta = smartnotes.text_delta(new, old)
+            self.assertEqual(smartnotes.apply_text_delta(new, delta), old)
+
+    def test_delta_size_tracks_change(self):
+        """Test that a small edit to a large note stores a small delta."""
+        lines = [f"log line {i}: worker heartbeat ok\n" for i in range(400)]
+        old = "".join(lines)
+        lines[200] = "log line 200: worker heartbeat FAILED\n"
+        new = "".join(lines)
+        delta = smartnotes.text_delta(new, old)
+        self.assertLess(len(json.dumps(delta)), 60)
+        self.assertEqual(smartnotes.apply_text_delta(new, delta), old)
+
+    def test_delta_on_large_repetitive_log_is_fast(self):
+        """Test that repeated lines in a large log do not make diffing quadratic."""
+        rng = random.Random(5)
+        heartbeat = ["INFO heartbeat ok\n"] * 20000
+        few = [rng.choice(["INFO a\n", "WARN b\n", "INFO c\n"]) for _ in range(20000)]
+        for lines in (heartbeat, few):
+            old = "".join(lines)
+            changed = list(lines)
+            changed[10000] = "ERROR heartbeat missed\n"
+            changed[12000:12000] = ["INFO restarted\n"]
+            changed = [line if rng.random() > 0.01 else "DEBUG\n" for line in changed]
+            for new in ("".join(changed), old.replace("ok", "OK", 1)):
+                start = time.perf_counter()
+                delta = smartnotes.text_delta(new, old)
+                self.assertLess(time.perf_counter() - start, 2)
+                self.assertEqual(smartnotes.apply_text_delta(new, delta), old)
+
+    def test_edits_keep_history(self):
+        """Test that each edit adds a revision and the current text stays in full."""
+        self.notes.add_note("Version one")
+        self.notes.edit_note(1, "Version two")
+        self.notes.edit_note(1, "Version three, longer")
+        note = SmartNotes(notes_dir=self.notes_dir).get_note_by_id(1)
+        self.assertEqual(note["content"], "Version three, longer")
+        self.assertEqual(len(note["history"]), 2)
+        self.assertEqual([rev for rev, _, _ in self.notes.revisions(note)], [3, 2, 1])
+        self.assertEqual(self.notes.get_revision(note, 1), "Version one")
+        self.assertEqual(self.notes.get_revision(note, 2), "Version two")
+        self.assertIsNone(self.notes.get_revision(note, 4))
+        self.assertIsNone(self.notes.get_revision(note, 0))
+
+    def test_revert_adds_revision(self):
+        """Test that revert restores old text as a new, revertible revision."""
+        self.notes.add_note("Original #keep")
+        self.notes.edit_note(1, "Mistake")
+        self.assertTrue(self.notes.revert_note(1, 1))
+        note = self.notes.get_note_by_id(1)
+        self.assertEqual(note["content"], "Original #keep")
+        self.assertIn("keep", note["tags"])
+        self.assertEqual(self.notes.get_revision(note, 2), "Mistake")
+        self.assertFalse(self.notes.revert_note(1, 9))
+        self.assertFalse(self.notes.revert_note(42, 1))
+
+    def test_replace_records_history(self):
+        """Test that bulk find and replace is undoable per note."""
+        self.notes.add_note("Connect to staging-db", on_duplicate="off")
+        self.notes.replace_in_notes("staging-db", "prod-db")
+        note = self.notes.get_note_by_id(1)
+        self.assertEqual(self.notes.get_revision(note, 1), "Connect to staging-db")
+
+    def test_history_output(self):
+        """Test structured history records and that note records omit deltas."""
+        self.notes.add_note("First draft")
+        self.notes.edit_note(1, "Second draft")
+        stream = io.StringIO()
+        self.notes.writer = RecordWriter("ndjson", stream=stream)
+        self.notes.show_history(1)
+        self.notes.show_history(1, rev=1)
+        self.notes.show_note(1)
+        self.notes.writer.flush()
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([(r["rev"], r["current"]) for r in records[:2]], [(2, True), (1, False)])
+        self.assertEqual(records[2]["content"], "First draft")
+        self.assertNotIn("history", records[3])
+
+
+class TestSmartNotesThreadSafety(unittest.TestCase):
+    """Test the reader-writer lock, batch() and concurrent use."""
+
+    def setUp(self):
+        """Set up a thread-safe store."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.notes_dir = Path(self.temp_dir) / ".smartnotes"
+        self.notes_dir.mkdir()
+        with open(self.notes_dir / "config.json", "w") as f:
+            json.dump({"durability": "relaxed", "duplicates": "off"}, f)
+        self.notes = SmartNotes(writer=RecordWriter("ndjson", stream=io.StringIO()),
+                                notes_dir=self.notes_dir, thread_safe=True)
+
+    def tearDown(self):
+        """Clean up."""
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_readers_share_writers_exclude(self):
+        """Test that reads overlap while a write waits for them."""
+        lock = smartnotes.RWLock()
+        inside = threading.Barrier(3, timeout=5)
+        order = []
+
+        def reader():
+            with lock.read():
+                inside.wait()
+                time.sleep(0.05)
+                order.append("read")
+
+        def writer():
+            inside.wait()
+            with lock.write():
+                order.append("write")
+
+        threads = [threading.Thread(target=reader), threading.Thread(target=reader),
+                   threading.Thread(target=writer)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(order, ["read", "read", "write"])
+
+    def test_lock_is_reentrant(self):
+        """Test nesting reads and writes in one thread."""
+        lock = smartnotes.RWLock()
+        with lock.write():
+            with lock.write():
+                with lock.read():
+                    pass
+        with lock.read():
+            with lock.read():
+                with self.assertRaises(RuntimeError):
+                    lock.acquire_write()
+        with lock.write():
+            pass
+
+    def test_batch_saves_once(self):
+        """Test that writes inside batch() are saved together at the end."""
+        self.notes.add_note("Before batch")
+        mtime = os.stat(self.notes.notes_file).st_mtime_ns
+        with self.notes.batch():
+            for i in range(20):
+                self.notes.add_note(f"Batched {i}")
+            self.notes.tag_note(1, ["batched"])
+            self.assertEqual(os.stat(self.notes.notes_file).st_mtime_ns, mtime)
+            self.assertEqual(len(SmartNotes(notes_dir=self.notes_dir).notes), 1)
+        self.assertEqual(len(SmartNotes(notes_dir=self.notes_dir).notes), 21)
+        self.assertEqual(len(list(self.notes.iter_changes())), 22)
+
+    def test_batch_rolls_back_on_error(self):
+        """Test that an exception inside batch() saves nothing and restores the notes."""
+        self.notes.add_note("Before batch")
+        with self.assertRaises(KeyError):
+            with self.notes.batch():
+                self.notes.add_note("Half done")
+                self.notes.tag_note(1, ["partial"])
+                self.notes.edit_note(1, "Edited in a failed batch")
+                raise KeyError("boom")
+        self.assertEqual([n["content"] for n in self.notes.notes], ["Before batch"])
+        self.assertNotIn("partial", self.notes._tag_index)
+        self.assertEqual(self.notes.stats.count, 1)
+        store = SmartNotes(notes_dir=self.notes_dir)
+        self.assertEqual([n["content"] for n in store.notes], ["Before batch"])
+        self.assertEqual(len(list(store.iter_changes())), 1)
+
+    def test_concurrent_readers_and_writers(self):
+        """Stress test: readers never see torn state and no write is lost."""
+        errors = []
+        stop = threading.Event()
+        added = [0] * 3
+
+        def check(condition, message):
+            if not condition:
+                errors.append(message)
+
+        def reader():
+            try:
+                while not stop.is_set():
+                    with self.notes._lock.read():
+                        check(len(self.notes.notes) == len(self.notes._by_id), "notes/_by_id differ")
+                        check(self.notes.stats.count == len(self.notes.notes), "stats out of step")
+                    self.notes.list_notes(search_term="worker")
+                    for note in self.notes.query_notes("tag:stress OR tag:extra"):
+                        check("stress" in note["tags"], f"query returned note #{note['id']}")
+                    self.notes.tags_with_prefix("st")
+                    self.notes.get_stats()
+            except Exception as e:  # pragma: no cover - reported below
+                errors.append(repr(e))
+
+        def writer(n):
+            try:
+                for i in range(25):
+                    self.notes.add_note(f"worker {n} entry {i} #stress")
+                    added[n] += 1
+                    if i % 5 == 4:
+                        with self.notes.batch():
+                            self.notes.tag_notes(["extra"], where="tag:stress")
+                            self.notes.delete_notes(ids=[max(self.notes._by_id)])
+                            added[n] -= 1
+            except Exception as e:  # pragma: no cover - reported below
+                errors.append(repr(e))
+
+        readers = [threading.Thread(target=reader) for _ in range(4)]
+        writers = [threading.Thread(target=writer, args=(n,)) for n in range(3)]
+        for t in readers + writers:
+            t.start()
+        for t in writers:
+            t.join(60)
+        stop.set()
+        for t in readers:
+            t.join(60)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.notes.notes), sum(added))
+        self.assertEqual(len({n["id"] for n in self.notes.notes}), sum(added))
+        tag_index = {t: set(ids) for t, ids in self.notes._tag_index.items()}
+        self.notes._build_lookups()
+        self.assertEqual(self.notes._tag_index, tag_index)
+        reloaded = SmartNotes(notes_dir=self.notes_dir)
+        self.assertEqual(sorted(n["id"] for n in reloaded.notes),
+                         sorted(n["id"] for n in self.notes.notes))
+
+
+class TestSmartNotesQueryCache(unittest.TestCase):
+    """Test the persistent query result cache."""
+
+    def setUp(self):
+        """Set up a store with a few notes."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.notes_dir = Path(self.temp_dir) / ".smartnotes"
+        store = self.open()
+        for i in range(5):
+            store.add_note(f"Cache note {i} #cache", tags=["even"] if i % 2 == 0 else [],
+                           on_duplicate="off")
+        store.close()
+
+    def tearDown(self):
+        """Clean up."""
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def open(self):
+        """Open the store with structured output captured."""
+        return SmartNotes(writer=RecordWriter("ndjson", stream=io.StringIO()),
+                          notes_dir=self.notes_dir)
+
+    def listed(self, store, **kwargs):
+        """IDs printed by list_notes."""
+        store.writer = RecordWriter("ndjson", stream=io.StringIO())
+        store.list_notes(**kwargs)
+        store.writer.flush()
+        return [r["id"] for r in map(json.loads, store.writer.stream.getvalue().splitlines())
+                if r["type"] == "note"]
+
+    def test_repeated_list_hits(self):
+        """Test that the same list is answered from the cache."""
+        store = self.open()
+        first = self.listed(store, tag_filter="even", limit=2)
+        second = self.listed(store, tag_filter="#EVEN", limit=2)
+        self.assertEqual(first, second)
+        self.assertEqual((store.query_cache.hits, store.query_cache.misses), (1, 1))
+
+    def test_mutation_invalidates(self):
+        """Test that any write empties the cache."""
+        store = self.open()
+        self.assertEqual(len(self.listed(store, tag_filter="cache")), 5)
+        store.add_note("Another #cache", on_duplicate="off")
+        self.assertEqual(len(self.listed(store, tag_filter="cache")), 6)
+        store.tag_note(6, ["even"])
+        self.assertIn(6, self.listed(store, tag_filter="even"))
+        self.assertEqual(store.query_cache.hits, 0)
+
+    def test_persists_across_instances(self):
+        """Test that a later process reuses cached results."""
+        store = self.open()
+        expected = self.listed(store, search_term="note", limit=3)
+        store.close()
+        again = self.open()
+        self.assertEqual(self.listed(again, search_term="note", limit=3), expected)
+        self.assertEqual(again.query_cache.hits, 1)
+
+    def test_other_writer_invalidates_persisted_entries(self):
+        """Test that entries saved for an older store version are ignored."""
+        store = self.open()
+        self.listed(store, tag_filter="cache")
+        store.close()
+        writer = self.open()
+        writer.add_note("Written elsewhere #cache", on_duplicate="off")
+        writer.close()
+        reader = self.open()
+        self.assertEqual(len(self.listed(reader, tag_filter="cache")), 6)
+        self.assertEqual(reader.query_cache.hits, 0)
+        self.assertEqual(reader.query_cache.misses, 2)
+
+    def test_unsaved_results_not_persisted(self):
+        """Test that results computed from unsaved changes are dropped on close."""
+        store = self.open()
+        store.save_notes = lambda: False
+        store.add_note("Never saved #cache", on_duplicate="off")
+        self.assertEqual(len(self.listed(store, tag_filter="cache")), 6)
+        store.close()
+        with open(self.notes_dir / "cache.json", encoding="utf-8") as f:
+            self.assertEqual(json.load(f)["entries"], [])
+
+    def test_query_key_is_normalized(self):
+        """Test that equivalent query spellings share an entry."""
+        store = self.open()
+        first = store.query_notes("tag:cache tag:even")
+        second = store.query_notes("tag:CACHE  AND  #even")
+        self.assertEqual([n["id"] for n in first], [n["id"] for n in second])
+        self.assertEqual(store.query_cache.hits, 1)
+
+    def test_lru_eviction(self):
+        """Test least-recently-used eviction."""
+        cache = smartnotes.QueryCache(capacity=2)
+        cache.put("a", [1], 0)
+        cache.put("b", [2], 0)
+        cache.get("a", 0)
+        cache.put("c", [3], 0)
+        self.assertEqual(list(cache.entries), ["a", "c"])
+        self.assertIsNone(cache.get("a", 1))
+        self.assertEqual(cache.entries, {})
+
+    def test_hit_rate_report(self):
+        """Test the cache report record."""
+        store = self.open()
+        for _ in range(4):
+            self.listed(store, limit=2)
+        store.writer = RecordWriter("ndjson", stream=io.StringIO())
+        store.show_cache()
+        store.writer.flush()
+        record = json.loads(store.writer.stream.getvalue())
+        self.assertEqual(record["type"], "cache")
+        self.assertEqual(record["hit_rate"], 0.75)
+
+
+class TestSmartNotesStreamingLoad(unittest.TestCase):
+    """Test the record-by-record notes.json loader."""
+
+    def setUp(self):
+        """Set up a store with a few notes."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.notes_dir = Path(self.temp_dir) / ".smartnotes"
+        store = self.open()
+        for i in range(1, 6):
+            store.add_note(f"Stream note {i}", on_duplicate="off")
+        store.close()
+        self.notes_file = self.notes_dir / "notes.json"
+
+    def tearDown(self):
+        """Clean up."""
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def open(self):
+        """Open the store with structured output captured."""
+        return SmartNotes(writer=RecordWriter("ndjson", stream=io.StringIO()),
+                          notes_dir=self.notes_dir)
+
+    def corrupt(self, old, new):
+        """Replace text in notes.json and return the damaged contents."""
+        text = self.notes_file.read_text(encoding="utf-8").replace(old, new, 1)
+        self.notes_file.write_text(text, encoding="utf-8")
+        return text
+
+    def backups(self):
+        """Backup copies written next to notes.json."""
+        return sorted(self.notes_dir.glob("notes.json.corrupt-*"))
+
+    def test_skips_malformed_record(self):
+        """Test that one damaged record does not lose the others."""
+        damaged = self.corrupt('"id": 3,', '"id": 3 oops')
+        store = self.open()
+        self.assertEqual([n["id"] for n in store.notes], [1, 2, 4, 5])
+        store.writer.flush()
+        records = [json.loads(line) for line in store.writer.stream.getvalue().splitlines()]
+        self.assertEqual(records[-1]["problems"], 1)
+        self.assertIn("element skipped", records[0]["message"])
+        self.assertEqual(records[-1]["loaded"], 4)
+        self.assertEqual(len(self.backups()), 1)
+        self.assertEqual(self.backups()[0].read_text(encoding="utf-8"), damaged)
+        store.close()
+
+    def test_skips_non_note_records(self):
+        """Test that well-formed values that are not notes are skipped."""
+        self.corrupt("[", '[\n  42,\n  {"content": "no id"},')
+        store = self.open()
+        self.assertEqual(len(store.notes), 5)
+        self.assertEqual(len(self.backups()), 1)
+        store.close()
+
+    def test_truncated_file_keeps_leading_notes(self):
+        """Test that a file cut off mid-record keeps everything before the cut."""
+        text = self.notes_file.read_text(encoding="utf-8")
+        self.notes_file.write_text(text[:text.index('"id": 4')], encoding="utf-8")
+        store = self.open()
+        self.assertEqual([n["id"] for n in store.notes], [1, 2, 3])
+        store.add_note("After recovery", on_duplicate="off")
+        store.close()
+        self.assertEqual(len(self.open().notes), 4)
+        self.assertEqual(len(self.backups()), 1)
+
+    def test_invalid_utf8_is_reported_and_backed_up(self):
+        """Test that undecodable bytes are not silently replaced."""
+        raw = self.notes_file.read_bytes().replace(b"Stream note 2", b"Stream note \xff2", 1)
+        self.notes_file.write_bytes(raw)
+        store = self.open()
+        self.assertEqual(len(store.notes), 5)
+        self.assertEqual(store.get_note_by_id(2)["content"], "Stream note \ufffd2")
+        store.writer.flush()
+        self.assertIn("Invalid UTF-8", store.writer.stream.getvalue())
+        self.assertEqual(self.backups()[0].read_bytes(), raw)
+        store.close()
+
+    def test_stray_delimiters_are_reported(self):
+        """Test that missing or doubled commas are reported, keeping every note."""
+        text = self.notes_file.read_text(encoding="utf-8")
+        text = text.replace("},\n  {", "}\n  {", 1).replace("},\n  {", "},,\n  {", 1)
+        self.notes_file.write_text(text, encoding="utf-8")
+        store = self.open()
+        self.assertEqual(len(store.notes), 5)
+        self.assertEqual(len(self.backups()), 1)
+        errors = []
+        list(iter_json_array(io.StringIO("[1 2,,3,]"), on_error=lambda offset, msg: errors.append(msg)))
+        self.assertEqual(len(errors), 3)
+
+    def test_unreadable_store_is_backed_up(self):
+        """Test that a store that cannot be read at all is copied before it is overwritten."""
+        self.notes_file.write_text('{"not": "an array"}', encoding="utf-8")
+        store = self.open()
+        self.assertEqual(store.notes, [])
+        store.add_note("Fresh start", on_duplicate="off")
+        store.close()
+        self.assertEqual(self.backups()[0].read_text(encoding="utf-8"), '{"not": "an array"}')
+
+    def test_clean_load_writes_no_backup(self):
+        """Test that a healthy store loads without warnings or backups."""
+        store = self.open()
+        store.writer.flush()
+        self.assertEqual(store.writer.stream.getvalue(), "")
+        self.assertEqual(len(store.notes), 5)
+        self.assertEqual(self.backups(), [])
+
+    def test_iter_json_array_resyncs_compact(self):
+        """Test recovery in compact JSON across small chunks."""
+        data = [{"id": i, "tags": [{"n": i}]} for i in range(1, 8)]
+        text = json.dumps(data).replace('"id": 4,', '"id": 4,,', 1)
+        errors = []
+        items = list(iter_json_array(io.StringIO(text), chunk_size=9,
+                                     on_error=lambda offset, msg: errors.append(offset)))
+        self.assertEqual([item["id"] for item in items], [1, 2, 3, 5, 6, 7])
+        self.assertEqual(len(errors), 1)
+        with self.assertRaises(ValueError):
+            list(iter_json_array(io.StringIO(text), chunk_size=9))
+
+
 class TestSmartNotesTagExtraction(unittest.TestCase):
     """Test tag extraction logic."""
 
@@ -526,6 +2267,86 @@ class TestSmartNotesGetNoteById(unittest.TestCase):
         self.assertIsNone(note)
 
 
+class TestSmartNotesStructuredOutput(unittest.TestCase):
+    """Test JSON / NDJSON output mode."""
+
+    def setUp(self):
+        """Set up test environment with an NDJSON writer."""
+        self.temp_dir = tempfile.mkdtemp()
+        os.environ['HOME'] = self.temp_dir
+        os.environ['USERPROFILE'] = self.temp_dir
+        self.stream = io.StringIO()
+        self.notes = SmartNotes(writer=RecordWriter("ndjson", stream=self.stream))
+
+    def tearDown(self):
+        """Clean up."""
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def records(self):
+        """Parse everything written so far."""
+        self.notes.writer.flush()
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_closed_pipe_exits_quietly(self):
+        """Test that a consumer exiting early (``| head -1``) causes no traceback."""
+        created = datetime.now().isoformat()
+        with open(self.notes.notes_file, "w", encoding="utf-8") as f:
+            json.dump([{"id": i, "content": f"Piped note {i} " + "x" * 200, "tags": ["deploy"],
+                        "created": created, "modified": created} for i in range(1, 2001)], f)
+        proc = subprocess.Popen([sys.executable, str(Path(__file__).parent / "smartnotes.py"),
+                                 "list", "--tag", "deploy", "--ndjson"],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertEqual(json.loads(proc.stdout.readline())["type"], "note")
+        proc.stdout.close()
+        stderr = proc.stderr.read().decode()
+        proc.stderr.close()
+        self.assertEqual(proc.wait(), 1)
+        self.assertNotIn("Traceback", stderr)
+
+    def test_add_emits_result(self):
+        """Test that add emits a result record."""
+        self.notes.add_note("Structured #output")
+        record = self.records()[0]
+        self.assertEqual(record["type"], "result")
+        self.assertEqual(record["action"], "add")
+        self.assertEqual(record["id"], 1)
+        self.assertIn("output", record["tags"])
+
+    def test_list_is_not_truncated(self):
+        """Test that listed notes carry their full content."""
+        long_content = "word " * 100
+        self.notes.add_note(long_content)
+        self.stream.truncate(0)
+        self.stream.seek(0)
+        self.notes.list_notes()
+        records = self.records()
+        self.assertEqual(records[0]["type"], "note")
+        self.assertEqual(records[0]["content"], long_content)
+        self.assertEqual(records[-1], {"type": "summary", "action": "list", "count": 1})
+
+    def test_missing_note_emits_error(self):
+        """Test that errors are reported as records."""
+        self.assertFalse(self.notes.show_note(42))
+        record = self.records()[0]
+        self.assertEqual(record["type"], "error")
+        self.assertEqual(record["id"], 42)
+
+    def test_json_mode_emits_array(self):
+        """Test that JSON mode produces one valid array."""
+        stream = io.StringIO()
+        writer = RecordWriter("json", stream=stream)
+        writer.write({"a": 1})
+        writer.write({"b": 2})
+        writer.close()
+        self.assertEqual(json.loads(stream.getvalue()), [{"a": 1}, {"b": 2}])
+
+    def test_json_mode_empty_array(self):
+        """Test that an empty JSON stream is still valid JSON."""
+        stream = io.StringIO()
+        RecordWriter("json", stream=stream).close()
+        self.assertEqual(json.loads(stream.getvalue()), [])
+
+
 def run_tests():
     """Run all tests with nice output."""
     print("=" * 70)
@@ -546,10 +2367,28 @@ def run_tests():
         TestSmartNotesDeleteNote,
         TestSmartNotesTagging,
         TestSmartNotesExport,
+        TestSmartNotesParallelExport,
         TestSmartNotesStats,
+        TestSmartNotesRunningStats,
+        TestSmartNotesDuplicates,
+        TestSmartNotesRelated,
+        TestSmartNotesQuery,
+        TestSmartNotesCompressedStorage,
+        TestSmartNotesImport,
+        TestSmartNotesSync,
+        TestSmartNotesDurability,
+        TestSmartNotesChangeFeed,
+        TestSmartNotesBulkOperations,
+        TestSmartNotesBlobStorage,
+        TestSmartNotesTagPrefix,
+        TestSmartNotesHistory,
+        TestSmartNotesThreadSafety,
+        TestSmartNotesQueryCache,
+        TestSmartNotesStreamingLoad,
         TestSmartNotesTagExtraction,
         TestSmartNotesEdgeCases,
         TestSmartNotesGetNoteById,
+        TestSmartNotesStructuredOutput,
     ]
     
     for test_class in test_classes: